@@ -0,0 +1,176 @@
+"""
+    Case allowance and sitewide download accounting with atomic redis counters, used instead of locking the CapUser
+    and SiteLimits rows when settings.API_CASE_ALLOWANCE_COUNTERS is 'redis'.
+
+    Redis only holds downloads that haven't been written back to the database yet:
+
+        case_allowance:<user id>:<window>   cases taken from a user's allowance in the window starting at
+                                            case_allowance_last_updated (as microseconds since the epoch)
+        case_allowance:dirty                set of "<user id>:<window>" with counts waiting to be written back
+        site_limits:daily_downloads         restricted cases downloaded sitewide
+
+    A user's available allowance is CapUser.case_allowance_remaining minus their pending count, and sitewide
+    downloads are SiteLimits.daily_downloads plus the pending count, so changes made directly in the database still
+    take effect immediately. reconcile_case_allowances() moves pending counts into the database; counts for a window
+    that has since been reset are dropped, as they no longer count against anything.
+
+    Moving a count writes to the database and then subtracts from redis, so a request that read the database before
+    the write but reaches redis after the subtraction would miss the count. To catch that, each subtraction also
+    increments <key>:released, which take_case_allowance() reads before reading the database; if it has changed by
+    the time the take runs, the take is retried with a fresh read.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import F
+
+from capdb import storages
+
+
+DIRTY_KEY = 'case_allowance:dirty'
+SITE_DOWNLOADS_KEY = 'site_limits:daily_downloads'
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+# KEYS: user key, site key, dirty set, user released key, site released key
+# ARGV: case count, user's allowance remaining in the database, sitewide downloads in the database, sitewide limit,
+#       '1' if the user has unlimited access, user key ttl, dirty set member, user released count and site released
+#       count read before the database
+# Returns {cases granted, sitewide downloads available, user allowance available}, or {-1} if a pending count was
+# released after the database was read
+TAKE_CASE_ALLOWANCE_SCRIPT = """
+if (redis.call('GET', KEYS[4]) or '0') ~= ARGV[8] or (redis.call('GET', KEYS[5]) or '0') ~= ARGV[9] then
+    return {-1}
+end
+local count = tonumber(ARGV[1])
+local site_available = math.max(0, tonumber(ARGV[4]) - tonumber(ARGV[3]) - tonumber(redis.call('GET', KEYS[2]) or '0'))
+if ARGV[5] == '1' then
+    return {0, site_available, 0}
+end
+local user_available = math.max(0, tonumber(ARGV[2]) - tonumber(redis.call('GET', KEYS[1]) or '0'))
+local granted = math.min(count, user_available, site_available)
+if granted > 0 then
+    redis.call('INCRBY', KEYS[1], granted)
+    redis.call('EXPIRE', KEYS[1], ARGV[6])
+    redis.call('INCRBY', KEYS[2], granted)
+    redis.call('SADD', KEYS[3], ARGV[7])
+end
+return {granted, site_available, user_available}
+"""
+
+# subtract a pending count that has been written to the database, unless the key has expired in the meantime, and
+# record the release for takes that read the database before the write
+# KEYS: pending count key, released key
+# ARGV: count written to the database
+RELEASE_PENDING_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('DECRBY', KEYS[1], ARGV[1])
+    redis.call('INCR', KEYS[2])
+    local ttl = redis.call('PTTL', KEYS[1])
+    if ttl > 0 then
+        redis.call('PEXPIRE', KEYS[2], ttl)
+    end
+end
+"""
+
+
+def window_id(case_allowance_last_updated):
+    """
+        >>> window_id(datetime(1970, 1, 1, 0, 0, 1, 5, tzinfo=dt_timezone.utc))
+        1000005
+    """
+    return (case_allowance_last_updated - EPOCH) // timedelta(microseconds=1)
+
+
+def start_case_allowance_window(user):
+    """
+        Apply the daily reset in CapUser.update_case_allowance(), saving it only if another request hasn't already,
+        so the user row doesn't have to be locked.
+    """
+    from capapi.models import CapUser  # avoid circular import
+
+    previous = user.case_allowance_last_updated
+    user.update_case_allowance(save=False)
+    if user.case_allowance_last_updated != previous:
+        updated = CapUser.objects.filter(pk=user.pk, case_allowance_last_updated=previous).update(
+            case_allowance_remaining=user.case_allowance_remaining,
+            case_allowance_last_updated=user.case_allowance_last_updated)
+        if not updated:
+            user.refresh_from_db(fields=['case_allowance_remaining', 'case_allowance_last_updated'])
+
+
+def take_case_allowance(user, case_ids):
+    """
+        Atomically take one case from user's allowance, and one sitewide download, for each of case_ids, which are
+        restricted cases the user hasn't already downloaded. Return {case_id: casebody status}, where statuses are as
+        if each case were checked in order by CaseDocumentSerializerWithCasebody: 'error_sitewide_limit_exceeded' once
+        sitewide downloads reach the limit, otherwise 'error_limit_exceeded' once the user's allowance runs out.
+        Users with unlimited access don't use any allowance or sitewide downloads.
+
+        The database side of each counter is read here rather than taken from user, which may have been loaded before
+        reconcile_case_allowances() last ran.
+    """
+    from capapi.models import CapUser, SiteLimits  # avoid circular import
+
+    if not case_ids:
+        return {}
+    redis_client = storages.redis_client
+    take = redis_client.register_script(TAKE_CASE_ALLOWANCE_SCRIPT)
+    unlimited = user.unlimited_access_in_effect()
+    window = None if unlimited else window_id(user.case_allowance_last_updated)
+    member = '%s:%s' % (user.pk, window)
+    user_key = 'case_allowance:%s' % member
+    while True:
+        user_released, site_released = redis_client.mget(user_key + ':released', SITE_DOWNLOADS_KEY + ':released')
+        site_limits = SiteLimits.get()
+        remaining = 0 if unlimited else CapUser.objects.filter(
+            pk=user.pk, case_allowance_last_updated=user.case_allowance_last_updated,
+        ).values_list('case_allowance_remaining', flat=True).first() or 0
+        result = take(
+            keys=[user_key, SITE_DOWNLOADS_KEY, DIRTY_KEY, user_key + ':released', SITE_DOWNLOADS_KEY + ':released'],
+            args=[
+                len(case_ids),
+                remaining,
+                site_limits.daily_downloads,
+                site_limits.daily_download_limit,
+                '1' if unlimited else '0',
+                settings.API_CASE_EXPIRE_HOURS * 60 * 60 * 2,
+                member,
+                user_released or 0,
+                site_released or 0,
+            ])
+        if result[0] != -1:
+            break
+    granted, site_available, _ = result
+    if unlimited:
+        granted = len(case_ids) if site_available else 0
+    # cases that weren't granted ran into whichever limit stopped the others
+    error = 'error_sitewide_limit_exceeded' if granted >= site_available else 'error_limit_exceeded'
+    return {case_id: 'ok' if i < granted else error for i, case_id in enumerate(case_ids)}
+
+
+def reconcile_case_allowances(batch_size=1000):
+    """ Move pending counts from redis into SiteLimits.daily_downloads and CapUser.case_allowance_remaining. """
+    from capapi.models import CapUser, SiteLimits  # avoid circular import
+
+    redis_client = storages.redis_client
+    release_pending = redis_client.register_script(RELEASE_PENDING_SCRIPT)
+    pending = int(redis_client.get(SITE_DOWNLOADS_KEY) or 0)
+    if pending:
+        SiteLimits.get()
+        SiteLimits.objects.filter(pk=1).update(daily_downloads=F('daily_downloads') + pending)
+        release_pending(keys=[SITE_DOWNLOADS_KEY, SITE_DOWNLOADS_KEY + ':released'], args=[pending])
+
+    while True:
+        members = redis_client.spop(DIRTY_KEY, batch_size)
+        if not members:
+            break
+        for member in members:
+            user_id, window = member.decode().split(':')
+            key = 'case_allowance:%s:%s' % (user_id, window)
+            pending = int(redis_client.get(key) or 0)
+            if pending:
+                CapUser.objects.filter(
+                    pk=user_id,
+                    case_allowance_last_updated=EPOCH + timedelta(microseconds=int(window)),
+                ).update(case_allowance_remaining=F('case_allowance_remaining') - pending)
+                release_pending(keys=[key, key + ':released'], args=[pending])
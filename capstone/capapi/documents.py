@@ -6,6 +6,7 @@ from django.conf import settings
 from elasticsearch_dsl import Search, Q
 
 from capdb.models import CaseMetadata, CaseLastUpdate
+from scripts.body_store import BODY_FORMATS, body_ref
 from scripts.helpers import alphanum_lower
 from scripts.simhash import get_distance
 
@@ -127,6 +128,7 @@ class CaseDocument(Document):
     casebody_data = fields.ObjectField(properties={
         'xml': fields.TextField(index=False),
         'html': fields.TextField(index=False),
+        'body_ref': fields.KeywordField(index=False),
         'text': fields.ObjectField(properties={
             'attorneys': fields.TextField(multi=True),
             'judges': fields.TextField(multi=True),
@@ -212,11 +214,18 @@ class CaseDocument(Document):
             if i in cites_by_id:
                 body.json['opinions'][i]['extracted_citations'] = [serializer.get_value_from_instance(c) for c in cites_by_id[i]]
 
-        return instance.redact_obj({
+        casebody_data = instance.redact_obj({
             'xml': body.xml,
             'html': body.html,
             'text': body.json,
         })
+        # xml and html aren't searchable, so they can be left out of the _source, to be fetched by
+        # scripts.body_store.get_bodies() when requested. body_ref identifies the version that was indexed.
+        casebody_data['body_ref'] = body_ref(casebody_data['xml'], casebody_data['html'])
+        if settings.ELASTICSEARCH_BODY_STORE:
+            for body_format in BODY_FORMATS:
+                del casebody_data[body_format]
+        return casebody_data
 
     def prepare_name(self, instance):
         return instance.redact_obj(instance.name)
@@ -356,7 +365,7 @@ class ResolveDocument(Document):
                 candidate.similarity = 1
             else:
                 distances = [SequenceMatcher(None, n1, n2).ratio()]
-                if self.simhash and candidate.simhash:
+                if self.simhash and candidate.simhash and self.simhash.split(':')[0] == candidate.simhash.split(':')[0]:
                     distances.append(get_distance(self.simhash, candidate.simhash))
                 candidate.similarity = sum(distances)/len(distances)
 
@@ -1,5 +1,6 @@
 from functools import lru_cache
 import operator
+import os
 import six
 import re
 import uuid
@@ -18,12 +19,15 @@ from django.http import QueryDict, HttpRequest
 from elasticsearch_dsl import SF
 from elasticsearch_dsl.query import Q, FunctionScore
 from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
 
 from capapi.resources import parallel_execute
 from capapi.views import api_views
 from capdb import models
+from scripts.cited_by import get_cited_by_index
 from scripts.helpers import alphanum_lower
 from scripts.extract_cites import extract_citations_normalized
+from scripts.simhash import SimhashIndex
 from user_data.models import UserHistory
 
 ### HELPERS ###
@@ -217,6 +221,10 @@ class CaseFilter(SingleCaseFilter):
             ignored. Example: author_type=scalia:dissent.'
     )
     cites_to = filters.CharFilter(label='Cases citing to citation (citation or case id)')
+    similar_to = filters.NumberFilter(label='Cases with text similar to the case with this id')
+    similar_to_distance = filters.NumberFilter(
+        min_value=0, max_value=settings.SIMHASH_MAX_DISTANCE,
+        label=f'Max simhash bits that may differ for similar_to (0 to {settings.SIMHASH_MAX_DISTANCE}; default {settings.SIMHASH_DEFAULT_DISTANCE})')
     facet = filters.CharFilter(label='Facet for which to aggregate results. Can be jurisdiction, \
         decision_date, or a comma-separated permutation of either.')
     ordering = filters.ChoiceFilter(
@@ -312,6 +320,18 @@ class CitesToDynamicFilter(BaseFTSFilter):
         """
         return [f'cites_to__{field}' for field in view.valid_query_fields if not field.startswith('cites_to')]
 
+    @staticmethod
+    def get_cited_ids(cites_to_request):
+        """ Return ids of cases matching the cites_to filters in cites_to_request, up to settings.MAX_JOINED_RESULTS. """
+        init_view = api_views.CaseDocumentViewSet(request=cites_to_request)
+        search = init_view.filter_queryset(init_view.get_queryset()).source(False)
+
+        cites_to_ids = parallel_execute(search, remove_keys=['highlight'])
+
+        if len(cites_to_ids) > settings.MAX_JOINED_RESULTS:
+            raise TooManyJoinedResultsException("Hit too many joined results")
+        return cites_to_ids
+
     def filter_queryset(self, request, queryset, view):
         # ignore empty searches
         search_fields = self.get_search_fields(view, request).copy()
@@ -334,13 +354,26 @@ class CitesToDynamicFilter(BaseFTSFilter):
             first_request.query_params.update(cites_to_keys)
             first_request.GET = first_request.query_params
 
-            init_view = api_views.CaseDocumentViewSet(request=first_request)
-            search = init_view.filter_queryset(init_view.get_queryset()).source(False)
+            # if the cited-by index is built, answer from its postings, picking the cited cases from its columns
+            # where possible rather than searching for them
+            cited_by_index = get_cited_by_index()
+            if cited_by_index is not None:
+                cited_nodes = cited_by_index.select(cites_to_keys)
+                if cited_nodes is None:
+                    cited_ids = self.get_cited_ids(first_request)
+                    cited_nodes = cited_by_index.nodes([int(i) for i in cited_ids])
+                citing_ids = cited_by_index.citing_ids(cited_nodes).tolist()
+                if len(citing_ids) > settings.MAX_CITED_BY_RESULTS:
+                    raise ValidationError({'cites_to': [
+                        'More than %s cases cite the matching cases; add filters to narrow them down.' % settings.MAX_CITED_BY_RESULTS]})
+
+                request.GET._mutable = True
+                _ = [request.GET.pop(key) for key in search_fields if key in request.GET.keys()]
+                request.GET._mutable = False
 
-            cites_to_ids = parallel_execute(search, remove_keys=['highlight'])
+                return queryset.filter('terms', id=citing_ids)
 
-            if len(cites_to_ids) > settings.MAX_JOINED_RESULTS:
-                raise TooManyJoinedResultsException("Hit too many joined results")
+            cites_to_ids = self.get_cited_ids(first_request)
 
             request.GET._mutable = True
             _ = [request.GET.pop(key) for key in search_fields if key in request.GET.keys()]
@@ -358,6 +391,50 @@ class CitesToDynamicFilter(BaseFTSFilter):
         return queryset
 
 
+class SimilarToFilter(BaseFilterBackend):
+    """
+        Filter to cases whose simhash is within similar_to_distance bits of the simhash of the case with id similar_to,
+        using the SimhashIndex written by scripts.simhash.build_simhash_index().
+    """
+    search_param = 'similar_to'
+
+    # per-process cache for get_index()
+    _index_cache = {}
+
+    @classmethod
+    def get_index(cls):
+        """ Return the memory-mapped SimhashIndex, reloaded if the file is replaced, or None if it hasn't been built. """
+        path = settings.SIMHASH_INDEX_PATH
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        file_key = (path, stat.st_ino, stat.st_mtime_ns)
+        if cls._index_cache.get('file_key') != file_key:
+            cls._index_cache.update(file_key=file_key, value=SimhashIndex(path))
+        return cls._index_cache['value']
+
+    def filter_queryset(self, request, queryset, view):
+        case_id = request.query_params.get(self.search_param)
+        if not case_id:
+            return queryset
+        try:
+            case_id = int(case_id)
+            distance = int(request.query_params.get('similar_to_distance', settings.SIMHASH_DEFAULT_DISTANCE))
+        except ValueError:
+            raise ValidationError("similar_to and similar_to_distance must be integers")
+        if not 0 <= distance <= settings.SIMHASH_MAX_DISTANCE:
+            raise ValidationError("similar_to_distance must be between 0 and %s" % settings.SIMHASH_MAX_DISTANCE)
+        index = self.get_index()
+        if index is None:
+            raise ValidationError("Similarity search is not available")
+        similar_ids = [
+            int(doc_id.split('-', 1)[1]) for doc_id, _ in index.query_id(f'cap-{case_id}', distance)
+            if doc_id.startswith('cap-') and doc_id != f'cap-{case_id}'
+        ]
+        return queryset.filter('terms', id=similar_ids)
+
+
 class NestedSimpleStringQueryBackend(NestedQueryBackend):
     """
     Support for SimpleStringQuery and highlighting for nested fields
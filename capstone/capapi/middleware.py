@@ -50,6 +50,43 @@ def add_no_cache_header(response):
     patch_cache_control(response, s_maxage=0, max_age=0)
 
 
+def cacheability_tests(request, response):
+    """
+        Return {test name: passed} for each test a response must pass to be cached. Also used by
+        capapi.response_cache.
+    """
+    # To cache this response, all of these must be true:
+    # - Response status code is 200 (we're conservative here for now)
+    # - The user is undefined or anonymous or has not accessed any user-specific attributes.
+    # - The request method is GET, HEAD, or OPTIONS.
+    # - The Cache-Control header was not already set.
+    #   (Setting that header happens when Django is trying to protect something.)
+    # - CSRF protection is not being used for this view.
+    # - No cookies are set by this view.
+    view_tests = {
+        'response_status': response.status_code == 200,
+        'user_safe': (
+            (
+                # if user failed to authenticate, we can only cache if they
+                # didn't supply a bad sessionid cookie or authorization header
+                'HTTP_AUTHORIZATION' not in request.META
+                and settings.SESSION_COOKIE_NAME not in request.COOKIES
+            ) if (not hasattr(request, 'user') or request.user.is_anonymous) else (
+                # if user successfully authenticated, we can only cache if we
+                # didn't access any user-specific data in preparing this view
+                hasattr(request.user, '_self_accessed_attrs')
+                and not (request.user._self_accessed_attrs - _capuser_cache_safe_attributes)
+            )
+        ),
+        'method': request.method in ('GET', 'HEAD', 'OPTIONS'),
+        'cache_header_not_set': not response.has_header("Cache-Control"),
+        'csrf_cookie_not_used': not request.META.get("CSRF_COOKIE_USED"),
+        'cookie_header_not_set': not response.has_header("Set-Cookie"),
+        'session_safe': not request.session.modified,
+    }
+    return view_tests
+
+
 def cache_header_middleware(get_response):
     """
         Set an outgoing "Cache-Control: s-maxage=<settings.CDN_CACHE_LENGTH>, max-age=<settings.BROWSER_CACHE_LENGTH>" header on all requests
@@ -74,35 +111,7 @@ def cache_header_middleware(get_response):
         if response.has_header("Cache-Control") and 's-maxage' in response['cache-control'].lower():
             return response
 
-        # To cache this response, all of these must be true:
-        # - Response status code is 200 (we're conservative here for now)
-        # - The user is undefined or anonymous or has not accessed any user-specific attributes.
-        # - The request method is GET, HEAD, or OPTIONS.
-        # - The Cache-Control header was not already set.
-        #   (Setting that header happens when Django is trying to protect something.)
-        # - CSRF protection is not being used for this view.
-        # - No cookies are set by this view.
-        view_tests = {
-            'response_status': response.status_code == 200,
-            'user_safe': (
-                (
-                    # if user failed to authenticate, we can only cache if they
-                    # didn't supply a bad sessionid cookie or authorization header
-                    'HTTP_AUTHORIZATION' not in request.META
-                    and settings.SESSION_COOKIE_NAME not in request.COOKIES
-                ) if (not hasattr(request, 'user') or request.user.is_anonymous) else (
-                    # if user successfully authenticated, we can only cache if we
-                    # didn't access any user-specific data in preparing this view
-                    hasattr(request.user, '_self_accessed_attrs')
-                    and not (request.user._self_accessed_attrs - _capuser_cache_safe_attributes)
-                )
-            ),
-            'method': request.method in ('GET', 'HEAD', 'OPTIONS'),
-            'cache_header_not_set': not response.has_header("Cache-Control"),
-            'csrf_cookie_not_used': not request.META.get("CSRF_COOKIE_USED"),
-            'cookie_header_not_set': not response.has_header("Set-Cookie"),
-            'session_safe': not request.session.modified,
-        }
+        view_tests = cacheability_tests(request, response)
 
         # If all tests pass, we can set the Cache-Control header
         cache_response = all(view_tests.values())
@@ -330,3 +330,28 @@ class CapESCursorPagination(ESCursorPagination):
         if request.query_params.get(self.cursor_query_param) and request.query_params.get('ordering') == 'random':
             raise serializers.ValidationError({'cursor': ['Pagination is not currently supported with random ordering. For a larger random sample, consider increasing page_size.']})
         return super().decode_cursor(request)
+
+    def iterate_queryset(self, queryset, batch_size):
+        """
+            Yield lists of hits for every result of queryset, in order, in batches of up to batch_size. Like
+            _paginate_queryset(), this pages with search_after on a sort ending in fallback_sort_field, but facets and
+            total hit counts are skipped. Invalid queries raise ValidationError, as in paginate_queryset().
+        """
+        if not any(k == self.fallback_sort_field or self.fallback_sort_field in k.keys() for k in queryset._sort):
+            queryset = queryset.sort(*(queryset._sort + [self.fallback_sort_field]))
+        queryset = queryset.extra(track_total_hits=False)
+        queryset.aggs._params = {'aggs': {}}
+        search_after = None
+        while True:
+            page = queryset.extra(search_after=search_after) if search_after else queryset
+            try:
+                hits = page[:batch_size].execute()['hits']['hits']
+            except TransportError as e:
+                if e.error == 'search_phase_execution_exception':
+                    raise serializers.ValidationError({'error': ['Invalid query parameters']})
+                raise
+            if hits:
+                yield hits
+            if len(hits) < batch_size:
+                return
+            search_after = hits[-1]['sort']
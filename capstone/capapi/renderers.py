@@ -1,12 +1,17 @@
+import csv
 import hashlib
 import json
+import re
+from io import StringIO
 
+import orjson
 import pandas
 from flatten_json import flatten
 
 from django.conf import settings
 from django.http.response import HttpResponseBase, HttpResponse
 from rest_framework import renderers
+from rest_framework.utils.encoders import JSONEncoder
 
 from capweb.helpers import cache_func
 
@@ -66,6 +71,44 @@ class NgramBrowsableAPIRenderer(BrowsableAPIRenderer):
         return super().get_filter_form([], view, request)
 
 
+class FastJSONRenderer(renderers.JSONRenderer):
+    """
+        JSONRenderer that encodes with orjson, producing the same bytes as the stock renderer, except that NaN and
+        infinity are rendered as null rather than raising an error. Falls back to the stock renderer for indented or
+        ascii-only output, and for anything orjson can't encode.
+    """
+    # orjson writes some floats differently from json.dumps, like 1e-7 for 1e-07 and 0.000025 for 2.5e-05
+    float_re = re.compile(rb'[0-9]e|0\.0000')
+    token_re = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|-?[0-9][0-9.e+-]*')
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None or self.ensure_ascii or not self.compact or \
+                self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            # types json.dumps doesn't handle natively are passed to the stock encoder, as they would be by json.dumps
+            ret = orjson.dumps(data, default=self.encoder_class().default,
+                               option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        if self.float_re.search(ret):
+            ret = self.token_re.sub(self.fix_float, ret)
+        # like the stock renderer, escape characters that are valid in JSON but not in javascript
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+
+    @staticmethod
+    def fix_float(match):
+        """
+            Rewrite a float token as json.dumps would.
+            >>> FastJSONRenderer.token_re.sub(FastJSONRenderer.fix_float, b'["1e-7",1e-7,2,0.000025,1e16,-1.5]')
+            b'["1e-7",1e-07,2,2.5e-05,1e+16,-1.5]'
+        """
+        token = match.group()
+        if token[0] == ord('"') or not any(c in token for c in b'.e'):
+            return token
+        return repr(float(token)).encode()
+
+
 class PassthroughRenderer(renderers.JSONRenderer):
     """
         Return data as-is. View should supply a Response.
@@ -95,8 +138,40 @@ class CSVRenderer(renderers.JSONRenderer):
 
     def render(self, data, accepted_media_type=None, renderer_context=None):
         if 'results' in data:
-            flattened_data = [flatten(case, '.', root_keys_to_ignore={'cites_to'}) for case in data['results']]
+            flattened_data = [flatten_result(case) for case in data['results']]
             json_normalize = pandas.json_normalize(flattened_data)
         else:
-            json_normalize = pandas.json_normalize(flatten(data, '.', root_keys_to_ignore={'cites_to'}))
+            json_normalize = pandas.json_normalize(flatten_result(data))
         return json_normalize.to_csv(index=False)
+
+
+def flatten_result(result):
+    """ Flatten a serialized result to {'dotted.key': value}, as for CSV columns. """
+    return flatten(result, '.', root_keys_to_ignore={'cites_to'})
+
+
+### streaming renderers: these take an iterable of lists of serialized results, and yield chunks of text ###
+
+def stream_ndjson(batches):
+    """ Yield each result as a line of JSON. """
+    for batch in batches:
+        yield ''.join(json.dumps(result, cls=JSONEncoder, ensure_ascii=False) + '\n' for result in batch)
+
+
+def stream_csv(batches):
+    """
+        Yield results as CSV rows, flattened like CSVRenderer. Because the header has to be written first, columns
+        are the flattened keys of the first batch; keys that only appear in later batches are left out.
+    """
+    buffer = StringIO()
+    writer = None
+    for batch in batches:
+        rows = [flatten_result(result) for result in batch]
+        if writer is None:
+            fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+            writer = csv.DictWriter(buffer, fieldnames, extrasaction='ignore')
+            writer.writeheader()
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
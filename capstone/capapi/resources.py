@@ -1,5 +1,8 @@
 import hashlib
 import concurrent.futures
+import os
+import threading
+import time
 from copy import copy
 from functools import reduce
 
@@ -196,29 +199,65 @@ def remove_nested_keys(target_dict, keys):
                     remove_nested_keys(item, keys)
 
 
-def run_search(search_blob):
+# client and thread pool shared by parallel_execute() calls in this process, set by get_parallel_search_pool()
+_parallel_search_state = {}
+_parallel_search_lock = threading.Lock()
+
+
+def get_parallel_search_pool():
+    """
+        Return (client, executor) for parallel_execute(): a long-lived Elasticsearch client whose connection pool keeps
+        a connection open for each of settings.PARALLEL_SEARCH_THREADS, and a thread pool of that size. Both are
+        created on first use in each process, so a forked worker doesn't share its parent's sockets.
+    """
+    with _parallel_search_lock:
+        if _parallel_search_state.get('pid') != os.getpid():
+            threads = settings.PARALLEL_SEARCH_THREADS
+            _parallel_search_state.update(
+                pid=os.getpid(),
+                client=Elasticsearch(**{'maxsize': threads, **settings.ELASTICSEARCH_DSL['default']}),
+                executor=concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix='parallel_search'),
+            )
+        return _parallel_search_state['client'], _parallel_search_state['executor']
+
+
+def run_search(es, search_blob):
+    """ Run one slice of a parallel_execute() search. Return (worker_i, hit ids, seconds, elasticsearch took ms). """
+    start = time.monotonic()
     # get elasticsearch query as a dictionary
     if search_blob['remove_keys']:
         remove_nested_keys(search_blob['query_body'], search_blob['remove_keys'])
 
-    es = Elasticsearch(**settings.ELASTICSEARCH_DSL['default'])
-    resp = es.search(index=search_blob['index'], body=search_blob['query_body'])
+    resp = es.search(
+        index=search_blob['index'],
+        body=search_blob['query_body'],
+        request_timeout=settings.PARALLEL_SEARCH_TIMEOUT)
     hits = deep_get(resp, ['hits', 'hits'])
-    es.close()
-    return search_blob['worker_i'], [hit['_id'] for hit in hits]
+    return search_blob['worker_i'], [hit['_id'] for hit in hits], time.monotonic() - start, resp.get('took')
+
 
+def parallel_execute_searches(searches):
+    start = time.monotonic()
+    es, executor = get_parallel_search_pool()
+    futures = [executor.submit(run_search, es, search) for search in searches]
+    try:
+        results = [future.result() for future in futures]
+    finally:
+        # if a search failed, don't wait on the rest
+        for future in futures:
+            future.cancel()
 
-def parallel_execute_searches(searches, workers):
-    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
-        results = executor.map(run_search, searches)
+    logger.info("parallel_execute: %s searches in %.3fs; slowest slice %.3fs, slowest elasticsearch took %sms" % (
+        len(results), time.monotonic() - start, max(r[2] for r in results), max(r[3] or 0 for r in results)))
 
-        # get flat results in order
-        flat_results = [i for _, worker_results in sorted(results) for i in worker_results]
-        return flat_results
+    # get flat results in order
+    flat_results = [i for _, worker_results, _, _ in sorted(results, key=lambda r: r[0]) for i in worker_results]
+    return flat_results
 
 def parallel_execute(search, workers=20, desired_docs=20000, remove_keys=None):
     """
-    Execute an elasticsearch-dsl Search object in parallel. Example:
+    Execute an elasticsearch-dsl Search object in parallel, as `workers` searches over slices of analysis.random_bucket,
+    run concurrently by the shared client and thread pool from get_parallel_search_pool(). Example:
 
         results = parallel_execute(CaseDocument.search().filter(...).sort(...), remove_keys=['highlight'])
 
@@ -248,7 +287,7 @@ def parallel_execute(search, workers=20, desired_docs=20000, remove_keys=None):
     buckets_per_worker = int(needed_buckets / workers)
 
     tasks = [get_next_search_dict(search, i) for i in range(0, workers)]
-    return parallel_execute_searches(tasks, workers)
+    return parallel_execute_searches(tasks)
 
 
 def api_request(request, viewset, method, url_kwargs={}, get_params={}):
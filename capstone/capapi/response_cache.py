@@ -0,0 +1,136 @@
+"""
+    Opt-in cache of rendered API responses for anonymous requests, stored in redis when settings.API_RESPONSE_CACHE
+    is set. Apply @cache_response() to a viewset action to serve identical requests from the cache:
+
+        response_cache:<sha256 of host, path, url kwargs, media type and query params>
+            msgpack [watermark, content type, body]
+        response_cache:watermark
+            incremented by advance_response_cache_watermark() whenever the data behind the cached views changes
+
+    An entry is only served while its watermark matches the current one, so advancing the watermark invalidates
+    every cached response at once; stale entries are overwritten or expire after settings.API_RESPONSE_CACHE_TIMEOUT.
+
+    Only requests without a session cookie or authorization header are looked up, and a response is only stored if
+    cache_header_middleware would let a CDN cache it, which rules out responses that accessed user-specific
+    attributes (see TrackingWrapper), set cookies, used csrf, or set their own Cache-Control header.
+"""
+import hashlib
+import json
+from functools import wraps
+
+import msgpack
+from django.conf import settings
+from rest_framework.response import Response
+
+from capapi.middleware import cacheability_tests
+from capdb import storages
+
+
+WATERMARK_KEY = 'response_cache:watermark'
+
+# query params that don't change the response body beyond the media type, which is part of the key anyway
+IGNORED_PARAMS = {'format'}
+
+
+class CachedResponse(Response):
+    """ Response replayed from the response cache, which renders the stored body instead of data. """
+    def __init__(self, body, content_type):
+        self.cached_body = body
+        super().__init__(content_type=content_type)
+
+    @property
+    def rendered_content(self):
+        self['Content-Type'] = self.content_type
+        return self.cached_body
+
+    @property
+    def data(self):
+        """ Parse the stored body for callers that use the data directly, like api_request(). """
+        return json.loads(self.cached_body)
+
+    @data.setter
+    def data(self, value):
+        # Response.__init__() sets data to None
+        pass
+
+
+def normalize_params(query_params):
+    """
+        Return query params in a canonical order, so requests that differ only in param order share a cache key.
+
+        >>> from django.http import QueryDict
+        >>> normalize_params(QueryDict('b=2&format=json&b=3&a=1'))
+        [('a', ['1']), ('b', ['2', '3'])]
+    """
+    return sorted((k, v) for k, v in query_params.lists() if k not in IGNORED_PARAMS)
+
+
+def response_cache_key(request, url_kwargs):
+    """ Return the cache key for request to a viewset action with url_kwargs, or None if it shouldn't use the cache. """
+    if not settings.API_RESPONSE_CACHE or request.method not in ('GET', 'HEAD'):
+        return None
+    # like cache_header_middleware, only treat requests without credentials as anonymous
+    if 'HTTP_AUTHORIZATION' in request.META or settings.SESSION_COOKIE_NAME in request.COOKIES:
+        return None
+    # rendered html includes per-request things like csrf tokens, so only json is cached
+    if request.accepted_renderer.format != 'json':
+        return None
+    key = json.dumps([
+        request.get_host(),
+        request.path,
+        sorted(url_kwargs.items()),
+        request.accepted_media_type,
+        normalize_params(request.query_params),
+    ])
+    return 'response_cache:' + hashlib.sha256(key.encode('utf8')).hexdigest()
+
+
+def get_cached_response(key):
+    """ Return (CachedResponse or None, current watermark) for key. """
+    watermark, entry = storages.redis_client.mget([WATERMARK_KEY, key])
+    watermark = int(watermark or 0)
+    if entry:
+        entry_watermark, content_type, body = msgpack.unpackb(entry, raw=False)
+        if entry_watermark == watermark:
+            return CachedResponse(body, content_type), watermark
+    return None, watermark
+
+
+def store_response(request, key, watermark):
+    """
+        Return a post-render callback that stores the rendered response under key, with the watermark read before
+        the response was generated, if it's cacheable.
+    """
+    def callback(response):
+        if len(response.content) > settings.API_RESPONSE_CACHE_MAX_BYTES:
+            return
+        if not all(cacheability_tests(request, response).values()):
+            return
+        entry = msgpack.packb([watermark, response['Content-Type'], response.content], use_bin_type=True)
+        storages.redis_client.set(key, entry, ex=settings.API_RESPONSE_CACHE_TIMEOUT)
+    return callback
+
+
+def cache_response(unless=None):
+    """ Decorator to serve a viewset action from the response cache, except for requests where unless(request) is true. """
+    def decorator(action):
+        @wraps(action)
+        def wrapper(self, request, *args, **kwargs):
+            key = None if unless and unless(request) else response_cache_key(request, kwargs)
+            if key is None:
+                return action(self, request, *args, **kwargs)
+            response, watermark = get_cached_response(key)
+            if response is not None:
+                return response
+            response = action(self, request, *args, **kwargs)
+            # only responses that are rendered, as opposed to used directly by api_request(), are stored
+            if isinstance(response, Response):
+                response.add_post_render_callback(store_response(request._request, key, watermark))
+            return response
+        return wrapper
+    return decorator
+
+
+def advance_response_cache_watermark():
+    """ Invalidate all cached responses. Call after changing the data behind the cached views. """
+    storages.redis_client.incr(WATERMARK_KEY)
@@ -1,6 +1,7 @@
 from collections import defaultdict
 from functools import reduce
 
+from django.conf import settings
 from django.db import transaction
 from django_elasticsearch_dsl_drf.utils import DictionaryProxy
 from rest_framework import serializers
@@ -8,10 +9,12 @@ from rest_framework.reverse import reverse as api_reverse
 from rest_framework.serializers import ListSerializer
 from django_elasticsearch_dsl_drf.serializers import DocumentSerializer
 
+from .case_allowance import start_case_allowance_window, take_case_allowance
 from .models import SiteLimits
 from .documents import CaseDocument, ResolveDocument
 from capdb import models
 from capweb.helpers import reverse
+from scripts.body_store import get_bodies
 from user_data.models import UserHistory
 
 
@@ -101,6 +104,12 @@ class BaseDocumentSerializer(DocumentSerializer):
             return instance
 
 
+def as_dict(obj):
+    if type(obj) == dict:
+        return obj
+    return obj._d_
+
+
 class CaseDocumentSerializer(BaseDocumentSerializer):
     class Meta:
         document = CaseDocument
@@ -139,10 +148,7 @@ class CaseDocumentSerializer(BaseDocumentSerializer):
 
         return preview_source + preview_inner
 
-    def to_representation(self, instance):
-        """
-        Convert ES result to output dictionary for the API.
-        """
+    def get_url_templates(self):
         # cache url templates to avoid lookups for each object serialized
         if not self._url_templates:
 
@@ -159,59 +165,59 @@ class CaseDocumentSerializer(BaseDocumentSerializer):
                 "court_url": placeholder_url("court-detail"),
                 "jurisdiction_url": placeholder_url("jurisdiction-detail"),
             }
+        return self._url_templates
 
-        def as_dict(obj):
-            if type(obj) == dict:
-                return obj
-            return obj._d_
+    def to_representation(self, instance):
+        """
+        Convert ES result to output dictionary for the API.
+        """
+        return self.serialize_case(instance)[0]
 
+    def serialize_case(self, instance):
+        """
+        Convert ES result to output dictionary for the API, in a single pass over the opinions, without modifying the
+        ES result. Returns the output dictionary, and casebody_data.text as shown to users, with head_matter moved
+        out of the opinions and extracted_citations stripped.
+        """
+        url_templates = self.get_url_templates()
         s = self.s_from_instance(instance)
 
-        # get extracted_citations list, removing duplicate c["cite"] values
+        # collect extracted_citations, and build opinions without them or the first head_matter
+        text = as_dict(s["casebody_data"]["text"])
         extracted_citations = []
-        ec = [
-            o["extracted_citations"]
-            for o in s["casebody_data"]["text"]["opinions"]
-            if "extracted_citations" in o
-        ]
-        ec = [item for sublist in ec for item in sublist]
-        for c in ec:
-            c = as_dict(c)
-            extracted_cite = {
-                "cite": c["cite"],
-                "category": c.get("category"),
-                "reporter": c.get("reporter"),
-            }
-            if c.get("target_cases"):
-                extracted_cite["case_ids"] = c["target_cases"]
-            if int(c.get("weight", 1)) > 1:
-                extracted_cite["weight"] = int(c["weight"])
-            if c.get("year"):
-                extracted_cite["year"] = c["year"]
-            if c.get("pin_cites"):
-                extracted_cite["pin_cites"] = c["pin_cites"]
-            if isinstance(c.get("opinion_id"), int):
-                extracted_cite["opinion_id"] = c["opinion_id"] - 1
-            extracted_citations.append(extracted_cite)
+        opinions = []
+        head_matter = None
+        for opinion in text["opinions"]:
+            opinion = as_dict(opinion)
+            if "extracted_citations" in opinion:
+                for c in opinion["extracted_citations"]:
+                    c = as_dict(c)
+                    extracted_cite = {
+                        "cite": c["cite"],
+                        "category": c.get("category"),
+                        "reporter": c.get("reporter"),
+                    }
+                    if c.get("target_cases"):
+                        extracted_cite["case_ids"] = c["target_cases"]
+                    if int(c.get("weight", 1)) > 1:
+                        extracted_cite["weight"] = int(c["weight"])
+                    if c.get("year"):
+                        extracted_cite["year"] = c["year"]
+                    if c.get("pin_cites"):
+                        extracted_cite["pin_cites"] = c["pin_cites"]
+                    if isinstance(c.get("opinion_id"), int):
+                        extracted_cite["opinion_id"] = c["opinion_id"] - 1
+                    extracted_citations.append(extracted_cite)
+                opinion = {k: v for k, v in opinion.items() if k != "extracted_citations"}
+            if head_matter is None and opinion["type"] == "head_matter":
+                head_matter = opinion
+            else:
+                opinions.append(opinion)
 
         # move head_matter outside of casebody_data
-        head_matter = list(
-            filter(
-                lambda x: x["type"] == "head_matter",
-                s["casebody_data"]["text"]["opinions"],
-            )
-        )
-        head_matter = head_matter[0] if head_matter else []
-        if head_matter:
-            s["casebody_data"]["text"]["opinions"].remove(head_matter)
-
-        if "text" in head_matter:
-            s["casebody_data"]["text"]["head_matter"] = head_matter["text"]
-
-        # strip citations from casebody data
-        for i, element in enumerate(s["casebody_data"]["text"]["opinions"]):
-            if "extracted_citations" in element:
-                del s["casebody_data"]["text"]["opinions"][i]["extracted_citations"]
+        text = {**text, "opinions": opinions}
+        if head_matter and "text" in head_matter:
+            text["head_matter"] = head_matter["text"]
 
         preview = self.get_preview(instance)
 
@@ -219,7 +225,7 @@ class CaseDocumentSerializer(BaseDocumentSerializer):
         # section in set_up_postgres.py to keep Elasticsearch updated.
         return {
             "id": s["id"],
-            "url": self._url_templates["case_url"] % s["id"],
+            "url": url_templates["case_url"] % s["id"],
             "name": s["name"],
             "name_abbreviation": s["name_abbreviation"],
             "decision_date": s["decision_date_original"],
@@ -230,17 +236,17 @@ class CaseDocumentSerializer(BaseDocumentSerializer):
                 {"type": c["type"], "cite": c["cite"]} for c in s["citations"]
             ],
             "volume": {
-                "url": self._url_templates["volume_url"] % s["volume"]["barcode"],
+                "url": url_templates["volume_url"] % s["volume"]["barcode"],
                 "volume_number": s["volume"]["volume_number"],
                 "barcode": s["volume"]["barcode"],
             },
             "reporter": {
-                "url": self._url_templates["reporter_url"] % s["reporter"]["id"],
+                "url": url_templates["reporter_url"] % s["reporter"]["id"],
                 "full_name": s["reporter"]["full_name"],
                 "id": s["reporter"]["id"],
             },
             "court": {
-                "url": self._url_templates["court_url"] % s["court"]["slug"],
+                "url": url_templates["court_url"] % s["court"]["slug"],
                 "name_abbreviation": s["court"]["name_abbreviation"],
                 "slug": s["court"]["slug"],
                 "id": s["court"]["id"],
@@ -249,15 +255,15 @@ class CaseDocumentSerializer(BaseDocumentSerializer):
             "jurisdiction": {
                 "id": s["jurisdiction"]["id"],
                 "name_long": s["jurisdiction"]["name_long"],
-                "url": self._url_templates["jurisdiction_url"]
+                "url": url_templates["jurisdiction_url"]
                 % s["jurisdiction"]["slug"],
                 "slug": s["jurisdiction"]["slug"],
                 "whitelisted": s["jurisdiction"]["whitelisted"],
                 "name": s["jurisdiction"]["name"],
             },
             "cites_to": extracted_citations,
-            "frontend_url": self._url_templates["frontend_url"] % s["frontend_url"],
-            "frontend_pdf_url": self._url_templates["frontend_pdf_url"]
+            "frontend_url": url_templates["frontend_url"] % s["frontend_url"],
+            "frontend_pdf_url": url_templates["frontend_pdf_url"]
             % s["frontend_pdf_url"]
             if s["frontend_pdf_url"]
             else None,
@@ -265,7 +271,7 @@ class CaseDocumentSerializer(BaseDocumentSerializer):
             "analysis": s.get("analysis", {}),
             "last_updated": s["last_updated"] or s["provenance"]["date_added"],
             "provenance": s["provenance"],
-        }
+        }, text
 
 
 class ResolveDocumentListSerializer(ListSerializer):
@@ -308,8 +314,12 @@ class CaseAllowanceMixin:
 
         if user.is_anonymous:
             # logged out users won't get any restricted case bodies, so nothing to update
+            self.prefetch_bodies()
             return super().data
 
+        if settings.API_CASE_ALLOWANCE_COUNTERS == "redis":
+            return self.data_with_allowance_counters(user)
+
         # set request.site_limits so it can be checked later in check_update_case_permissions()
         request.site_limits = SiteLimits.get()
 
@@ -347,6 +357,16 @@ class CaseAllowanceMixin:
                 )
                 self.context["allowed_case_ids"] = allowed_case_ids
 
+            # restricted bodies are only fetched for cases the user has already accessed, or that fit in the
+            # remaining allowance in the order to_representation() will grant them
+            granted_ids = set(self.context.get("allowed_case_ids", ()))
+            if request.site_limits.daily_downloads < request.site_limits.daily_download_limit:
+                new_ids = [i for i in self.get_restricted_ids() if i not in granted_ids]
+                if not user.unlimited_access_in_effect():
+                    new_ids = new_ids[:max(user.case_allowance_remaining, 0)]
+                granted_ids.update(new_ids)
+            self.prefetch_bodies(granted_ids)
+
             result = super().data
 
             # store history
@@ -376,6 +396,81 @@ class CaseAllowanceMixin:
 
         return result
 
+    def data_with_allowance_counters(self, user):
+        """
+            Version of data for settings.API_CASE_ALLOWANCE_COUNTERS == 'redis'. Instead of locking the user and
+            SiteLimits rows, restricted cases are counted against atomic redis counters in one step before
+            serializing, and to_representation() reads each case's status from context["case_statuses"]. Counts are
+            written back to the database by capapi.tasks.reconcile_case_allowances.
+        """
+        if not user.unlimited_access_in_effect():
+            start_case_allowance_window(user)
+
+        restricted_ids = self.get_restricted_ids()
+
+        # restricted cases in our results that this user has already accessed don't count against the allowance
+        allowed_case_ids = set()
+        if user.has_tracked_history and restricted_ids:
+            allowed_case_ids = set(
+                UserHistory.objects.filter(case_id__in=restricted_ids, user_id=user.id)
+                .values_list("case_id", flat=True)
+                .distinct()
+            )
+        self.context["allowed_case_ids"] = allowed_case_ids
+        self.context["case_statuses"] = take_case_allowance(
+            user, [i for i in restricted_ids if i not in allowed_case_ids])
+        self.prefetch_bodies(allowed_case_ids | {
+            i for i, status in self.context["case_statuses"].items() if status == "ok"})
+
+        result = super().data
+
+        # store history
+        if user.track_history:
+            cases = result if hasattr(self, "many") else [result]
+            to_create = [
+                UserHistory(user_id=user.id, case_id=c["id"])
+                for c in cases
+                if c["casebody"]["status"] == "ok"
+            ]
+            if to_create:
+                UserHistory.objects.bulk_create(to_create)
+                if not user.has_tracked_history:
+                    user.has_tracked_history = True
+                    user.save(update_fields=["has_tracked_history"])
+
+        return result
+
+    def get_restricted_ids(self):
+        """ Return distinct ids of restricted cases being serialized, in order. """
+        serializer = self.child if hasattr(self, "many") else self
+        instances = self.instance if hasattr(self, "many") else [self.instance]
+        restricted_ids = []
+        for instance in instances:
+            s = serializer.s_from_instance(instance)
+            if s["restricted"] and s["id"] not in restricted_ids:
+                restricted_ids.append(s["id"])
+        return restricted_ids
+
+    def prefetch_bodies(self, granted_ids=()):
+        """
+            If the requested body format is kept outside of elasticsearch (see settings.ELASTICSEARCH_BODY_STORE),
+            fetch it in one batch for use by to_representation(), for unrestricted cases and the restricted cases in
+            granted_ids. Bodies of other restricted cases won't be sent, so they aren't fetched.
+        """
+        serializer = self.child if hasattr(self, "many") else self
+        instances = self.instance if hasattr(self, "many") else [self.instance]
+        body_format = serializer.get_body_format()
+        refs_by_id = {}
+        for instance in instances:
+            s = serializer.s_from_instance(instance)
+            if s["restricted"] and s["id"] not in granted_ids:
+                continue
+            casebody_data = s.get("casebody_data", {})
+            if body_format not in casebody_data and "body_ref" in casebody_data:
+                refs_by_id[s["id"]] = casebody_data["body_ref"]
+        if refs_by_id:
+            self.context["bodies"] = get_bodies(refs_by_id, body_format)
+
 
 class ListSerializerWithCaseAllowance(CaseAllowanceMixin, ListSerializer):
     """Custom ListSerializer for CaseDocumentSerializerWithCasebody that enforces CaseAllowance."""
@@ -389,7 +484,7 @@ class CaseDocumentSerializerWithCasebody(CaseAllowanceMixin, CaseDocumentSeriali
         list_serializer_class = ListSerializerWithCaseAllowance
 
     def to_representation(self, instance, check_permissions=True):
-        case = super().to_representation(instance)
+        case, text = self.serialize_case(instance)
         request = self.context.get("request")
         s = self.s_from_instance(instance)
 
@@ -405,6 +500,9 @@ class CaseDocumentSerializerWithCasebody(CaseAllowanceMixin, CaseDocumentSeriali
             and case["id"] in self.context["allowed_case_ids"]
         ):
             status = "ok"
+        elif "case_statuses" in self.context:
+            # allowance already taken by data_with_allowance_counters()
+            status = self.context["case_statuses"][case["id"]]
         elif (
             request.site_limits.daily_downloads
             >= request.site_limits.daily_download_limit
@@ -420,16 +518,29 @@ class CaseDocumentSerializerWithCasebody(CaseAllowanceMixin, CaseDocumentSeriali
         # render case
         data = None
         if status == "ok":
-            body_format = self.context.get(
-                "force_body_format"
-            ) or request.query_params.get("body_format")
-            if body_format not in ("html", "xml"):
-                body_format = "text"
-            data = s["casebody_data"][body_format]
+            body_format = self.get_body_format()
+            if body_format == "text":
+                data = text
+            elif body_format in s["casebody_data"]:
+                data = s["casebody_data"][body_format]
+            else:
+                # body is kept outside of elasticsearch -- use the batch fetched by prefetch_bodies() if possible
+                bodies = self.context.get("bodies", {})
+                if case["id"] not in bodies:
+                    bodies = get_bodies({case["id"]: s["casebody_data"].get("body_ref")}, body_format)
+                data = bodies.get(case["id"])
 
         case["casebody"] = {"status": status, "data": data}
         return case
 
+    def get_body_format(self):
+        body_format = self.context.get(
+            "force_body_format"
+        ) or self.context.get("request").query_params.get("body_format")
+        if body_format not in ("html", "xml"):
+            body_format = "text"
+        return body_format
+
 
 class VolumeSerializer(serializers.ModelSerializer):
     jurisdictions = JurisdictionSerializer(source="reporter.jurisdictions", many=True)
@@ -15,6 +15,8 @@ from capweb.helpers import statement_timeout, StatementTimeout
 def daily_site_limit_reset_and_report():
     from capapi.models import SiteLimits, CapUser  # import here to avoid circular import
 
+    # include downloads still counted in redis
+    reconcile_case_allowances()
     site_limits = SiteLimits.get()
 
     # send admin email
@@ -51,6 +53,14 @@ User emails:
     except KeyError:
         pass
 
+@shared_task
+def reconcile_case_allowances():
+    """ Write case downloads counted in redis back to the database, if settings.API_CASE_ALLOWANCE_COUNTERS is 'redis'. """
+    from capapi import case_allowance  # import here to avoid circular import
+
+    if settings.API_CASE_ALLOWANCE_COUNTERS == 'redis':
+        case_allowance.reconcile_case_allowances()
+
 @shared_task
 def cache_query_count(sql, cache_key):
     """ Cache the result of a count() sql query, because it didn't return quickly enough the first time. """
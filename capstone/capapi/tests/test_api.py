@@ -1,13 +1,20 @@
+import json
 from csv import DictReader
 from io import StringIO
 
+import mock
+from elasticsearch import TransportError
 from flaky import flaky
 from rest_framework.request import Request
 from rest_framework.test import APIRequestFactory
 
+import fabfile
 from capapi import api_reverse
+from capapi.documents import CaseDocument
 from capapi.views import api_views
 from capdb.tasks import update_elasticsearch_from_queue
+from scripts.body_store import get_bodies
+from scripts.cited_by import get_cited_by_index
 from test_data.test_fixtures.factories import *
 from capapi.tests.helpers import check_response
 from user_data.models import UserHistory
@@ -195,6 +202,44 @@ def test_csv(transactional_db, client, auth_client, restricted_case, unrestricte
     check_response(response, status_code=400, content_type="text/plain", content_includes="Select a valid choice")
 
 
+@pytest.mark.django_db(databases=['default', 'capdb', 'user_data'])
+def test_stream(auth_user, auth_client, client, restricted_case, unrestricted_case, unrestricted_case_factory, elasticsearch, settings):
+    """ Test ?stream=ndjson and ?stream=csv on case list API. """
+    cases = [restricted_case, unrestricted_case] + [unrestricted_case_factory() for _ in range(3)]
+    settings.STREAM_BATCH_SIZE = 2
+    list_url = api_reverse("cases-list")
+
+    # every case is streamed, across several batches, and restricted bodies count against the case allowance once
+    response = auth_client.get(list_url, {"stream": "ndjson", "full_case": "true", "ordering": "-decision_date"})
+    check_response(response, content_type="application/x-ndjson")
+    results = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+    assert sorted(r['id'] for r in results) == sorted(c.id for c in cases)
+    assert [r['decision_date'] for r in results] == sorted((r['decision_date'] for r in results), reverse=True)
+    assert all(r['casebody']['status'] == 'ok' for r in results)
+    auth_user.refresh_from_db()
+    assert auth_user.case_allowance_remaining == auth_user.total_case_allowance - 1
+
+    # anonymous users get results without restricted bodies
+    response = client.get(list_url, {"stream": "ndjson", "full_case": "true"})
+    results = {r['id']: r for r in map(json.loads, b''.join(response.streaming_content).decode().splitlines())}
+    assert results[restricted_case.id]['casebody']['status'] == 'error_auth_required'
+    assert results[unrestricted_case.id]['casebody']['status'] == 'ok'
+
+    # csv
+    response = auth_client.get(list_url, {"stream": "csv"})
+    check_response(response, content_type="text/csv")
+    rows = DictReader(StringIO(b''.join(response.streaming_content).decode()))
+    assert sorted(row['name_abbreviation'] for row in rows) == sorted(c.name_abbreviation for c in cases)
+
+    # invalid params
+    check_response(auth_client.get(list_url, {"stream": "xml"}), status_code=400, content_includes="stream")
+    check_response(auth_client.get(list_url, {"stream": "csv", "ordering": "random"}), status_code=400, content_includes="stream")
+
+    # search errors are reported before the stream starts
+    with mock.patch('capapi.documents.RawSearch.execute', side_effect=TransportError(400, 'search_phase_execution_exception')):
+        check_response(auth_client.get(list_url, {"stream": "ndjson"}), status_code=400, content_includes="Invalid query parameters")
+
+
 @pytest.mark.django_db(databases=['default', 'capdb', 'user_data'])
 def test_track_history(auth_user, auth_client, restricted_case, elasticsearch):
     # initial fetch
@@ -418,6 +463,33 @@ def test_body_format_html(auth_client, restricted_case, elasticsearch):
     assert restricted_case.body_cache.html in data
 
 
+@pytest.mark.django_db(databases=['default', 'capdb', 'user_data'])
+@pytest.mark.parametrize("body_store", ["postgres", "file"])
+def test_body_store(client, auth_client, restricted_case, case_factory, elasticsearch, settings, tmp_path, body_store):
+    settings.ELASTICSEARCH_BODY_STORE = body_store
+    settings.BODY_STORE_PATH = str(tmp_path / 'body.store')
+    cases = [restricted_case, case_factory()]
+    if body_store == 'file':
+        fabfile.build_body_store()
+    # edit a case after the body store is built, so it has to be fetched from postgres
+    cases[1].body_cache.html = '<section class="casebody">Edited</section>'
+    cases[1].body_cache.save()
+    CaseMetadata.reindex_cases(CaseMetadata.objects.filter(id__in=[c.id for c in cases]).for_indexing())
+    assert set(CaseDocument.get(restricted_case.id).casebody_data.to_dict()) == {'body_ref', 'text'}
+
+    for body_format in ('xml', 'html'):
+        assert get_casebody_data_with_format(auth_client, restricted_case.id, body_format) == getattr(restricted_case.body_cache, body_format)
+        response = auth_client.get(api_reverse('cases-list'), {"full_case": "true", "body_format": body_format})
+        check_response(response)
+        results = {case['id']: case['casebody']['data'] for case in response.json()['results']}
+        assert results == {c.id: getattr(c.body_cache, body_format) for c in cases}
+
+    # bodies of restricted cases aren't fetched for users who can't see them
+    with mock.patch('capapi.serializers.get_bodies', wraps=get_bodies) as mock_get_bodies:
+        check_response(client.get(api_reverse('cases-list'), {"full_case": "true", "body_format": "html"}))
+    assert [set(call[0][0]) for call in mock_get_bodies.call_args_list] == [{cases[1].id}]
+
+
 @pytest.mark.django_db(databases=['capdb'])
 @pytest.mark.parametrize("body_format", ["html", "xml", "text"])
 def test_exclude_data(body_format, case, elasticsearch):
@@ -554,6 +626,58 @@ def test_filter_case_cite_by(client, case_factory, elasticsearch):
     assert set(case['id'] for case in content['results']) == expected_case_ids
 
 
+@pytest.mark.django_db(databases=['capdb'])
+def test_filter_case_cite_by_index(client, case_factory, elasticsearch, settings, tmp_path):
+    search_url = api_reverse("cases-list")
+    cite_text = '1 Mass. 1'
+    case_cited = case_factory(citations__cite=cite_text)
+    other_case = case_factory()
+    matching_cases = [case_factory(
+        extracted_citations__cite=cite_text,
+        extracted_citations__normalized_cite=alphanum_lower(cite_text),
+        extracted_citations__target_case=case_cited,
+        extracted_citations__target_cases=[case_cited.id]
+    ) for _ in range(3)]
+    expected_case_ids = set(c.id for c in matching_cases)
+    case_cited.sync_case_body_cache()
+    update_elasticsearch_from_queue()
+    settings.CITED_BY_INDEX_PATH = str(tmp_path / 'cited_by.index')
+    fabfile.build_cited_by_index()
+
+    # cited cases picked from the index columns
+    content = client.get(search_url, {"cites_to__jurisdiction": case_cited.jurisdiction.slug}).json()
+    assert set(case['id'] for case in content['results']) == expected_case_ids
+    content = client.get(search_url, {"cites_to__court_id": case_cited.court_id, "cites_to__reporter": case_cited.reporter_id}).json()
+    assert set(case['id'] for case in content['results']) == expected_case_ids
+    content = client.get(search_url, {"cites_to__jurisdiction": other_case.jurisdiction.slug}).json()
+    assert content['results'] == []
+
+    # cited cases found by searching
+    search_text_no_index = " ".join(case_cited.body_cache.text.split(" ")[:3])
+    content = client.get(search_url, {"cites_to__search": search_text_no_index}).json()
+    assert set(case['id'] for case in content['results']) == expected_case_ids
+
+    # invalid slugs are still rejected
+    check_response(client.get(search_url, {"cites_to__jurisdiction": "not-a-jurisdiction"}), status_code=400)
+
+    # too many citing cases is an error rather than a huge terms query
+    settings.MAX_CITED_BY_RESULTS = 2
+    check_response(client.get(search_url, {"cites_to__jurisdiction": case_cited.jurisdiction.slug}), status_code=400)
+
+    # trends timelines are counted from the index
+    trends_url = api_reverse("ngrams-list")
+    trends_queries = [{"q": "api(cites_to_id=%s)" % case_cited.id}, {"q": "api(cites_to__jurisdiction=%s)" % case_cited.jurisdiction.slug, "jurisdiction": "*"}]
+    index_timelines = [client.get(trends_url, params).json() for params in trends_queries]
+    assert index_timelines[0]
+
+    # an index older than CITED_BY_INDEX_MAX_AGE_HOURS isn't used
+    settings.CITED_BY_INDEX_MAX_AGE_HOURS = 0
+    assert get_cited_by_index() is None
+    content = client.get(search_url, {"cites_to__jurisdiction": case_cited.jurisdiction.slug}).json()
+    assert set(case['id'] for case in content['results']) == expected_case_ids
+    assert [client.get(trends_url, params).json() for params in trends_queries] == index_timelines
+
+
 @pytest.mark.django_db(databases=['capdb'])
 def test_filter_court(client, court):
     # filtering court by jurisdiction
@@ -581,6 +705,35 @@ def test_filter_reporter(client, reporter):
         assert reporter_name_str in result['full_name']
 
 
+@pytest.mark.django_db(databases=['capdb'])
+def test_filter_case_similar_to(client, case_factory, elasticsearch, settings, tmp_path):
+    settings.SIMHASH_INDEX_PATH = str(tmp_path / 'simhash.index')
+    search_url = api_reverse("cases-list")
+    cases = [case_factory() for _ in range(4)]
+    simhashes = ['2:0000000000000000', '2:0000000000000007', '2:00000000000003ff', '2:ffffffffffffffff']
+    CaseAnalysis.bulk_upsert([CaseAnalysis(case=c, key='simhash', value=s) for c, s in zip(cases, simhashes)])
+    update_elasticsearch_from_queue()
+
+    # similarity search isn't available until index is built
+    check_response(client.get(search_url, {"similar_to": cases[0].id}), status_code=400)
+    fabfile.build_simhash_index()
+
+    # default distance
+    content = client.get(search_url, {"similar_to": cases[0].id}).json()
+    assert [case['id'] for case in content['results']] == [cases[1].id]
+
+    # custom distance
+    content = client.get(search_url, {"similar_to": cases[0].id, "similar_to_distance": 10}).json()
+    assert set(case['id'] for case in content['results']) == {cases[1].id, cases[2].id}
+
+    # no matches
+    content = client.get(search_url, {"similar_to": cases[3].id}).json()
+    assert content['results'] == []
+
+    # distance out of range
+    check_response(client.get(search_url, {"similar_to": cases[0].id, "similar_to_distance": 14}), status_code=400)
+
+
 # NGRAMS
 
 @flaky(max_runs=10)  # ngrammed_cases call to ngram_jurisdictions doesn't reliably work because it uses multiprocessing within pytest environment
@@ -1,11 +1,14 @@
 from copy import deepcopy
+from urllib.parse import urlencode
 
 import pytest
 
 from django.conf import settings
 from django.http import SimpleCookie
 
+from capapi.documents import CaseDocument
 from capapi.resources import api_reverse  # noqa -- this is dynamically used by test_cache_headers
+from capapi.response_cache import advance_response_cache_watermark
 from capapi.tests.helpers import is_cached, check_response
 from capweb.helpers import reverse
 from capdb.models import CaseMetadata
@@ -103,4 +106,34 @@ def test_cache_headers_with_bad_auth(client):
     client.credentials()
     client.cookies = SimpleCookie({settings.SESSION_COOKIE_NAME: 'fake'})
     response = client.get(reverse('home'))
-    assert not is_cached(response)
\ No newline at end of file
+    assert not is_cached(response)
+
+
+@pytest.mark.django_db(databases=['default', 'capdb', 'user_data'])
+def test_response_cache(client, auth_client, case_factory, elasticsearch, settings):
+    settings.API_RESPONSE_CACHE = True
+    case = case_factory()
+    detail_url = api_reverse('cases-detail', args=[case.id])
+    list_url = api_reverse('cases-list')
+    list_params = {'id': case.id, 'name_abbreviation': case.name_abbreviation}
+    detail_response = client.get(detail_url)
+    list_response = client.get(list_url, list_params)
+    assert list_response.json()['results'][0]['name_abbreviation'] == case.name_abbreviation
+    CaseDocument.get(case.id).update(name_abbreviation='Changed')
+
+    # anonymous requests are served from the cache, including with params in a different order
+    response = client.get(detail_url)
+    assert response.content == detail_response.content
+    assert is_cached(response)
+    response = client.get(list_url + '?' + urlencode([('name_abbreviation', case.name_abbreviation), ('id', case.id)]))
+    assert response.content == list_response.content
+
+    # logged-in and random requests are not
+    assert auth_client.get(detail_url).json()['name_abbreviation'] == 'Changed'
+    response = client.get(list_url, {'id': case.id, 'ordering': 'random'})
+    assert response.json()['results'][0]['name_abbreviation'] == 'Changed'
+
+    # advancing the watermark invalidates everything
+    advance_response_cache_watermark()
+    assert client.get(detail_url).json()['name_abbreviation'] == 'Changed'
+    assert client.get(list_url, list_params).json()['results'] == []
@@ -2,7 +2,7 @@ from elasticsearch.exceptions import RequestError
 import pytest
 
 from capapi.documents import CaseDocument
-from capapi.resources import parallel_execute
+from capapi.resources import get_parallel_search_pool, parallel_execute
 
 
 @pytest.mark.django_db(databases=['capdb'])
@@ -12,6 +12,11 @@ def test_parallel_execute(three_cases, elasticsearch):
     results = parallel_execute(CaseDocument.search().filter('terms', id=expected_ids), desired_docs=3)
     assert sorted(results) == expected_ids
 
+    # later searches reuse the same client and threads
+    client, executor = get_parallel_search_pool()
+    assert parallel_execute(CaseDocument.search().filter('terms', id=expected_ids), desired_docs=3) == results
+    assert get_parallel_search_pool() == (client, executor)
+
     # errors are raised
     with pytest.raises(RequestError):
         parallel_execute(CaseDocument.search().sort('invalid'), desired_docs=1)
@@ -1,9 +1,14 @@
+import random
+from copy import deepcopy
+
 import pytest
+from rest_framework.renderers import JSONRenderer
 from rest_framework.request import Request
 from rest_framework.test import APIRequestFactory
 
 from capapi import serializers
 from capapi.documents import CaseDocument
+from capapi.renderers import FastJSONRenderer
 from capapi.resources import api_reverse
 
 
@@ -25,3 +30,198 @@ def test_CaseDocumentSerializerWithCasebody(case_factory, elasticsearch):
     assert len(serialized.data) == 3
     for case in serialized.data:
         assert 'casebody' in case
+
+
+def random_case_hit(rand):
+    """ A random elasticsearch hit for a case, with the fields CaseDocumentSerializer reads. """
+    words = ['', 'a', 'Smith v. Jones', '1 U.S. 1', 'caf\xe9', ' ', '"quoted"', '2e-05']
+
+    def maybe(value):
+        return value if rand.random() < 0.5 else None
+
+    def extracted_citation():
+        c = {'cite': rand.choice(words)}
+        for key, value in [
+            ('category', 'reporters:federal'), ('reporter', 'U.S.'), ('target_cases', [rand.randint(1, 100)]),
+            ('weight', rand.randint(1, 3)), ('year', rand.choice([None, 1900])), ('pin_cites', [{'page': '2'}]),
+            ('opinion_id', rand.randint(0, 3)),
+        ]:
+            if rand.random() < 0.5:
+                c[key] = value
+        return c
+
+    opinions = []
+    for i in range(rand.randint(0, 4)):
+        opinion = {'type': rand.choice(['head_matter', 'majority', 'dissent'])}
+        if rand.random() < 0.7:
+            opinion['text'] = rand.choice(words)
+        if rand.random() < 0.7:
+            opinion['extracted_citations'] = [extracted_citation() for _ in range(rand.randint(0, 3))]
+        opinion['author'] = maybe(rand.choice(words))
+        opinions.append(opinion)
+    text = {'judges': [rand.choice(words)], 'opinions': opinions}
+    if rand.random() < 0.2:
+        text['head_matter'] = 'stale'
+    text['corrections'] = rand.choice(words)
+
+    hit = {'_source': {
+        'id': rand.randint(1, 10**6),
+        'name': rand.choice(words),
+        'name_abbreviation': rand.choice(words),
+        'decision_date_original': '1900-01-01',
+        'docket_number': rand.choice(words),
+        'first_page': '1',
+        'last_page': '2',
+        'citations': [{'type': 'official', 'cite': rand.choice(words), 'normalized_cite': '1us1'}],
+        'volume': {'barcode': '32044', 'volume_number': '1'},
+        'reporter': {'id': 1, 'full_name': rand.choice(words)},
+        'court': {'slug': 'us', 'name_abbreviation': 'U.S.', 'id': 1, 'name': rand.choice(words)},
+        'jurisdiction': {'id': 1, 'name_long': 'United States', 'slug': 'us', 'whitelisted': rand.random() < 0.5,
+                         'name': 'U.S.'},
+        'frontend_url': '/us/1/1/',
+        'frontend_pdf_url': maybe('/us/1/1.pdf'),
+        'last_updated': maybe('2020-01-01T00:00:00+00:00'),
+        'provenance': {'date_added': '2019-01-01', 'source': 'Harvard', 'batch': '2018'},
+        'restricted': False,
+        'casebody_data': {'text': text},
+    }}
+    if rand.random() < 0.8:
+        hit['_source']['analysis'] = {
+            'pagerank': {'raw': rand.random() / 10**rand.randint(0, 12), 'percentile': rand.random()},
+            'random_bucket': rand.randint(0, 0xFFFF),
+        }
+    if rand.random() < 0.3:
+        hit['highlight'] = {'name': ['<em>a</em>']}
+    if rand.random() < 0.3:
+        inner_hit = {'highlight': {'text': ['<em>b</em>']}}
+        hit['inner_hits'] = {'casebody_data.text.opinions': {'hits': {'hits': [inner_hit]}}}
+    return hit
+
+
+def to_representation_reference(serializer, instance):
+    """
+    The CaseDocumentSerializer.to_representation() that serialize_case() replaced, which walks the opinions several
+    times and moves head_matter and strips extracted_citations in the ES result itself.
+    """
+    serializer.get_url_templates()
+    s = serializer.s_from_instance(instance)
+
+    # get extracted_citations list, removing duplicate c["cite"] values
+    extracted_citations = []
+    ec = [
+        o["extracted_citations"]
+        for o in s["casebody_data"]["text"]["opinions"]
+        if "extracted_citations" in o
+    ]
+    ec = [item for sublist in ec for item in sublist]
+    for c in ec:
+        c = serializers.as_dict(c)
+        extracted_cite = {
+            "cite": c["cite"],
+            "category": c.get("category"),
+            "reporter": c.get("reporter"),
+        }
+        if c.get("target_cases"):
+            extracted_cite["case_ids"] = c["target_cases"]
+        if int(c.get("weight", 1)) > 1:
+            extracted_cite["weight"] = int(c["weight"])
+        if c.get("year"):
+            extracted_cite["year"] = c["year"]
+        if c.get("pin_cites"):
+            extracted_cite["pin_cites"] = c["pin_cites"]
+        if isinstance(c.get("opinion_id"), int):
+            extracted_cite["opinion_id"] = c["opinion_id"] - 1
+        extracted_citations.append(extracted_cite)
+
+    # move head_matter outside of casebody_data
+    head_matter = list(
+        filter(
+            lambda x: x["type"] == "head_matter",
+            s["casebody_data"]["text"]["opinions"],
+        )
+    )
+    head_matter = head_matter[0] if head_matter else []
+    if head_matter:
+        s["casebody_data"]["text"]["opinions"].remove(head_matter)
+
+    if "text" in head_matter:
+        s["casebody_data"]["text"]["head_matter"] = head_matter["text"]
+
+    # strip citations from casebody data
+    for i, element in enumerate(s["casebody_data"]["text"]["opinions"]):
+        if "extracted_citations" in element:
+            del s["casebody_data"]["text"]["opinions"][i]["extracted_citations"]
+
+    preview = serializer.get_preview(instance)
+
+    # IMPORTANT: If you change what values are exposed here, also change the "CaseLastUpdate triggers"
+    # section in set_up_postgres.py to keep Elasticsearch updated.
+    return {
+        "id": s["id"],
+        "url": serializer._url_templates["case_url"] % s["id"],
+        "name": s["name"],
+        "name_abbreviation": s["name_abbreviation"],
+        "decision_date": s["decision_date_original"],
+        "docket_number": s["docket_number"],
+        "first_page": s["first_page"],
+        "last_page": s["last_page"],
+        "citations": [
+            {"type": c["type"], "cite": c["cite"]} for c in s["citations"]
+        ],
+        "volume": {
+            "url": serializer._url_templates["volume_url"] % s["volume"]["barcode"],
+            "volume_number": s["volume"]["volume_number"],
+            "barcode": s["volume"]["barcode"],
+        },
+        "reporter": {
+            "url": serializer._url_templates["reporter_url"] % s["reporter"]["id"],
+            "full_name": s["reporter"]["full_name"],
+            "id": s["reporter"]["id"],
+        },
+        "court": {
+            "url": serializer._url_templates["court_url"] % s["court"]["slug"],
+            "name_abbreviation": s["court"]["name_abbreviation"],
+            "slug": s["court"]["slug"],
+            "id": s["court"]["id"],
+            "name": s["court"]["name"],
+        },
+        "jurisdiction": {
+            "id": s["jurisdiction"]["id"],
+            "name_long": s["jurisdiction"]["name_long"],
+            "url": serializer._url_templates["jurisdiction_url"]
+            % s["jurisdiction"]["slug"],
+            "slug": s["jurisdiction"]["slug"],
+            "whitelisted": s["jurisdiction"]["whitelisted"],
+            "name": s["jurisdiction"]["name"],
+        },
+        "cites_to": extracted_citations,
+        "frontend_url": serializer._url_templates["frontend_url"] % s["frontend_url"],
+        "frontend_pdf_url": serializer._url_templates["frontend_pdf_url"]
+        % s["frontend_pdf_url"]
+        if s["frontend_pdf_url"]
+        else None,
+        "preview": preview,
+        "analysis": s.get("analysis", {}),
+        "last_updated": s["last_updated"] or s["provenance"]["date_added"],
+        "provenance": s["provenance"],
+    }
+
+
+def test_case_serializer_fast_path_random():
+    # serializing in one pass and rendering with FastJSONRenderer gives the same bytes as the reference serializer
+    # and the stock renderer, and leaves the hit unchanged
+    rand = random.Random(1)
+    request = Request(APIRequestFactory().get(api_reverse("cases-list")))
+    context = {'request': request, 'force_body_format': 'text'}
+    for _ in range(500):
+        hit = random_case_hit(rand)
+        original = deepcopy(hit)
+        for Serializer in (serializers.CaseDocumentSerializer, serializers.NoLoginCaseDocumentSerializer):
+            serializer = Serializer(context=context)
+            fast = FastJSONRenderer().render(serializer.to_representation(hit))
+            reference_hit = deepcopy(original)
+            reference = to_representation_reference(serializer, reference_hit)
+            if Serializer is serializers.NoLoginCaseDocumentSerializer:
+                reference["casebody"] = {"status": "ok", "data": reference_hit["_source"]["casebody_data"]["text"]}
+            assert fast == JSONRenderer().render(reference), original
+        assert hit == original
@@ -1,17 +1,22 @@
 import re
+from datetime import timedelta
 
 import pytest
 from django.core import mail
+from django.utils import timezone
 
+from capapi.case_allowance import take_case_allowance
 from capapi.resources import api_reverse
 from capapi.models import SiteLimits, CapUser
-from capapi.tasks import daily_site_limit_reset_and_report
+from capapi.tasks import daily_site_limit_reset_and_report, reconcile_case_allowances
 from capapi.tests.helpers import check_response
 from capweb.helpers import reverse
 
 
 @pytest.mark.django_db(databases=['default', 'capdb', 'user_data'])
-def test_site_limits(client, auth_client, restricted_case, mailoutbox, elasticsearch):
+@pytest.mark.parametrize("counters", ["database", "redis"])
+def test_site_limits(client, auth_client, restricted_case, mailoutbox, elasticsearch, settings, counters):
+    settings.API_CASE_ALLOWANCE_COUNTERS = counters
 
     ### registration limit ###
 
@@ -60,6 +65,7 @@ def test_site_limits(client, auth_client, restricted_case, mailoutbox, elasticse
     ### tracking ###
 
     # site_limits updated
+    reconcile_case_allowances.apply()
     site_limits.refresh_from_db()
     assert site_limits.daily_signups == 1
     assert site_limits.daily_downloads == 1
@@ -74,3 +80,45 @@ def test_site_limits(client, auth_client, restricted_case, mailoutbox, elasticse
     assert last_mail.subject == 'CAP daily usage: 1 registered users, 1 blacklisted downloads'
 
 
+@pytest.mark.django_db(databases=['default', 'capdb', 'user_data'])
+def test_case_allowance_counters(auth_user, auth_client, restricted_case_factory, elasticsearch, settings):
+    settings.API_CASE_ALLOWANCE_COUNTERS = 'redis'
+    cases = [restricted_case_factory() for _ in range(3)]
+    auth_user.case_allowance_remaining = 1
+    auth_user.save()
+
+    def fetch_statuses(case):
+        response = auth_client.get(api_reverse('cases-detail', args=[case.id]), {'full_case': 'true'})
+        return response.json()['casebody']['status']
+
+    # allowance is taken from redis, and written back to the database by reconcile_case_allowances
+    assert fetch_statuses(cases[0]) == 'ok'
+    assert fetch_statuses(cases[1]) == 'error_limit_exceeded'
+    auth_user.refresh_from_db()
+    assert auth_user.case_allowance_remaining == 1
+    reconcile_case_allowances.apply()
+    auth_user.refresh_from_db()
+    assert auth_user.case_allowance_remaining == 0
+    assert SiteLimits.get().daily_downloads == 1
+
+    # changes made in the database take effect immediately
+    auth_user.case_allowance_remaining = 1
+    auth_user.save()
+    assert fetch_statuses(cases[1]) == 'ok'
+    assert fetch_statuses(cases[2]) == 'error_limit_exceeded'
+
+    # allowance resets after API_CASE_EXPIRE_HOURS, and pending counts from the old window are dropped
+    auth_user.case_allowance_last_updated = timezone.now() - timedelta(hours=settings.API_CASE_EXPIRE_HOURS + 1)
+    auth_user.save()
+    assert fetch_statuses(cases[2]) == 'ok'
+    reconcile_case_allowances.apply()
+    auth_user.refresh_from_db()
+    assert auth_user.case_allowance_remaining == auth_user.total_case_allowance - 1
+    assert SiteLimits.get().daily_downloads == 3
+
+    # takes read the database again, so a user loaded before reconcile_case_allowances ran can't reuse its count
+    auth_user.case_allowance_remaining = 1
+    auth_user.save()
+    assert take_case_allowance(auth_user, [cases[0].id]) == {cases[0].id: 'ok'}
+    reconcile_case_allowances.apply()
+    assert take_case_allowance(auth_user, [cases[1].id]) == {cases[1].id: 'error_limit_exceeded'}
@@ -1,8 +1,10 @@
 import bisect
+import os
 import urllib
 import re
+from collections import Counter
 from datetime import datetime
-from collections import defaultdict
+from itertools import chain
 from pathlib import Path
 
 from django.utils.functional import partition
@@ -13,7 +15,8 @@ from rest_framework.response import Response
 from rest_framework.reverse import reverse
 from django_elasticsearch_dsl_drf.filter_backends import DefaultOrderingFilterBackend, HighlightBackend
 from django_elasticsearch_dsl_drf.viewsets import BaseDocumentViewSet as DEDDBaseDocumentViewSet
-from django.http import QueryDict, HttpResponseRedirect, FileResponse, HttpResponseBadRequest
+from django.conf import settings
+from django.http import QueryDict, HttpResponseRedirect, FileResponse, HttpResponseBadRequest, StreamingHttpResponse
 from elasticsearch_dsl import TermsFacet, DateHistogramFacet
 from rest_framework.exceptions import ValidationError
 
@@ -21,12 +24,14 @@ from capapi import serializers, filters, permissions, renderers as capapi_render
 from capapi.documents import CaseDocument, RawSearch, ResolveDocument
 from capapi.pagination import CapESCursorPagination
 from capapi.serializers import CaseDocumentSerializer, ResolveDocumentSerializer
-from capapi.middleware import add_cache_header
+from capapi.middleware import add_cache_header, add_no_cache_header
 from capapi.resources import api_request
+from capapi.response_cache import cache_response
 from capdb import models
 from capdb.models import CaseMetadata
-from capdb.storages import ngram_kv_store_ro
+from capdb.storages import ngram_kv_store_ro, get_wildcard_key, NgramTotalsTable, NGRAM_VERSION_KEY
 from capweb.helpers import cache_func
+from scripts.cited_by import get_cited_by_index
 from scripts.helpers import alphanum_lower
 from user_data.models import UserHistory
 
@@ -101,6 +106,7 @@ class CaseDocumentViewSet(BaseDocumentViewSet):
     query_filter_backends = [
         filters.CitesToDynamicFilter,
         filters.CaseFilterBackend,
+        filters.SimilarToFilter,
         # queries that take full-text search operators:
         filters.MultiFieldFTSFilter,
         filters.NameFTSFilter,
@@ -274,10 +280,11 @@ class CaseDocumentViewSet(BaseDocumentViewSet):
 
     def get_renderers(self):
         if self.action == 'retrieve':
-            return [renderers.JSONRenderer(), capapi_renderers.PdfRenderer(), capapi_renderers.BrowsableAPIRenderer(), capapi_renderers.CSVRenderer()]
+            return [capapi_renderers.FastJSONRenderer(), capapi_renderers.PdfRenderer(), capapi_renderers.BrowsableAPIRenderer(), capapi_renderers.CSVRenderer()]
         else:
-            return [renderers.JSONRenderer(), capapi_renderers.BrowsableAPIRenderer(), capapi_renderers.CSVRenderer()]
+            return [capapi_renderers.FastJSONRenderer(), capapi_renderers.BrowsableAPIRenderer(), capapi_renderers.CSVRenderer()]
 
+    @cache_response()
     def retrieve(self, request, *args, **kwargs):
         # for user's convenience, if user gets /cases/casecitation or /cases/Case Citation (or any non-numeric value)
         # we redirect to /cases/?cite=casecitation
@@ -308,6 +315,7 @@ class CaseDocumentViewSet(BaseDocumentViewSet):
 
         return super(CaseDocumentViewSet, self).retrieve(request, *args, **kwargs)
 
+    @cache_response(unless=lambda request: request.query_params.get('ordering') == 'random')
     def list(self, request, *args, **kwargs):
         # cites_to can contain citations or IDs, so split out IDs into separate
         # cites_to_id parameter
@@ -317,8 +325,41 @@ class CaseDocumentViewSet(BaseDocumentViewSet):
             params.setlist('cites_to', cites_to)
             params.setlist('cites_to_id', cites_to_id)
 
+        if 'stream' in request.query_params:
+            return self.stream_list(request)
+
         return super(CaseDocumentViewSet, self).list(request, *args, **kwargs)
 
+    stream_formats = {
+        'ndjson': ('application/x-ndjson', capapi_renderers.stream_ndjson),
+        'csv': ('text/csv', capapi_renderers.stream_csv),
+    }
+
+    def stream_list(self, request):
+        """
+            Handle ?stream=ndjson or ?stream=csv by returning every matching case in a single streaming response,
+            instead of a page at a time. Results are fetched and serialized in batches of settings.STREAM_BATCH_SIZE,
+            so case allowances are checked and updated once per batch, as for a page of results.
+        """
+        stream_format = request.query_params['stream']
+        if stream_format not in self.stream_formats:
+            raise ValidationError({'stream': ['Must be one of: %s.' % ', '.join(self.stream_formats)]})
+        if request.query_params.get('ordering') == 'random':
+            raise ValidationError({'stream': ['Streaming is not supported with random ordering.']})
+        queryset = self.filter_queryset(self.get_queryset())
+        hit_batches = self.paginator.iterate_queryset(queryset, settings.STREAM_BATCH_SIZE)
+        # run the first search before the response starts, so an invalid query gets an error status
+        first_batch = next(hit_batches, None)
+        batches = (
+            self.get_serializer(hits, many=True).data
+            for hits in chain([first_batch] if first_batch else [], hit_batches))
+        content_type, render = self.stream_formats[stream_format]
+        response = StreamingHttpResponse(render(batches), content_type=f'{content_type}; charset=utf-8')
+        response["Content-Disposition"] = f'attachment; filename="CAP_{datetime.now()}.{stream_format}"'
+        # request.user is only read once streaming starts, too late for cache_header_middleware to notice
+        add_no_cache_header(response)
+        return response
+
     def finalize_response(self, request, response, *args, **kwargs):
         """Set content-disposition for json and csv formats."""
         response = super().finalize_response(request, response, *args, **kwargs)
@@ -410,31 +451,54 @@ class NgramViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # cache translation table between jurisdiction slug and ID
-
-        self.jurisdiction_id_to_slug = dict(models.Jurisdiction.objects.values_list('pk', 'slug'))
-        self.jurisdiction_id_to_slug[None] = 'total'
+        jurisdiction_id_to_slug, self.totals_by_jurisdiction_year_length = self.get_totals()
+        self.jurisdiction_id_to_slug = {**jurisdiction_id_to_slug, None: 'total'}
         self.jurisdiction_slug_to_id = {v:k for k,v in self.jurisdiction_id_to_slug.items()}
-        self.totals_by_jurisdiction_year_length = self.load_totals()
+
+    # per-process cache for get_totals()
+    _totals_cache = {}
+
+    @classmethod
+    def get_totals(cls):
+        """
+            Return (<jurisdiction id to slug dict>, <totals>), where totals are in the format returned by load_totals().
+            These come from the memory-mapped NgramTotalsTable written at ngram build time, which is reloaded if the
+            file is replaced. If the table is missing or doesn't match the version of the ngram database, fall back
+            to querying the database; the result is cached until the table file changes.
+        """
+        table_path = ngram_kv_store_ro.totals_table_path()
+        try:
+            stat = os.stat(table_path)
+            file_key = (table_path, stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            file_key = None
+        if file_key and cls._totals_cache.get('file_key') == file_key:
+            return cls._totals_cache['value']
+
+        if file_key and Path(ngram_kv_store_ro.db_path()).exists():
+            table = NgramTotalsTable(table_path)
+            if table.version != (ngram_kv_store_ro.get(NGRAM_VERSION_KEY) or b''):
+                # a read-only handle doesn't see writes made after it was opened, so the table may be from an
+                # update we haven't seen yet -- reopen to catch up
+                ngram_kv_store_ro.open()
+            if table.version == (ngram_kv_store_ro.get(NGRAM_VERSION_KEY) or b''):
+                cls._totals_cache.update(file_key=file_key, value=(table.jurisdiction_id_to_slug, table))
+                return cls._totals_cache['value']
+
+        value = dict(models.Jurisdiction.objects.values_list('pk', 'slug')), cls.load_totals()
+        if file_key:
+            cls._totals_cache.update(file_key=file_key, value=value)
+        return value
 
     @staticmethod
     def load_totals():
-        # populate self.totals_by_jurisdiction_year_length, a mapping of jurisdiction-year-length to counts, like:
+        # return a mapping of jurisdiction-year-length to counts, like:
         #   {
         #       (<jur_id>, <year>, <length>): (<word count>, <document count>),
         #   }
         if not Path(ngram_kv_store_ro.db_path()).exists():
             return {}
-        totals_by_jurisdiction_year_length = defaultdict(lambda: [0,0])
-        for k, v in ngram_kv_store_ro.get_prefix(b'totals', packed=True):
-            jur, year, n = ngram_kv_store_ro.unpack(k[len(b'totals'):])
-            totals_by_jurisdiction_year_length[(jur, year, n)] = v
-            for total in (
-                totals_by_jurisdiction_year_length[(None, year, n)],
-                totals_by_jurisdiction_year_length[(None, None, n)]
-            ):
-                total[0] += v[0]
-                total[1] += v[1]
-        return totals_by_jurisdiction_year_length
+        return ngram_kv_store_ro.load_totals()
 
     @staticmethod
     def query_params_are_filters(query_body):
@@ -511,6 +575,52 @@ class NgramViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
             **total_results['facets']['decision_date']
         }
 
+    @staticmethod
+    def get_citation_facets_from_index(query_params):
+        """
+            Given query_params made of cites_to_id or cites_to__* filters, plus an optional jurisdiction filter on the
+            citing cases, return the decision_date and jurisdiction,decision_date facets the cases endpoint would,
+            counted from the cited-by index's postings rather than by searching for the cited cases. Return None if
+            the index isn't available or can't answer the query.
+        """
+        cited_by_index = get_cited_by_index()
+        if cited_by_index is None:
+            return None
+        params = {k: query_params.getlist(k) for k in query_params if k not in ('page_size', 'facet')}
+        if any(len(values) != 1 for values in params.values()):
+            return None
+        params = {k: values[0] for k, values in params.items()}
+        jurisdiction = params.pop('jurisdiction', None)
+        if list(params) == ['cites_to_id']:
+            try:
+                cited_nodes = cited_by_index.nodes([int(params['cites_to_id'])])
+            except ValueError:
+                return None
+        elif params and all(k.startswith('cites_to__') for k in params):
+            cited_nodes = cited_by_index.select({k[len('cites_to__'):]: v for k, v in params.items()})
+            if cited_nodes is None:
+                return None
+        else:
+            return None
+
+        slugs = {jurisdiction_id: slug for slug, jurisdiction_id in cited_by_index.jurisdictions.items()}
+        counts = {slugs[j]: years for j, years in cited_by_index.citing_counts(cited_nodes).items() if j in slugs}
+        if jurisdiction is not None:
+            counts = {jurisdiction: counts[jurisdiction]} if jurisdiction in counts else {}
+
+        def histogram(years):
+            # like elasticsearch's date histogram, include empty years between the first and last
+            return {year: years.get(year, 0) for year in range(min(years), max(years) + 1)} if years else {}
+
+        total = Counter()
+        for years in counts.values():
+            total.update(years)
+        return {
+            'decision_date': histogram(total),
+            'jurisdiction,decision_date': {
+                slug: histogram(years) for slug, years in sorted(counts.items(), key=lambda item: -sum(item[1].values()))},
+        }
+
     def get_citation_data(self, request, query_params, words_encoded):
         # given a case and its decision year, generate the timeline for the trends API.
 
@@ -522,13 +632,19 @@ class NgramViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
         elif jurisdiction != 'total':
             query_params['jurisdiction'] = jurisdiction
 
-        # set up request caller and make API requests with facet parameter
-        # These queries should always return valid JSON 
-        query_results = api_request(request, CaseDocumentViewSet, 'list', get_params=query_params).data
-
-        # fail if there are no results. There should be _something_ in the page results if 
-        # the aggregation is not just 0
-        if 'results' not in query_results or not query_results['results']:
+        # count citing cases from the cited-by index if it can answer the query
+        facets = self.get_citation_facets_from_index(query_params)
+        if facets is None:
+            # set up request caller and make API requests with facet parameter
+            # These queries should always return valid JSON 
+            query_results = api_request(request, CaseDocumentViewSet, 'list', get_params=query_params).data
+
+            # fail if there are no results. There should be _something_ in the page results if 
+            # the aggregation is not just 0
+            if 'results' not in query_results or not query_results['results']:
+                return {}
+            facets = query_results['facets']
+        elif not facets['decision_date']:
             return {}
 
         total_dict = self.get_total_dict(request)
@@ -539,13 +655,13 @@ class NgramViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
 
         # format results into trend graph
         if jurisdiction != '*':
-            query_results = query_results['facets']['decision_date']
+            query_results = facets['decision_date']
             years_out = self.create_timeline_entries(query_results, total_dict, jurisdiction)
 
             out[jurisdiction] = years_out
             results[words_encoded] = out
         else:
-            query_results = query_results['facets']['jurisdiction,decision_date']
+            query_results = facets['jurisdiction,decision_date']
 
             for jurisdiction, value in list(query_results.items())[:10]:
                 years_out = self.create_timeline_entries(value, total_dict, jurisdiction)
@@ -555,6 +671,7 @@ class NgramViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
 
         return results
 
+    @cache_response()
     def list(self, request, *args, **kwargs):
         # without specific ngram search, return nothing
         q = self.request.GET.get('q', '').strip()
@@ -579,8 +696,12 @@ class NgramViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
             pairs = []
         elif q_sig.endswith(b' *'):
             results = {}
-            # wildcard search
-            pairs = ngram_kv_store_ro.get_prefix(q_sig[:-1], packed=True)
+            # wildcard search -- look up the top completions in the wildcard index, or scan the prefix if it hasn't been built
+            prefix = q_sig[:-1]
+            top_completions = ngram_kv_store_ro.get(get_wildcard_key(prefix), packed=True)
+            if top_completions is None:
+                top_completions = ngram_kv_store_ro.top_completions(prefix, 10)
+            pairs = [(gram, value) for gram, value in ngram_kv_store_ro.get_many([gram for gram, _ in top_completions[:10]], packed=True) if value]
         else:
             results = {}
             # non-wildcard search
@@ -612,6 +733,9 @@ class NgramViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
             for gram, data in pairs:
                 total_jur = data[None]
                 sort_count = total_jur[None][0]
+                # grams can be left with no observations by update_ngrams_from_queue()
+                if not sort_count:
+                    continue
                 bisect.insort_right(top_pairs, (sort_count, gram, data))
                 top_pairs = top_pairs[-10:]
 
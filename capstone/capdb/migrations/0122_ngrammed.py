@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('capdb', '0121_auto_20231219_2128'),
+    ]
+
+    operations = [
+        # existing rows are already reflected in the ngram database, so default them to ngrammed=True
+        migrations.AddField(
+            model_name='caselastupdate',
+            name='ngrammed',
+            field=models.BooleanField(db_index=True, default=True, help_text='Whether this update has been applied to the ngram database'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='casedeleted',
+            name='ngrammed',
+            field=models.BooleanField(db_index=True, default=True, help_text='Whether this delete has been applied to the ngram database'),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('capdb', '0122_ngrammed'),
+    ]
+
+    operations = [
+        # existing rows predate tracking, so leave them null; run `fab update_postgres_env` to install the trigger
+        # that sets this field, then `fab export_citation_graph` before the next `fab update_citation_graph`
+        migrations.AddField(
+            model_name='caselastupdate',
+            name='graph_timestamp',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='When a change that affects the citation graph was last made', null=True),
+        ),
+    ]
@@ -8,7 +8,7 @@ import shutil
 from contextlib import contextmanager
 import struct
 import base64
-import fitz
+import billiard
 from lxml import etree
 from model_utils import FieldTracker
 import nacl
@@ -38,13 +38,15 @@ from scripts.fastcase.format_fastcase import format_fastcase_html
 from scripts.fix_court_tag.fix_court_tag import fix_court_tag
 from scripts.helpers import (special_jurisdiction_cases, jurisdiction_translation, parse_xml,
                              serialize_xml, jurisdiction_translation_long_name,
-                             short_id_from_s3_key, alphanum_lower, parse_html)
+                             short_id_from_s3_key, alphanum_lower)
+from scripts.pdf_cache import get_case_pdf
 from scripts.process_metadata import get_case_metadata, parse_decision_date
 
 from elasticsearch.helpers import BulkIndexError
 
 from scripts.render_case import iter_pars
-from scripts.simhash import get_simhash
+from scripts.simhash import get_simhash, get_simhashes
+from scripts.tokenizer import tokenize
 
 
 def choices(*args):
@@ -155,6 +157,52 @@ def fetch_relations(instance, select_relations=None, prefetch_relations=None):
                 sub_field_name]
 
 
+
+### Helpers for rendering cases in worker processes ###
+
+# state set in each render worker by init_render_worker()
+_render_worker_state = {}
+
+
+def init_render_worker(case_metadatas, blocks_by_id, fonts_by_id, labels_by_block_id, rerender):
+    """
+        Pool initializer for VolumeMetadata.sync_case_body_caches(processes=...). Workers are forked, so the volume's
+        cases, blocks, fonts and labels are a read-only copy-on-write snapshot rather than being sent to each worker.
+
+        Database connections inherited from the parent may be in the middle of its transaction. Set them aside
+        without closing them, which would close the parent's connection too, so each worker opens its own.
+    """
+    _render_worker_state['inherited_connections'] = [connections[alias] for alias in connections]
+    for alias in connections:
+        del connections[alias]
+    _render_worker_state['volume'] = (case_metadatas, blocks_by_id, fonts_by_id, labels_by_block_id, rerender)
+
+
+def render_case_body_cache(i):
+    """
+        Pool worker for VolumeMetadata.sync_case_body_caches(processes=...). Call sync_case_body_cache() without
+        saving for the i'th case, and return results in a form that is cheap to send back to the parent, which does
+        the bulk writes:
+            (changed, {body_cache field: value}, [(analysis key, value)], cites_to_delete, cites_to_create)
+    """
+    case_metadatas, blocks_by_id, fonts_by_id, labels_by_block_id, rerender = _render_worker_state['volume']
+    case_metadata = case_metadatas[i]
+    changed, analyses, cites_to_delete, cites_to_create = case_metadata.sync_case_body_cache(
+        blocks_by_id,
+        fonts_by_id,
+        labels_by_block_id,
+        rerender=rerender,
+        save=False,
+        simhash=False)
+    if not changed:
+        return False, {}, [], [], []
+    fields = ['html', 'xml', 'text', 'json'] if rerender else ['text', 'json']
+    body_cache_values = {k: getattr(case_metadata.body_cache, k) for k in fields}
+    cited_by_field = ExtractedCitation._meta.get_field('cited_by')
+    for cite in cites_to_create:
+        cited_by_field.delete_cached_value(cite)  # don't send the whole case back with each cite
+    return True, body_cache_values, [(a.key, a.value) for a in analyses], cites_to_delete, cites_to_create
+
 class TransactionTimestampDateTimeField(models.DateTimeField):
     """ Postgres timestamp field that defaults to current_timestamp, the timestamp at the start of the transaction """
 
@@ -739,9 +787,11 @@ class VolumeMetadata(models.Model):
         super().save(*args, **kwargs)
 
     @transaction.atomic(using='capdb')
-    def sync_case_body_caches(self, rerender=True, page_structures=None):
+    def sync_case_body_caches(self, rerender=True, page_structures=None, processes=None):
         """
             Efficiently update case body caches for all cases in this volume.
+            If processes is more than 1 (default settings.SYNC_CASE_BODY_CACHE_PROCESSES), cases are rendered in a
+            pool of forked worker processes, and this process does the database writes.
         """
         to_update = []
         to_create = []
@@ -766,14 +816,24 @@ class VolumeMetadata(models.Model):
             update_fields = ['text', 'json']
 
         # do processing
-        for case_metadata in query:
-            changed, analyses, cites_to_delete, cites_to_create = case_metadata.sync_case_body_cache(
+        if processes is None:
+            processes = settings.SYNC_CASE_BODY_CACHE_PROCESSES
+        case_metadatas = list(query)
+        if processes > 1 and len(case_metadatas) > 1:
+            results = self.render_case_body_caches_in_pool(
+                case_metadatas, processes, blocks_by_id, fonts_by_id, labels_by_block_id, rerender)
+        else:
+            results = (case_metadata.sync_case_body_cache(
                 blocks_by_id,
                 fonts_by_id,
                 labels_by_block_id,
                 rerender=rerender,
-                save=False)
+                save=False,
+                simhash=False) for case_metadata in case_metadatas)
+        changed_cases = []
+        for case_metadata, (changed, analyses, cites_to_delete, cites_to_create) in zip(case_metadatas, results):
             if changed:
+                changed_cases.append(case_metadata)
                 all_analyses.extend(analyses)
                 body_cache = case_metadata.body_cache
                 if body_cache.id:
@@ -783,6 +843,10 @@ class VolumeMetadata(models.Model):
                 all_cites_to_create += cites_to_create
                 all_cites_to_delete += cites_to_delete
 
+        # simhash all changed cases at once
+        simhashes = get_simhashes([c.body_cache.text for c in changed_cases])
+        all_analyses.extend(CaseAnalysis(case=c, key='simhash', value=simhash) for c, simhash in zip(changed_cases, simhashes))
+
         # save
         if to_create:
             CaseBodyCache.objects.bulk_create(to_create)
@@ -795,6 +859,39 @@ class VolumeMetadata(models.Model):
         if all_cites_to_create:
             ExtractedCitation.objects.bulk_create(all_cites_to_create)
 
+    @staticmethod
+    def render_case_body_caches_in_pool(case_metadatas, processes, blocks_by_id, fonts_by_id, labels_by_block_id, rerender):
+        """
+            Render case_metadatas with render_case_body_cache() in a pool of forked processes. Copy the results
+            onto each case's body_cache, and yield the same (changed, analyses, cites_to_delete, cites_to_create)
+            as sync_case_body_cache(save=False), in order.
+
+            This uses billiard, celery's fork of multiprocessing, because celery prefork workers are daemonic and
+            multiprocessing doesn't let daemonic processes start a pool.
+        """
+        pool = billiard.get_context('fork').Pool(
+            min(processes, len(case_metadatas)),
+            initializer=init_render_worker,
+            initargs=(case_metadatas, blocks_by_id, fonts_by_id, labels_by_block_id, rerender))
+        try:
+            results = pool.imap(render_case_body_cache, range(len(case_metadatas)), chunksize=4)
+            for case_metadata, (changed, body_cache_values, analyses, cites_to_delete, cites_to_create) in zip(case_metadatas, results):
+                if not changed:
+                    yield False, [], [], []
+                    continue
+                try:
+                    body_cache = case_metadata.body_cache
+                except CaseBodyCache.DoesNotExist:
+                    body_cache = case_metadata.body_cache = CaseBodyCache(metadata=case_metadata)
+                for k, v in body_cache_values.items():
+                    setattr(body_cache, k, v)
+                for cite in cites_to_create:
+                    cite.cited_by = case_metadata
+                analyses = [CaseAnalysis(case=case_metadata, key=k, value=v) for k, v in analyses]
+                yield True, analyses, cites_to_delete, cites_to_create
+        finally:
+            pool.terminate()
+
     @transaction.atomic(using='capdb')
     def unredact(self, key=settings.REDACTION_KEY, replace_pdf=True):
         """
@@ -1265,10 +1362,11 @@ class CaseMetadata(models.Model):
         renderer = render_case.VolumeRenderer(blocks_by_id, {}, {})
         return renderer.hydrate_opinions(structure.opinions, blocks_by_id)
 
-    def sync_case_body_cache(self, blocks_by_id=None, fonts_by_id=None, labels_by_block_id=None, rerender=True, save=True):
+    def sync_case_body_cache(self, blocks_by_id=None, fonts_by_id=None, labels_by_block_id=None, rerender=True, save=True, simhash=None):
         """
             Update self.body_cache with new values based on the current value of self.structure.
             blocks_by_id and fonts_by_id can be provided for efficiency if updating a bunch of cases from the same volume.
+            simhash is passed through to run_text_analysis().
 
             Return value:
                 If case contents have changed, return (True, analyses, cites_to_delete, cites_to_create)
@@ -1284,7 +1382,7 @@ class CaseMetadata(models.Model):
             json, text = self.get_json_from_html(body_cache.html)
             if body_cache.json != json or body_cache.text != text:
                 body_cache.json, body_cache.text = json, text
-                analyses = self.run_text_analysis(save=save)
+                analyses = self.run_text_analysis(save=save, simhash=simhash)
                 if save:
                     body_cache.save(update_fields=['text', 'json'])
                 return True, analyses, [], []
@@ -1324,7 +1422,7 @@ class CaseMetadata(models.Model):
                 setattr(body_cache, k, new_val)
                 changed = True
         if changed:
-            analyses = self.run_text_analysis(blocks_by_id, save=save)
+            analyses = self.run_text_analysis(blocks_by_id, save=save, simhash=simhash)
             if save:
                 body_cache.save()
                 ExtractedCitation.objects.filter(id__in=cites_to_delete).delete()
@@ -1332,23 +1430,26 @@ class CaseMetadata(models.Model):
             return True, analyses, cites_to_delete, cites_to_create
         return False, [], [], []
 
-    def run_text_analysis(self, blocks_by_id=None, save=True):
+    def run_text_analysis(self, blocks_by_id=None, save=True, simhash=None, words=None):
         """
             Calculate char_count, word_count, and ocr_confidence for case.
             Return CaseAnalysis objects.
             ocr_confidence will be skipped if blocks_by_id is None.
+            simhash can be provided if it was already calculated for a batch of cases with get_simhashes(),
+            or set to False to skip it if the caller will calculate it in bulk.
+            words can be provided if they were already tokenized for a batch of cases with tokenize_many().
         """
-        from scripts.tokenizer import tokenize  # local import to avoid loading nltk if not needed
-
         text = self.body_cache.text
-        words = list(tokenize(text))
+        if words is None:
+            words = list(tokenize(text, settings.TEXT_ANALYSIS_TOKENIZER_VERSION))
         analyses = [
             CaseAnalysis(case=self, key='char_count', value=len(text)),
             CaseAnalysis(case=self, key='word_count', value=len(words)),
             CaseAnalysis(case=self, key='cardinality', value=len(set(words))),
-            CaseAnalysis(case=self, key='simhash', value=get_simhash(text)),
             CaseAnalysis(case=self, key='sha256', value=hashlib.sha256(text.encode('utf8')).hexdigest()),
         ]
+        if simhash is not False:
+            analyses.append(CaseAnalysis(case=self, key='simhash', value=simhash or get_simhash(text)))
         confidence = None
         if self.human_corrected:
             confidence = 1.0
@@ -1368,33 +1469,7 @@ class CaseMetadata(models.Model):
         return analyses
 
     def get_json_from_html(self, html):
-        casebody_pq = parse_html(html)
-        casebody_pq.remove(
-            '.page-label,.footnotemark,.bracketnum,.footnote > a')  # remove page numbers and footnote numbers from text/json
-
-        # extract each opinion into a dictionary
-        opinions = []
-        opinions.append({
-            'type': 'head_matter',
-            'author': 'head_matter',
-            'text': casebody_pq('.head-matter').text(),
-        })
-        for opinion in casebody_pq.items('.opinion'):
-            opinions.append({
-                'type': opinion.attr['data-type'],
-                'author': opinion('.author').text() or None,
-                'text': opinion.text(),
-            })
-        json = {
-            'judges': [judge.text() for judge in casebody_pq('.judges').items()],
-            'attorneys': [attorney.text() for attorney in casebody_pq('.attorneys').items()],
-            'parties': [party.text() for party in casebody_pq('.parties').items()],
-            'opinions': opinions,
-            'corrections': casebody_pq('.corrections').text(),
-        }
-
-        text = "\n".join([o['text'] for o in json['opinions']] + [json['corrections']])
-        return json, text
+        return render_case.extract_json_from_html(html)
 
     def sync_from_initial_metadata(self, force=False):
         """
@@ -1534,13 +1609,11 @@ class CaseMetadata(models.Model):
 
     def get_pdf(self):
         """
-            Return PDF for this case from volume PDF. `fitz` is the PyMuPDF library.
+            Return PDF for this case from volume PDF, via the PDF slice cache if configured.
         """
         if not self.pdf_available():
             return None
-        doc = fitz.open(self.volume.pdf_file.path)
-        doc.select(range(self.first_page_order - 1, self.last_page_order))
-        return doc.write(garbage=2)
+        return get_case_pdf(self.volume.pdf_file.path, self.first_page_order, self.last_page_order, self.volume.redacted)
 
     def formatted_decision_date(self):
         """
@@ -2639,13 +2712,16 @@ class CaseLastUpdate(models.Model):
     case = models.OneToOneField('CaseMetadata', related_name='last_update', on_delete=models.DO_NOTHING)
     timestamp = models.DateTimeField()
     indexed = models.BooleanField(default=False, db_index=True)
+    ngrammed = models.BooleanField(default=False, db_index=True, help_text="Whether this update has been applied to the ngram database")
+    graph_timestamp = models.DateTimeField(null=True, blank=True, db_index=True, help_text="When a change that affects the citation graph was last made")
 
 
 class CaseDeleted(models.Model):
-    """Tombstone so deleted cases are deleted from elasticsearch."""
+    """Tombstone so deleted cases are deleted from elasticsearch and the ngram database."""
     case_id = models.IntegerField()
     timestamp = models.DateTimeField()
     indexed = models.BooleanField(default=False, db_index=True)
+    ngrammed = models.BooleanField(default=False, db_index=True, help_text="Whether this delete has been applied to the ngram database")
 
 
 class CaseAnalysis(models.Model):
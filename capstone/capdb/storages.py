@@ -1,12 +1,19 @@
 import csv
 import gzip
 import hashlib
+import heapq
+import json
+import mmap
 import shutil
+import struct
+import uuid
 import traceback
 import types
+from collections import defaultdict
 from contextlib import contextmanager
 
 import msgpack
+import numpy as np
 import os
 import itertools
 from pathlib import Path
@@ -434,6 +441,166 @@ class KVDB:
         return self._db
 
 
+### ngram value encoding ###
+
+# Values for b'<n><gram>' keys in NgramRocksDB start with this version byte. Older values are msgpack maps, which always
+# start with 0x80-0x8f or 0xde-0xdf, so the two formats can be told apart.
+NGRAM_VALUE_VERSION = 2
+
+def write_uvarint(out, i):
+    """ Append non-negative int i to bytearray out as a varint. """
+    while i > 0x7f:
+        out.append((i & 0x7f) | 0x80)
+        i >>= 7
+    out.append(i)
+
+def write_svarint(out, i):
+    """ Append int i to bytearray out as a zigzag-encoded varint. """
+    write_uvarint(out, i << 1 if i >= 0 else (-i << 1) - 1)
+
+def read_uvarint(buf, pos):
+    """ Return (<int>, <new pos>) for the varint at buf[pos]. """
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+def read_svarint(buf, pos):
+    """ Return (<int>, <new pos>) for the zigzag-encoded varint at buf[pos]. """
+    i, pos = read_uvarint(buf, pos)
+    return (i >> 1) ^ -(i & 1), pos
+
+def pack_ngram_years(years):
+    """
+        Encode a {<year>: [<instance_count>, <document_count>]} dict as a column of delta-encoded years followed by
+        a column of instance counts and a column of document counts.
+        >>> years = {100: [3, 1], -50: [2, 2], 101: [1, 1]}
+        >>> unpack_ngram_years(pack_ngram_years(years)) == ([-50, 100, 101], [2, 3, 1], [2, 1, 1])
+        True
+    """
+    sorted_years = sorted(years)
+    out = bytearray()
+    write_uvarint(out, len(sorted_years))
+    previous = 0
+    for year in sorted_years:
+        write_svarint(out, year - previous)
+        previous = year
+    for column in (0, 1):
+        for year in sorted_years:
+            write_svarint(out, years[year][column])
+    return bytes(out)
+
+def unpack_ngram_years(block):
+    """ Decode output of pack_ngram_years() to ([<year>, ...], [<instance_count>, ...], [<document_count>, ...]). """
+    count, pos = read_uvarint(block, 0)
+    columns = ([], [], [])
+    for column in columns:
+        for _ in range(count):
+            i, pos = read_svarint(block, pos)
+            column.append(i)
+    years = columns[0]
+    for i in range(1, count):
+        years[i] += years[i-1]
+    return columns
+
+def pack_ngram_value(total, blocks):
+    """
+        Encode an ngram value, given total == [<instance_count>, <document_count>] across all jurisdiction-years, and
+        blocks == {<jurisdiction_id>: pack_ngram_years(...)}. Layout:
+            <NGRAM_VALUE_VERSION> <total instances> <total documents> <block count>
+            <jurisdiction_id> <block length> <block>
+            <jurisdiction_id> <block length> <block>
+            ...
+        Blocks are sorted by jurisdiction_id and length-prefixed, so the overall total can be read without decoding
+        blocks, and merges only need to decode the blocks they change.
+    """
+    out = bytearray([NGRAM_VALUE_VERSION])
+    write_svarint(out, total[0])
+    write_svarint(out, total[1])
+    write_uvarint(out, len(blocks))
+    for jurisdiction_id in sorted(blocks):
+        block = blocks[jurisdiction_id]
+        write_uvarint(out, jurisdiction_id)
+        write_uvarint(out, len(block))
+        out += block
+    return bytes(out)
+
+def unpack_ngram_blocks(value):
+    """ Decode output of pack_ngram_value() to (<total>, <blocks>), without decoding the blocks themselves. """
+    total_instances, pos = read_svarint(value, 1)
+    total_documents, pos = read_svarint(value, pos)
+    count, pos = read_uvarint(value, pos)
+    blocks = {}
+    for _ in range(count):
+        jurisdiction_id, pos = read_uvarint(value, pos)
+        length, pos = read_uvarint(value, pos)
+        blocks[jurisdiction_id] = value[pos:pos+length]
+        pos += length
+    return [total_instances, total_documents], blocks
+
+def unpack_ngram_value(value):
+    """
+        Decode output of pack_ngram_value() to the dict format documented in NgramRocksDB.NgramMergeOperator.
+        >>> value = pack_ngram_dict({None: {None: [3, 2], 100: [3, 2]}, 1: [100, 2, 1], 2: [100, 1, 1]})
+        >>> unpack_ngram_value(value) == {None: {None: [3, 2], 100: [3, 2]}, 1: [100, 2, 1], 2: [100, 1, 1]}
+        True
+    """
+    total, blocks = unpack_ngram_blocks(value)
+    totals = {None: total}
+    out = {None: totals}
+    for jurisdiction_id, block in blocks.items():
+        years = out[jurisdiction_id] = []
+        for year, instance_count, document_count in zip(*unpack_ngram_years(block)):
+            years.extend((year, instance_count, document_count))
+            totals_year = totals.setdefault(year, [0, 0])
+            totals_year[0] += instance_count
+            totals_year[1] += document_count
+    return out
+
+def pack_ngram_dict(value):
+    """ Encode an ngram value in the legacy msgpack dict format (see NgramMergeOperator) with pack_ngram_value(). """
+    blocks = {}
+    for jurisdiction_id, flat_years in value.items():
+        if jurisdiction_id is None:
+            continue
+        years = {}
+        for i in range(0, len(flat_years), 3):
+            year_counts = years.setdefault(flat_years[i], [0, 0])
+            year_counts[0] += flat_years[i+1]
+            year_counts[1] += flat_years[i+2]
+        years = {k: v for k, v in years.items() if v[0] or v[1]}
+        if years:
+            blocks[jurisdiction_id] = pack_ngram_years(years)
+    return pack_ngram_value(value[None][None], blocks)
+
+def ngram_value_total(value):
+    """ Return [<instance_count>, <document_count>] across all jurisdiction-years for an encoded ngram value. """
+    if value[0] == NGRAM_VALUE_VERSION:
+        total_instances, pos = read_svarint(value, 1)
+        total_documents, pos = read_svarint(value, pos)
+        return [total_instances, total_documents]
+    return KVDB.unpack(value)[None][None]
+
+
+# key whose value changes on every write that affects totals; see NgramTotalsTable
+NGRAM_VERSION_KEY = b"version"
+
+def new_ngram_version():
+    return uuid.uuid4().bytes
+
+def get_wildcard_key(prefix):
+    """
+        Key for the wildcard index entry listing the top completions for a gram key prefix like b'<n><word> ', in the
+        form pack([[b'<n><gram>', <instance_count>], ...]), sorted by instance count descending.
+        See scripts.ngrams.build_wildcard_index().
+    """
+    return b"wildcard" + prefix
+
+
 class NgramRocksDB(KVDB):
     """ Wrapper for RocksDB. """
     name = 'rocksdb'
@@ -441,6 +608,13 @@ class NgramRocksDB(KVDB):
 
     ## helpers
 
+    @staticmethod
+    def unpack(v, packed=True):
+        """ Decode ngram values with unpack_ngram_value(), and everything else with msgpack. """
+        if packed and v and v[0] == NGRAM_VALUE_VERSION:
+            return unpack_ngram_value(v)
+        return KVDB.unpack(v, packed)
+
     def db_path(self):
         return os.path.join(self.path, self.name+".db")
 
@@ -494,50 +668,99 @@ class NgramRocksDB(KVDB):
         self.db_or_batch(batch).put(k, self.pack(v, packed))
 
     class NgramMergeOperator(MergeOperator):
-        def full_merge(self, key, existing_value, ops):
-            """
-                Our mergable keys contain the counts for all jurisdiction-years and totals for an ngram, like this:
-                    existing_value == self.pack({
-                        <jurisdiction_id>: [
-                            <year>, <instance_count>, <document_count>,
-                            <year>, <instance_count>, <document_count>,
-                            ...
-                        ],
-                        None: {
-                            <year>: [<instance_count>, <document_count>],
-                            ...,
-                            None: [<instance_count>, <document_count>],
-                        }
-                    })
-                This function merges in new observations, in the form:
-                    ops == [
-                        self.pack((<jurisdiction_id>, <year>, <instance_count>, <document_count>)),
+        """
+            Our mergable keys contain the counts for all jurisdiction-years and totals for an ngram. Decoded with
+            NgramRocksDB.unpack(), they look like this:
+                {
+                    <jurisdiction_id>: [
+                        <year>, <instance_count>, <document_count>,
+                        <year>, <instance_count>, <document_count>,
                         ...
-                    ]
-            """
-            try:
-                # get target for merge
-                value = KVDB.unpack(existing_value) if existing_value else {
+                    ],
                     None: {
-                        None: [0, 0],
+                        <year>: [<instance_count>, <document_count>],
+                        ...,
+                        None: [<instance_count>, <document_count>],
                     }
                 }
-                for new_value in ops:
-                    # get values to merge
-                    new_value = KVDB.unpack(new_value)
-                    jurisdiction_id, storage_year, instance_count, document_count = new_value
-                    # merge in individual jurisdiction-year value
-                    value.setdefault(jurisdiction_id, []).extend((storage_year, instance_count, document_count))
-                    # merge in running total for year
-                    totals = value[None]
-                    totals_year = totals.setdefault(storage_year, [0,0])
-                    totals_year[0] += instance_count
-                    totals_year[1] += document_count
-                    # merge in running total for all years combined
-                    total = totals[None]
-                    total[0] += instance_count
-                    total[1] += document_count
-                return (True, KVDB.pack(value))
+            and are stored with pack_ngram_value(). Values written before NGRAM_VALUE_VERSION were stored as msgpack
+            dicts in the decoded format; they are converted on their next merge, or by scripts.ngrams.migrate_ngram_values.
+
+            New observations are merged in as operands in the form:
+                self.pack((<jurisdiction_id>, <year>, <instance_count>, <document_count>))
+            or as the output of partial_merge(), which combines operands into a pack_ngram_value() delta.
+
+            Observations for a jurisdiction-year that is already present are added to the existing counts, and counts
+            may be negative to remove observations (see scripts.ngrams.update_ngrams_from_queue). Jurisdiction-years
+            whose counts drop to zero are removed.
+        """
+        @staticmethod
+        def add_operand(operand, deltas, total):
+            """ Add counts from a merge operand to deltas, in the form {<jurisdiction_id>: {<year>: [<instance_count>, <document_count>]}}. """
+            if operand[0] == NGRAM_VALUE_VERSION:
+                operand_total, blocks = unpack_ngram_blocks(operand)
+                for jurisdiction_id, block in blocks.items():
+                    years = deltas.setdefault(jurisdiction_id, {})
+                    for year, instance_count, document_count in zip(*unpack_ngram_years(block)):
+                        year_counts = years.setdefault(year, [0, 0])
+                        year_counts[0] += instance_count
+                        year_counts[1] += document_count
+                total[0] += operand_total[0]
+                total[1] += operand_total[1]
+            else:
+                jurisdiction_id, storage_year, instance_count, document_count = KVDB.unpack(operand)
+                year_counts = deltas.setdefault(jurisdiction_id, {}).setdefault(storage_year, [0, 0])
+                year_counts[0] += instance_count
+                year_counts[1] += document_count
+                total[0] += instance_count
+                total[1] += document_count
+
+        def full_merge(self, key, existing_value, ops):
+            try:
+                # get target for merge
+                if not existing_value:
+                    total, blocks = [0, 0], {}
+                elif existing_value[0] != NGRAM_VALUE_VERSION:
+                    total, blocks = unpack_ngram_blocks(pack_ngram_dict(KVDB.unpack(existing_value)))
+                else:
+                    total, blocks = unpack_ngram_blocks(existing_value)
+
+                # collect new observations
+                deltas = {}
+                for op in ops:
+                    self.add_operand(op, deltas, total)
+
+                # re-encode only the jurisdictions that changed; other blocks are copied as-is
+                for jurisdiction_id, year_deltas in deltas.items():
+                    years = {}
+                    if jurisdiction_id in blocks:
+                        for year, instance_count, document_count in zip(*unpack_ngram_years(blocks[jurisdiction_id])):
+                            years[year] = [instance_count, document_count]
+                    for year, (instance_count, document_count) in year_deltas.items():
+                        year_counts = years.setdefault(year, [0, 0])
+                        year_counts[0] += instance_count
+                        year_counts[1] += document_count
+                        if not year_counts[0] and not year_counts[1]:
+                            del years[year]
+                    if years:
+                        blocks[jurisdiction_id] = pack_ngram_years(years)
+                    else:
+                        blocks.pop(jurisdiction_id, None)
+
+                return (True, pack_ngram_value(total, blocks))
+            except Exception:
+                # rocksdb swallows this stack trace, so print before raising
+                traceback.print_exc()
+                raise
+
+        def partial_merge(self, key, left, right):
+            try:
+                deltas = {}
+                total = [0, 0]
+                for op in (left, right):
+                    self.add_operand(op, deltas, total)
+                blocks = {jurisdiction_id: pack_ngram_years(years) for jurisdiction_id, years in deltas.items()}
+                return (True, pack_ngram_value(total, blocks))
             except Exception:
                 # rocksdb swallows this stack trace, so print before raising
                 traceback.print_exc()
@@ -549,6 +772,9 @@ class NgramRocksDB(KVDB):
     def merge(self, k, v, packed=False, batch=None):
         self.db_or_batch(batch).merge(k, self.pack(v, packed))
 
+    def delete(self, k, batch=None):
+        self.db_or_batch(batch).delete(k)
+
     ## readers
 
     def get(self, k, packed=False):
@@ -562,6 +788,121 @@ class NgramRocksDB(KVDB):
                 return
             yield k, self.unpack(v, packed)
 
+    def get_many(self, keys, packed=False):
+        values = self.db.multi_get(keys)
+        return [(k, self.unpack(values.get(k), packed)) for k in keys]
+
+    def load_totals(self):
+        """
+            Return a mapping of jurisdiction-year-length to counts, including totals across jurisdictions and years:
+                {
+                    (<jur_id>, <year>, <length>): [<word count>, <document count>],
+                    (None, <year>, <length>): [<word count>, <document count>],
+                    (None, None, <length>): [<word count>, <document count>],
+                }
+            This scans every totals key; prefer NgramTotalsTable on hot paths.
+        """
+        totals_by_jurisdiction_year_length = defaultdict(lambda: [0,0])
+        for k, v in self.get_prefix(b'totals', packed=True):
+            jur, year, n = self.unpack(k[len(b'totals'):])
+            totals_by_jurisdiction_year_length[(jur, year, n)] = v
+            for total in (
+                totals_by_jurisdiction_year_length[(None, year, n)],
+                totals_by_jurisdiction_year_length[(None, None, n)]
+            ):
+                total[0] += v[0]
+                total[1] += v[1]
+        return totals_by_jurisdiction_year_length
+
+    def totals_table_path(self):
+        return os.path.join(self.path, self.name+".totals")
+
+    def top_completions(self, prefix, count):
+        """
+            Return the top `count` ngram keys starting with prefix by total instance count, as
+            [[b'<n><gram>', <instance_count>], ...], by scanning every key under the prefix.
+        """
+        top = []
+        for k, v in self.get_prefix(prefix):
+            total = ngram_value_total(v)[0]
+            if total <= 0:
+                continue
+            if len(top) < count:
+                heapq.heappush(top, (total, k))
+            elif (total, k) > top[0]:
+                heapq.heapreplace(top, (total, k))
+        return [[k, total] for total, k in sorted(top, reverse=True)]
+
+class NgramTotalsTable:
+    """
+        Read-only, memory-mapped copy of NgramRocksDB.load_totals() plus the jurisdiction id -> slug map, written by
+        scripts.ngrams.write_totals_table() so API workers can share it instead of scanning totals keys per request.
+
+        File layout:
+            b'CAPNGT01'
+            <uint32 header length> <header json: {"version": <hex NGRAM_VERSION_KEY value>, "jurisdictions": {<id>: <slug>}}>
+            <uint64 row count> <padding to 8 bytes>
+            <int64 keys, sorted> -- see table_key()
+            <int64 counts> -- [<word count>, <document count>] for each key
+
+        Usage:
+            table = NgramTotalsTable(path)
+            table[(jur_id, year, n)]  # => [<word count>, <document count>], or [0, 0] if missing
+    """
+    magic = b'CAPNGT01'
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(self.magic)] != self.magic:
+            raise ValueError("%s is not an ngram totals table" % path)
+        pos = len(self.magic)
+        header_length, = struct.unpack_from('<I', self.mmap, pos)
+        pos += 4
+        header = json.loads(self.mmap[pos:pos+header_length])
+        pos += header_length
+        row_count, = struct.unpack_from('<Q', self.mmap, pos)
+        pos += 8
+        pos += -pos % 8
+        self.version = bytes.fromhex(header['version'])
+        self.jurisdiction_id_to_slug = {int(k): v for k, v in header['jurisdictions'].items()}
+        self.keys = np.frombuffer(self.mmap, dtype='<i8', count=row_count, offset=pos)
+        self.counts = np.frombuffer(self.mmap, dtype='<i8', count=row_count*2, offset=pos + row_count*8).reshape(-1, 2)
+
+    @staticmethod
+    def table_key(jurisdiction_id, year, n):
+        """ Pack a (jur_id, year, n) totals key, where jur_id and year may be None, into a sortable int. """
+        jurisdiction_key = 0 if jurisdiction_id is None else jurisdiction_id + 1
+        return (jurisdiction_key << 16 | (year or 0)) << 4 | n
+
+    def __getitem__(self, key):
+        table_key = self.table_key(*key)
+        i = np.searchsorted(self.keys, table_key)
+        if i < len(self.keys) and self.keys[i] == table_key:
+            return self.counts[i].tolist()
+        return [0, 0]
+
+    @classmethod
+    def write(cls, path, version, totals, jurisdiction_id_to_slug):
+        """ Atomically write a table for totals, in the format returned by NgramRocksDB.load_totals(). """
+        rows = sorted((cls.table_key(*k), v[0], v[1]) for k, v in totals.items())
+        keys = np.array([r[0] for r in rows], dtype='<i8')
+        counts = np.array([r[1:] for r in rows], dtype='<i8').reshape(-1, 2)
+        header = json.dumps({
+            'version': (version or b'').hex(),
+            'jurisdictions': {str(k): v for k, v in jurisdiction_id_to_slug.items()},
+        }).encode('utf8')
+        out = bytearray(cls.magic)
+        out += struct.pack('<I', len(header)) + header
+        out += struct.pack('<Q', len(rows))
+        out += bytes(-len(out) % 8)
+        out += keys.tobytes() + counts.tobytes()
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(out)
+        os.replace(temp_path, path)
+
+
 # using SimpleLazyObject lets our tests mock the wrapped object after import
 ngram_kv_store = SimpleLazyObject(lambda: NgramRocksDB())
 ngram_kv_store_ro = SimpleLazyObject(lambda: NgramRocksDB(read_only=True))
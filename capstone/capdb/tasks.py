@@ -1,16 +1,21 @@
+import os
 from copy import copy
 from datetime import datetime, timedelta
-from time import sleep
 
 from celery import shared_task
-from celery.exceptions import Reject
-from elasticsearch import ElasticsearchException, NotFoundError
-from urllib3.exceptions import ReadTimeoutError
+from elasticsearch import NotFoundError
+from elasticsearch.helpers import BulkIndexError
 from django.db.models import Prefetch
 from django.utils import timezone
 
 from capapi.documents import CaseDocument, ResolveDocument
+from capapi.response_cache import advance_response_cache_watermark
 from capdb.models import *
+from scripts import cite_index, cited_by
+from scripts.es_indexer import BulkIndexer, prepare_case_actions
+from scripts.pdf_cache import get_pdf_slice_cache
+from scripts.simhash import get_simhashes
+from scripts.tokenizer import tokenize_many
 
 
 ### HELPERS ###
@@ -113,41 +118,39 @@ def update_elasticsearch_for_vol(self, volume_id):
         Index all cases for given volume with elasticsearch.
     """
     with record_task_status_for_volume(self, volume_id):
-        # fetch cases
+        if not settings.MAINTAIN_ELASTICSEARCH_INDEX:
+            return
         cases = CaseMetadata.objects.filter(volume_id=volume_id).for_indexing()
+        # BulkIndexer retries documents rejected with 429 (too many requests) with backoff, so failures left over are
+        # recorded as a task error for the volume, and can be rerun with `fab populate_search_index:last_run_before=...`
+        failures = BulkIndexer(report_interval=None).index(prepare_case_actions(cases))
+        advance_response_cache_watermark()
+        if failures:
+            raise_bulk_index_error(failures)
 
-        # attempt to store 10 times, with linearly increasing backoff. this gives time for the bulk queue to be processed
-        # if necessary (in which case we'll get BulkIndexError with error 429, too many requests).
-        for i in range(10):
-            try:
-                CaseMetadata.reindex_cases(cases)
-                return
-            except (ElasticsearchException, ReadTimeoutError) as e:
-                if i == 9:
-                    # If all 10 requests fail, re-add job to the back of the queue
-                    if type(e) == BulkIndexError:
-                        # delete submitted data from BulkIndexError, because otherwise error messages are too large to store
-                        for item in e.args[1]:
-                            for v in item.values():
-                                v['data'] = '[data omitted]'
-                    raise Reject('Bulk indexing of volume %s failed: %s' % (volume_id, e), requeue=True)
-                sleep(i)
+
+def raise_bulk_index_error(failures):
+    """ Raise BulkIndexError for {case id: error} returned by BulkIndexer.index(), with a sample of the errors. """
+    raise BulkIndexError('%s case(s) failed to index.' % len(failures), list(failures.items())[:10])
 
 
 @shared_task(acks_late=True)  # use acks_late for tasks that can be safely re-run if they fail
 def update_elasticsearch_from_queue():
     """
-        Index 100 cases that need to be indexed, in a loop, until we run out.
+        Index cases that need to be indexed, settings.ELASTICSEARCH_QUEUE_BATCH_SIZE at a time, until we run out.
+        Cases that fail to index are left in the queue for the next run.
     """
     if not settings.MAINTAIN_ELASTICSEARCH_INDEX:
         return
     batch_size = 100
+    changed = False
 
     # check for deletes
     while True:
         with transaction.atomic(using='capdb'):
             case_ids = list(CaseDeleted.objects.filter(indexed=False).select_for_update(skip_locked=True)[:batch_size].values_list('case_id', flat=True))
             if case_ids:
+                changed = True
                 for case_id in case_ids:
                     try:
                         CaseDocument().delete(id=case_id)
@@ -162,16 +165,54 @@ def update_elasticsearch_from_queue():
                 break
 
     # check for updates
+    batch_size = settings.ELASTICSEARCH_QUEUE_BATCH_SIZE
+    indexer = BulkIndexer()
+    failures = {}
     while True:
         with transaction.atomic(using='capdb'):
-            case_ids = list(CaseLastUpdate.objects.filter(indexed=False).select_for_update(skip_locked=True)[:batch_size].values_list('case_id', flat=True))
+            case_ids = list(CaseLastUpdate.objects
+                .filter(indexed=False)
+                .exclude(case_id__in=list(failures))
+                .select_for_update(skip_locked=True)[:batch_size]
+                .values_list('case_id', flat=True))
             if case_ids:
+                changed = True
                 cases = list(CaseMetadata.objects.filter(id__in=case_ids).for_indexing())
-                CaseMetadata.reindex_cases(cases)
-                CaseLastUpdate.objects.filter(case__in=cases).update(indexed=True)
+                batch_failures = indexer.index(prepare_case_actions(cases))
+                failures.update(batch_failures)
+                CaseLastUpdate.objects.filter(case__in=cases).exclude(case_id__in=list(batch_failures)).update(indexed=True)
             if len(case_ids) < batch_size:
                 break
 
+    # make the changes searchable before invalidating cached API responses, so they can't be cached again stale
+    if changed:
+        CaseDocument._index.refresh()
+        advance_response_cache_watermark()
+
+    if failures:
+        raise_bulk_index_error(failures)
+
+
+@shared_task(acks_late=True)  # use acks_late for tasks that can be safely re-run if they fail
+def update_cite_index():
+    """
+        Apply case and citation changes to the cite index hourly, so new cases are resolved by extract_citations;
+        citations are resolved from the database instead if the index is older than settings.CITE_INDEX_MAX_AGE_HOURS.
+    """
+    if os.path.exists(settings.CITE_INDEX_PATH):
+        cite_index.update_cite_index()
+    else:
+        cite_index.build_cite_index()
+
+
+@shared_task(acks_late=True)  # use acks_late for tasks that can be safely re-run if they fail
+def build_cited_by_index():
+    """
+        Rebuild the cited-by index daily, so cites_to__* filters keep up with new citations; filters stop using an
+        index older than settings.CITED_BY_INDEX_MAX_AGE_HOURS.
+    """
+    cited_by.build_cited_by_index()
+
 
 @shared_task(bind=True, acks_late=True)  # use acks_late for tasks that can be safely re-run if they fail
 def sync_from_initial_metadata_for_vol(self, volume_id, force):
@@ -189,13 +230,13 @@ def sync_from_initial_metadata_for_vol(self, volume_id, force):
 
 
 @shared_task(bind=True, acks_late=True)  # use acks_late for tasks that can be safely re-run if they fail
-def sync_case_body_cache_for_vol(self, volume_id, rerender=True):
+def sync_case_body_cache_for_vol(self, volume_id, rerender=True, processes=None):
     """
         call sync_case_body_cache on cases in given volume
     """
     with record_task_status_for_volume(self, volume_id):
         volume = VolumeMetadata.objects.get(pk=volume_id)
-        volume.sync_case_body_caches(rerender=rerender)
+        volume.sync_case_body_caches(rerender=rerender, processes=processes)
 
 
 @shared_task(bind=True, acks_late=True)  # use acks_late for tasks that can be safely re-run if they fail
@@ -210,12 +251,31 @@ def run_text_analysis_for_vol(self, volume_id):
              .select_related('body_cache', 'structure')
              .defer('body_cache__xml', 'body_cache__html', 'body_cache__json'))
         blocks_by_id = PageStructure.blocks_by_id(volume.page_structures.all())
-        for case_metadata in query:
-            all_analyses.extend(case_metadata.run_text_analysis(blocks_by_id, save=False))
+        case_metadatas = list(query)
+        texts = [c.body_cache.text for c in case_metadatas]
+        simhashes = get_simhashes(texts)
+        words_by_case = tokenize_many(texts, settings.TEXT_ANALYSIS_TOKENIZER_VERSION)
+        for case_metadata, simhash, words in zip(case_metadatas, simhashes, words_by_case):
+            all_analyses.extend(case_metadata.run_text_analysis(blocks_by_id, save=False, simhash=simhash, words=words))
         if all_analyses:
             CaseAnalysis.bulk_upsert(all_analyses)
 
 
+@shared_task(bind=True, acks_late=True)  # use acks_late for tasks that can be safely re-run if they fail
+def warm_pdf_cache_for_vol(self, volume_id):
+    """
+        slice the PDF for each case in given volume into the PDF slice cache
+    """
+    pdf_cache = get_pdf_slice_cache()
+    if pdf_cache is None:
+        return
+    with record_task_status_for_volume(self, volume_id):
+        volume = VolumeMetadata.objects.get(pk=volume_id)
+        for case in volume.case_metadatas.all():
+            if case.pdf_available():
+                pdf_cache.warm(volume.pdf_file.path, case.first_page_order, case.last_page_order, volume.redacted)
+        pdf_cache.evict()
+
 def create_case_metadata_from_all_vols(update_existing=False):
     """
         iterate through all volumes, call celery task for each volume
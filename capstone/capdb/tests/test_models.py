@@ -1,16 +1,19 @@
 from io import StringIO
 from textwrap import dedent
 
+import fitz
 import pytest
 import re
 
+from django.core.cache import cache
 from django.utils.text import slugify
 
 from capdb.models import CaseMetadata, CaseImage, fetch_relations, Court, EditLog, CaseBodyCache, VolumeMetadata
 from capdb.storages import CapFileStorage
-from capdb.tasks import retrieve_images_from_cases, update_elasticsearch_from_queue
+from capdb.tasks import retrieve_images_from_cases, update_elasticsearch_from_queue, warm_pdf_cache_for_vol
 from test_data.test_fixtures.helpers import xml_equal, set_case_text, html_equal
 from capapi.documents import CaseDocument
+from scripts.pdf_cache import get_metrics, get_pdf_slice_cache
 
 
 ### test our model helpers ###
@@ -375,3 +378,45 @@ def test_extract_page_image(volume_metadata):
     volume_metadata.save()
     images = volume_metadata.extract_page_images(1)
     assert b'\x89PNG' in images[0]
+
+
+### Slice case PDFs from volume PDFs with the PDF slice cache ###
+
+@pytest.mark.django_db(databases=['capdb'])
+def test_pdf_slice_cache(case_factory, settings, tmp_path):
+    settings.PDF_CACHE_DIR = str(tmp_path)
+    case = case_factory(volume__pdf_file="fake_volume.pdf", volume__redacted=False, first_page_order=1, last_page_order=2)
+
+    def get_pdf_and_metrics():
+        before = get_metrics()
+        pdf = case.get_pdf()
+        assert len(fitz.open(stream=pdf, filetype='pdf')) == 2
+        return pdf, {k: v - before[k] for k, v in get_metrics().items()}
+
+    # first request slices volume PDF, second is served from cache
+    pdf, metrics = get_pdf_and_metrics()
+    assert metrics == {'hits': 0, 'misses': 1, 'evictions': 0}
+    assert get_pdf_and_metrics() == (pdf, {'hits': 1, 'misses': 0, 'evictions': 0})
+
+    # redaction state is part of the cache key
+    case.volume.redacted = True
+    assert get_pdf_and_metrics()[1] == {'hits': 0, 'misses': 1, 'evictions': 0}
+
+    # least recently used slices are evicted when cache is full
+    pdf_cache = get_pdf_slice_cache()
+    settings.PDF_CACHE_MAX_BYTES = pdf_cache.size() - 1
+    case.volume.redacted = False
+    assert get_pdf_and_metrics()[1] == {'hits': 1, 'misses': 0, 'evictions': 0}
+    case.first_page_order = 2
+    case.get_pdf()
+    assert get_metrics()['evictions'] >= 1
+    assert pdf_cache.size() <= settings.PDF_CACHE_MAX_BYTES
+    assert cache.get(pdf_cache.size_key) == pdf_cache.size()
+
+    # warm-up task slices every case in the volume
+    case.first_page_order = 1
+    case.save()
+    settings.PDF_CACHE_MAX_BYTES = 10 * 1024**2
+    warm_pdf_cache_for_vol(case.volume_id)
+    case.refresh_from_db()
+    assert get_pdf_and_metrics()[1] == {'hits': 1, 'misses': 0, 'evictions': 0}
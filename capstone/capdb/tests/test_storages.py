@@ -42,3 +42,26 @@ def test_isdir(file_storage):
 
     assert file_storage.isdir('a')
     assert not file_storage.isdir('a/b.txt')
+
+
+def test_ngram_merge_operator(tmpdir):
+    from capdb.storages import NgramRocksDB, NGRAM_VALUE_VERSION, ngram_value_total
+    db = NgramRocksDB(path=str(tmpdir))
+
+    # observations are merged into the compact encoding
+    db.merge(b'\1foo', (1, 100, 2, 1), packed=True)
+    db.merge(b'\1foo', (2, 100, 1, 1), packed=True)
+    db.merge(b'\1foo', (1, 101, 1, 1), packed=True)
+    raw = db.get(b'\1foo')
+    assert raw[0] == NGRAM_VALUE_VERSION
+    assert ngram_value_total(raw) == [4, 3]
+    assert db.get(b'\1foo', packed=True) == {None: {None: [4, 3], 100: [3, 2], 101: [1, 1]}, 1: [100, 2, 1, 101, 1, 1], 2: [100, 1, 1]}
+
+    # negative observations remove jurisdiction-years
+    db.merge(b'\1foo', (2, 100, -1, -1), packed=True)
+    assert db.get(b'\1foo', packed=True) == {None: {None: [3, 2], 100: [2, 1], 101: [1, 1]}, 1: [100, 2, 1, 101, 1, 1]}
+
+    # legacy msgpack values are converted on merge
+    db.put(b'\1bar', {None: {None: [1, 1], 100: [1, 1]}, 1: [100, 1, 1]}, packed=True)
+    db.merge(b'\1bar', (1, 100, 1, 1), packed=True)
+    assert db.get(b'\1bar', packed=True) == {None: {None: [2, 2], 100: [2, 2]}, 1: [100, 2, 2]}
@@ -22,12 +22,16 @@ from capdb.tasks import get_case_count_for_jur, get_court_count_for_jur, \
     update_elasticsearch_from_queue, run_text_analysis_for_vol
 
 import fabfile
+from scripts.citation_graph import CitationGraph
 from test_data.test_fixtures.helpers import get_timestamp, check_timestamps_changed, check_timestamps_unchanged, \
     set_case_text
 
 
 @pytest.mark.django_db(databases=['capdb'])
-def test_export_cases(case_factory, tmp_path, django_assert_num_queries, elasticsearch, monkeypatch):
+@pytest.mark.parametrize("processes", [1, 3])
+def test_export_cases(case_factory, tmp_path, django_assert_num_queries, elasticsearch, monkeypatch, settings, processes):
+    # with 3 processes, some slices are empty, so data files include empty xz streams
+    settings.EXPORT_PROCESSES = processes
     version = date.today().strftime('%Y%m%d')
     case1 = case_factory(jurisdiction__slug="aaa", volume__reporter__short_name="aaa", jurisdiction__whitelisted=False)
     case2 = case_factory(jurisdiction__slug="bbb", volume__reporter__short_name="bbb", jurisdiction__whitelisted=True)
@@ -358,6 +362,41 @@ def test_extract_citations(reset_sequences, case_factory, elasticsearch, client,
     assert set(new_ids) == (set(old_ids) | {new_id}) - {old_id}
 
 
+@pytest.mark.django_db(databases=['capdb'], transaction=True)
+def test_extract_citations_with_cite_index(case_factory, settings, tmp_path):
+    settings.CITE_INDEX_PATH = str(tmp_path / 'cite.index')
+    targets = [case_factory(citations__cite="1 U.S. 1", decision_date=datetime(1900, 1, 1)) for _ in range(2)]
+    case = case_factory(decision_date=datetime(2000, 1, 1))
+    set_case_text(case, "Foo v. Bar, 1 U.S. 1. Baz v. Qux, 2 U.S. 2.")
+
+    def get_extracted_cites():
+        case.refresh_from_db()
+        return case.body_cache.html, list(case.extracted_citations.order_by('cite').values_list('cite', 'target_cases'))
+
+    # cites resolve the same way from the index as from the database
+    case.sync_case_body_cache()
+    db_result = get_extracted_cites()
+    fabfile.build_cite_index()
+    case.sync_case_body_cache()
+    assert get_extracted_cites() == db_result
+    assert db_result[1] == [('1 U.S. 1', [t.id for t in targets]), ('2 U.S. 2', [])]
+
+    # new cites are picked up when the index is updated
+    target = case_factory(citations__cite="2 U.S. 2", decision_date=datetime(1900, 1, 1))
+    case.sync_case_body_cache()
+    assert get_extracted_cites()[1][1] == ('2 U.S. 2', [])
+    fabfile.update_cite_index()
+    case.sync_case_body_cache()
+    assert get_extracted_cites()[1][1] == ('2 U.S. 2', [target.id])
+
+    # a stale index is ignored in favor of the database
+    new_target = case_factory(citations__cite="3 U.S. 3", decision_date=datetime(1900, 1, 1))
+    set_case_text(case, "Foo v. Bar, 3 U.S. 3.")
+    settings.CITE_INDEX_MAX_AGE_HOURS = 0
+    case.sync_case_body_cache()
+    assert get_extracted_cites()[1] == [('3 U.S. 3', [new_target.id])]
+
+
 @pytest.mark.django_db(databases=['capdb'])
 def test_update_elasticsearch_for_vol(three_cases, volume_metadata, django_assert_num_queries, elasticsearch):
     with django_assert_num_queries(select=2, update=1):
@@ -380,7 +419,7 @@ def test_sync_case_body_cache_for_vol(volume_metadata, case_factory, django_asse
         ('char_count', 47),
         ('ocr_confidence', 1.0),
         ('sha256', 'da95df9d6d5d506285c9a8f9010560fa57905f64b3e94748b8854d678e18f0cc'),
-        ('simhash', '1:6e45862a08eb1d4c'),
+        ('simhash', '2:f4b2916730c69937'),
         ('word_count', 11)
     ]
     for case in cases:
@@ -393,6 +432,33 @@ def test_sync_case_body_cache_for_vol(volume_metadata, case_factory, django_asse
     assert all(c.text == 'Case text 0\nCase text 1Case text 2\nCase text 3\n' for c in CaseBodyCache.objects.all())
 
 
+
+@pytest.mark.django_db(databases=['capdb'], transaction=True)
+def test_sync_case_body_cache_for_vol_in_processes(volume_metadata, case_factory):
+    cases = [case_factory(volume=volume_metadata, citations__cite="%s U.S. 1" % (i + 1)) for i in range(3)]
+    set_case_text(cases[0], "Foo v. Bar, 2 U.S. 1.")
+
+    def get_results():
+        return [(
+            c.body_cache.html, c.body_cache.xml, c.body_cache.text, c.body_cache.json,
+            sorted((a.key, a.value) for a in c.analysis.all()),
+            list(c.extracted_citations.values_list('cite', 'target_cases')),
+        ) for c in CaseMetadata.objects.filter(volume=volume_metadata).select_related('body_cache').order_by('id')]
+
+    # rendering in worker processes gives the same results as rendering in this process
+    sync_case_body_cache_for_vol(volume_metadata.barcode, processes=1)
+    expected = get_results()
+    assert expected[0][5] == [('2 U.S. 1', [cases[1].id])]
+    CaseBodyCache.objects.update(html='', xml='', text='blank')
+    ExtractedCitation.objects.all().delete()
+    sync_case_body_cache_for_vol(volume_metadata.barcode, processes=2)
+    assert get_results() == expected
+
+    # text/json sync
+    CaseBodyCache.objects.update(text='blank')
+    sync_case_body_cache_for_vol(volume_metadata.barcode, rerender=False, processes=2)
+    assert get_results() == expected
+
 @pytest.mark.django_db(databases=['capdb'], transaction=True)
 def test_run_text_analysis(reset_sequences, case):
     timestamp = get_timestamp(case)
@@ -405,7 +471,7 @@ def test_run_text_analysis(reset_sequences, case):
         ('char_count', 11),
         ('ocr_confidence', 1.0),
         ('sha256', 'c66397f6ebb7b7e5dfd7191e81ee17db2d8c92bcb45f0c41b1e1c5307334622e'),
-        ('simhash', '1:025d04b98eb62906'),
+        ('simhash', '2:c0f10bdd2ec49921'),
         ('word_count', 3)
     ]
     assert sorted((a.key, a.value) for a in case.analysis.all()) == expected_analysis
@@ -508,6 +574,55 @@ def test_export_citation_graph(case_factory, tmpdir, citation_factory, jurisdict
     for r in results:  # check 'cites' column
         assert set(c.cite for c in Citation.objects.filter(case_id=r['id'])) == set(r['cites'].split('; '))
 
+    # check CSR graph
+    graph = CitationGraph.load(output_folder / "csr")
+    assert graph.ids.tolist() == sorted([case_from.id, case_to.id, another_case_to.id, different_jur_case.id])
+    assert graph.jurisdiction_ids[graph.index_of(case_from.id)] == jur1.id
+    assert graph.years[graph.index_of(case_from.id)] == 2000
+
+    # check aggregations
+    totals = json.loads(output_folder.joinpath("aggregations", "totals.json").read_text())
+    assert totals == {str(jur1.id): {str(jur1.id): 1, str(jur3.id): 1}, str(jur2.id): {str(jur1.id): 1}}
+
+    # resuming regenerates files derived from the graph
+    jur_folder.joinpath("README.md").unlink()
+    fabfile.export_citation_graph(output_folder=str(output_folder), resume="true")
+    assert jur_folder.joinpath("README.md").read_text().endswith("\n* Nodes: 2\n* Edges: 1\n")
+
+
+@pytest.mark.django_db(databases=['capdb'], transaction=True)
+def test_update_citation_graph(case_factory, tmp_path, capsys):
+    cite_to, cite_from = "1 U.S. 1", "2 U.S. 2"
+    case_to = case_factory(citations__cite=cite_to, decision_date=datetime(1990, 1, 1))
+    case_from = case_factory(citations__cite=cite_from, decision_date=datetime(2000, 1, 1))
+    set_case_text(case_from, f"Cite to case: {cite_to}")
+    case_from.sync_case_body_cache()
+    fabfile.export_citation_graph(output_folder=str(tmp_path))
+    assert case_from.analysis.get(key='pagerank').value['percentile'] == 0
+    assert case_to.analysis.get(key='pagerank').value['percentile'] == 0.5
+    timestamps = [get_timestamp(c) for c in (case_to, case_from)]
+
+    # add a case citing case_to
+    new_case = case_factory(citations__cite="3 U.S. 3", decision_date=datetime(2010, 1, 1))
+    set_case_text(new_case, f"Cite to case: {cite_to}")
+    new_case.sync_case_body_cache()
+    fabfile.update_citation_graph(output_folder=str(tmp_path))
+
+    # graph includes new citation
+    graph = CitationGraph.load(tmp_path / "csr")
+    assert graph.ids[graph.cited(graph.index_of(new_case.id))].tolist() == [case_to.id]
+
+    # only scores with changed percentiles are written
+    assert new_case.analysis.get(key='pagerank').value['percentile'] == 0
+    assert case_to.analysis.get(key='pagerank').value['percentile'] == 2/3
+    check_timestamps_changed(case_to, timestamps[0])
+    check_timestamps_unchanged(case_from, timestamps[1])
+
+    # writing pagerank scores doesn't count as a citation change
+    capsys.readouterr()
+    fabfile.update_citation_graph(output_folder=str(tmp_path))
+    assert "Found 0 changed cases" in capsys.readouterr().out
+
 
 @pytest.mark.django_db(databases=['capdb'], transaction=True)
 def test_pagerank(tmp_path, reset_sequences, three_cases):
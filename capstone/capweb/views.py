@@ -38,6 +38,7 @@ from capdb.storages import download_files_storage
 from capapi.resources import form_for_request, api_request
 from capweb.templatetags.docs_url import docs_url
 from config.logging import logger
+from scripts.cite_index import get_cite_index
 from scripts.extract_cites import extract_citations_normalized
 
 
@@ -404,18 +405,23 @@ def fetch(request):
             }
             normalized_cites = list(cite_lookup.keys())
 
-            es_cases = CaseDocument.search().query(
-                Q(
-                    'bool',
-                    should=[
-                        Q("terms", citations__normalized_cite=normalized_cites),
-                        Q("terms", citations__rdb_normalized_cite=normalized_cites),
-                    ]
-                )
-            ).source(
-                includes=['id']
-            ).execute()
-            cases = CaseMetadata.objects.filter(id__in=[c.id for c in es_cases]).prefetch_related('citations')
+            cite_index = get_cite_index()
+            if cite_index:
+                case_ids = cite_index.case_ids(normalized_cites, ['normalized_cite', 'rdb_normalized_cite'])
+            else:
+                es_cases = CaseDocument.search().query(
+                    Q(
+                        'bool',
+                        should=[
+                            Q("terms", citations__normalized_cite=normalized_cites),
+                            Q("terms", citations__rdb_normalized_cite=normalized_cites),
+                        ]
+                    )
+                ).source(
+                    includes=['id']
+                ).execute()
+                case_ids = [c.id for c in es_cases]
+            cases = CaseMetadata.objects.filter(id__in=case_ids).prefetch_related('citations')
 
             # get possible cases matching each extracted cite
             cases_by_cite = defaultdict(set)
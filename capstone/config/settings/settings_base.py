@@ -390,6 +390,18 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'capdb.tasks.update_elasticsearch_from_queue',
         'schedule': crontab(),
     },
+    'reconcile-case-allowances': {
+        'task': 'capapi.tasks.reconcile_case_allowances',
+        'schedule': crontab(),
+    },
+    'update-cite-index': {
+        'task': 'capdb.tasks.update_cite_index',
+        'schedule': crontab(minute=30),
+    },
+    'build-cited-by-index': {
+        'task': 'capdb.tasks.build_cited_by_index',
+        'schedule': crontab(hour=3, minute=0),
+    },
 }
 CELERY_TIMEZONE = 'UTC'
 CELERY_TASK_ROUTES = {
@@ -401,6 +413,14 @@ CELERY_TASK_ROUTES = {
 
 API_CASE_DAILY_ALLOWANCE = 500
 API_CASE_EXPIRE_HOURS = 24
+# 'database' locks the user and SiteLimits rows to count case downloads; 'redis' counts them with atomic redis counters
+# (see capapi.case_allowance), written back to the database by capapi.tasks.reconcile_case_allowances
+API_CASE_ALLOWANCE_COUNTERS = 'database'
+# cache rendered json responses to anonymous /cases/ and /ngrams/ requests in redis (see capapi.response_cache);
+# invalidated when update_elasticsearch_from_queue or an ngram build changes the data
+API_RESPONSE_CACHE = False
+API_RESPONSE_CACHE_TIMEOUT = 60*60*24  # seconds to keep each cached response
+API_RESPONSE_CACHE_MAX_BYTES = 2*1024*1024  # larger responses aren't cached
 API_BASE_URL_ROUTE = '/api'
 API_VERSION = 'v1'
 API_DOCS_CASE_ID = 2
@@ -519,8 +539,40 @@ LOGIN_URL = 'login'
 
 # directories to search for nltk data
 NLTK_PATH = [os.path.join(SERVICES_DIR, 'nltk')]
+# parameters of nltk's english punkt model, for tokenizer version 2; see scripts.tokenizer.export_punkt_params
+PUNKT_PARAMS_PATH = os.path.join(SERVICES_DIR, 'nltk/tokenizers/punkt/PY3/english.json')
+
+# scripts.tokenizer version used for ngrams and for word counts in text analysis
+NGRAM_TOKENIZER_VERSION = 1
+TEXT_ANALYSIS_TOKENIZER_VERSION = 1
+
+# worker processes used to render each volume in sync_case_body_caches; 1 renders in the calling process. Each celery
+# worker running sync_case_body_cache_for_vol forks its own pool, so a host runs up to celery concurrency * N renderers.
+SYNC_CASE_BODY_CACHE_PROCESSES = 1
+# sliced scrolls exported in parallel by each bulk export task; 1 exports in the calling process. Each celery worker
+# running an export task forks its own pool, so a host runs up to celery concurrency * N exporters.
+EXPORT_PROCESSES = 1
 
 NGRAM_THREAD_COUNT = 4
+NGRAM_SPILL_THRESHOLD = 2000000  # max distinct grams per length each ngram worker holds in memory before spilling to disk
+NGRAM_SPILL_DIR = None  # where ngram workers write sorted run files; defaults to the system temp dir
+NGRAM_WILDCARD_TOP_N = 10  # number of completions stored per prefix in the wildcard index; must be at least 10
+
+SIMHASH_INDEX_PATH = os.path.join(BASE_DIR, 'test_data/simhash.index')  # written by fab build_simhash_index
+SIMHASH_INDEX_BANDS = 3  # bands per simhash in the index; about 64 / log2(document count) is fastest to query
+SIMHASH_MAX_DISTANCE = 13  # max bits that may differ for near-duplicate search
+SIMHASH_DEFAULT_DISTANCE = 6
+
+PAGERANK_PERCENTILE_TOLERANCE = 0.001  # update_citation_graph only rewrites pagerank scores whose percentile moves more than this
+
+CITE_INDEX_PATH = os.path.join(BASE_DIR, 'test_data/cite.index')  # written by fab build_cite_index; citations are resolved from the database until it exists
+CITE_INDEX_MAX_AGE_HOURS = 3  # updated hourly by capdb.tasks.update_cite_index; citations are resolved from the database if it's older than this
+CITED_BY_INDEX_PATH = os.path.join(BASE_DIR, 'test_data/cited_by.index')  # written by fab build_cited_by_index; cites_to__* filters search for cited case ids until it exists
+CITED_BY_INDEX_MAX_AGE_HOURS = 48  # rebuilt daily by capdb.tasks.build_cited_by_index; cites_to__* filters search instead if it's older than this
+STATIC_PATH_TABLE_PATH = os.path.join(BASE_DIR, 'test_data/static_paths.table')  # written by fab set_case_static_file_names; set to None to look up paths in the database
+
+PDF_CACHE_DIR = os.path.join(BASE_DIR, 'test_data/pdf_cache')  # case PDFs sliced from volume PDFs; set to None to slice on every request
+PDF_CACHE_MAX_BYTES = 10 * 1024**3
 
 # feature flags
 SCREENSHOT_FEATURE = False
@@ -576,6 +628,22 @@ ELASTICSEARCH_DSL={
 }
 ELASTICSEARCH_DSL_AUTO_REFRESH = False  # don't force a reindex on every write to ES; let ES do it routinely instead
 MAINTAIN_ELASTICSEARCH_INDEX = True  # whether to update index when changing cases
+# where API responses get case xml and html: None stores them in the elasticsearch _source; 'postgres' leaves them out
+# and reads them from CaseBodyCache; 'file' also reads them from BODY_STORE_PATH, written by fab build_body_store.
+# Cases must be reindexed after changing this.
+ELASTICSEARCH_BODY_STORE = None
+BODY_STORE_PATH = os.path.join(BASE_DIR, 'test_data/body.store')
+ELASTICSEARCH_QUEUE_BATCH_SIZE = 1000  # cases locked and indexed at a time by update_elasticsearch_from_queue
+# bulk indexer used by update_elasticsearch_from_queue and update_elasticsearch_for_vol; see scripts/es_indexer.py
+ELASTICSEARCH_INDEXER_PROCESSES = 1  # worker processes preparing documents, forked by each celery worker that indexes; 1 prepares in the calling process
+ELASTICSEARCH_INDEXER_THREADS = 4  # concurrent bulk requests
+ELASTICSEARCH_INDEXER_CHUNK_BYTES = 5 * 1024**2  # starting size of bulk requests, adjusted toward TARGET_SECONDS per request
+ELASTICSEARCH_INDEXER_MIN_CHUNK_BYTES = 256 * 1024
+ELASTICSEARCH_INDEXER_MAX_CHUNK_BYTES = 50 * 1024**2  # must be below the server's http.max_content_length
+ELASTICSEARCH_INDEXER_TARGET_SECONDS = 2
+ELASTICSEARCH_INDEXER_MAX_RETRIES = 8  # retries of documents rejected with 429
+ELASTICSEARCH_INDEXER_INITIAL_BACKOFF = 1  # seconds; doubled for each retry
+ELASTICSEARCH_INDEXER_MAX_BACKOFF = 60
 
 ELASTICSEARCH_INDEXES={
     'cases_endpoint': 'cases',
@@ -584,6 +652,10 @@ ELASTICSEARCH_INDEXES={
 MAX_PAGE_SIZE = 10000
 MAX_RESULT_WINDOW = 50000  # must be at least MAX_PAGE_SIZE+1, or number needed for parallel_execute()
 MAX_JOINED_RESULTS = 20000 # max for cites_to parallel_execute search
+MAX_CITED_BY_RESULTS = 2 ** 16  # max citing cases for a cites_to__* filter answered from the cited-by index; elasticsearch's default max_terms_count
+PARALLEL_SEARCH_THREADS = 20  # concurrent slice searches run by parallel_execute(), per process
+PARALLEL_SEARCH_TIMEOUT = 30  # seconds allowed for each parallel_execute() slice search
+STREAM_BATCH_SIZE = 1000  # results fetched and serialized at a time for /cases/?stream=, with case allowances updated per batch
 
 SCREENSHOT_DEFAULT_TIMEOUT = 30  # seconds
 
@@ -1,3 +1,5 @@
+import tempfile
+
 from .settings_dev import *  # noqa
 
 TESTING = True
@@ -27,3 +29,11 @@ STATICFILES_STORAGE = 'pipeline.storage.PipelineStorage'
 INSTALLED_APPS.remove('django.contrib.staticfiles')
 
 USAGE_LOG_PATH = '/tmp/pytest_access.log'
+PDF_CACHE_DIR = None  # tests opt in
+STATIC_PATH_TABLE_PATH = None  # tests opt in
+
+# tests that build indexes write them to a temp dir instead of test_data/
+INDEX_DIR = tempfile.mkdtemp()
+SIMHASH_INDEX_PATH = os.path.join(INDEX_DIR, 'simhash.index')
+CITE_INDEX_PATH = os.path.join(INDEX_DIR, 'cite.index')
+CITED_BY_INDEX_PATH = os.path.join(INDEX_DIR, 'cited_by.index')
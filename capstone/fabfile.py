@@ -31,7 +31,7 @@ except Exception as e:
     )
 
 from django.core import management
-from django.db import connections, transaction
+from django.db import transaction
 from django.db.models import Prefetch, Min, Max
 from django.utils import timezone
 from django.utils.encoding import force_bytes
@@ -466,6 +466,7 @@ def set_case_static_file_names():
 def export_cap_static_volumes(dest_dir="/tmp/cap_exports", reporter=None, volume=None, last_run_before=None):
     """
     First step of the static files export process: export cases, one celery task per volume.
+    Volumes already in dest_dir are skipped if their ExportManifest.json shows their inputs haven't changed.
     """
     print("Scheduling tasks to reindex volumes")
     volumes = VolumeMetadata.objects.exclude(out_of_scope=True)
@@ -803,6 +804,25 @@ def ngram_jurisdictions(slug=None):
     ngram_jurisdictions(slug)
 
 
+@task
+def update_ngrams_from_queue():
+    """
+        Apply pending case changes and deletions to the ngram database. Databases built before per-case ledgers were
+        added must be deleted and rebuilt with ngram_jurisdictions first.
+    """
+    from scripts.ngrams import update_ngrams_from_queue
+
+    update_ngrams_from_queue()
+
+
+@task
+def migrate_ngram_values():
+    """Rewrite ngram values stored in the legacy msgpack format in the compact columnar format."""
+    from scripts.ngrams import migrate_ngram_values
+
+    migrate_ngram_values()
+
+
 @task
 def url_to_js_string(
     target_url="http://case.test:8000/maintenance/?no_toolbar",
@@ -1095,9 +1115,13 @@ def load_token_streams(replace_existing=False):
 
 @task
 def refresh_case_body_cache(
-    last_run_before=None, rerender=True, volume=None, if_missing=False
+    last_run_before=None, rerender=True, volume=None, if_missing=False, processes=None
 ):
-    """Recreate CaseBodyCache for all cases. Use `fab refresh_case_body_cache:rerender=false` to just regenerate text/json from html."""
+    """
+    Recreate CaseBodyCache for all cases. Use `fab refresh_case_body_cache:rerender=false` to just regenerate text/json from html.
+    Use processes=N to render each volume with N worker processes, e.g. for a single huge volume. Each celery worker
+    forks its own N processes, so keep celery concurrency * N within the host's cores.
+    """
     volumes = VolumeMetadata.objects.filter(out_of_scope=False)
     if volume:
         volumes = volumes.filter(pk=volume)
@@ -1111,9 +1135,34 @@ def refresh_case_body_cache(
         volumes,
         last_run_before=last_run_before,
         rerender=rerender != "false",
+        processes=int(processes) if processes else None,
     )
 
 
+@task
+def benchmark_json_extraction(count=1000):
+    """Time json/text extraction from rendered html for a sample of cases, single pass vs. PyQuery."""
+    import time
+    from capdb.models import CaseBodyCache
+    from scripts.render_case import extract_json_from_html
+    from scripts.tests.test_render_case import extract_json_from_html_pyquery
+
+    htmls = list(CaseBodyCache.objects.exclude(html=None).values_list('html', flat=True)[:int(count)])
+    if not htmls:
+        print("No rendered cases found")
+        return
+    timings = {}
+    for extract in (extract_json_from_html_pyquery, extract_json_from_html):
+        start = time.perf_counter()
+        for html in htmls:
+            extract(html)
+        timings[extract.__name__] = time.perf_counter() - start
+    old, new = timings['extract_json_from_html_pyquery'], timings['extract_json_from_html']
+    print("%s cases, %s bytes of html" % (len(htmls), sum(len(html) for html in htmls)))
+    print("PyQuery: %.2fms per case" % (1000 * old / len(htmls)))
+    print("Single pass: %.2fms per case (%.1fx)" % (1000 * new / len(htmls), old / new))
+
+
 @task
 def update_elasticsearch_from_queue():
     """Make sure all pending case changes have been recorded in elasticsearch."""
@@ -1130,6 +1179,59 @@ def run_text_analysis(last_run_before=None):
     )
 
 
+@task
+def compare_tokenizers(count=1000, new_version=2, old_version=1):
+    """Check that two tokenizer versions produce the same tokens for a sample of cases, and time them."""
+    import time
+    from capdb.models import CaseBodyCache
+    from scripts.tokenizer import tokenize_many
+
+    texts = list(CaseBodyCache.objects.exclude(text=None).values_list('text', flat=True)[:int(count)])
+    timings = {}
+    tokens = {}
+    for version in (int(old_version), int(new_version)):
+        start = time.perf_counter()
+        tokens[version] = tokenize_many(texts, version)
+        timings[version] = time.perf_counter() - start
+    mismatches = sum(1 for old, new in zip(tokens[int(old_version)], tokens[int(new_version)]) if old != new)
+    print("%s cases, %s mismatched" % (len(texts), mismatches))
+    for version, timing in timings.items():
+        print("Version %s: %.2fs" % (version, timing))
+
+
+@task
+def export_punkt_params():
+    """Export nltk's english punkt model for tokenizer version 2. Run after updating nltk or its punkt data."""
+    from scripts.tokenizer import export_punkt_params
+
+    export_punkt_params()
+
+
+@task
+def warm_pdf_cache(volume=None, last_run_before=None):
+    """Slice case PDFs for all volumes with PDFs, or for a single volume barcode, into the PDF slice cache."""
+    volumes = VolumeMetadata.objects.exclude(out_of_scope=True).exclude(pdf_file="")
+    if volume:
+        volumes = volumes.filter(pk=volume)
+    tasks.run_task_for_volumes(tasks.warm_pdf_cache_for_vol, volumes, last_run_before=last_run_before)
+
+
+@task
+def pdf_cache_stats():
+    """Print PDF slice cache hit, miss and eviction counts, and current size."""
+    from scripts.pdf_cache import get_metrics, get_pdf_slice_cache
+
+    metrics = get_metrics()
+    lookups = metrics['hits'] + metrics['misses']
+    print("Hits: %s, misses: %s, evictions: %s" % (metrics['hits'], metrics['misses'], metrics['evictions']))
+    if lookups:
+        print("Hit rate: %.1f%%" % (100 * metrics['hits'] / lookups))
+    pdf_cache = get_pdf_slice_cache()
+    if pdf_cache:
+        print("Size: %s of %s bytes" % (pdf_cache.size(), pdf_cache.max_bytes))
+    else:
+        print("PDF slice cache is disabled")
+
 @task
 def sync_from_initial_metadata(last_run_before=None, force=False):
     """Call sync_from_initial_metadata on all cases. Use force=1 to re-run on already synced cases (not recommended)."""
@@ -1384,6 +1486,7 @@ def download_pdfs(jurisdiction=None):
             volume.pdf_file.name = str(new_path)
             volume.save()
             print("  - Downloaded to %s" % new_path)
+            tasks.warm_pdf_cache_for_vol.delay(volume.pk)
         except Exception:
             # clean up partial downloads if process is killed
             download_files_storage.delete(str(new_path))
@@ -1467,224 +1570,31 @@ def populate_case_page_order():
 
 
 @task
-def export_citation_graph(output_folder="graph"):
-    """writes cited from and citing to to file"""
-    from django.utils import timezone
-    from django.contrib.postgres.aggregates import ArrayAgg
+def export_citation_graph(output_folder="graph", resume="false"):
+    """writes cited from and citing to to file. Use resume=true to reuse the graph already exported to output_folder."""
+    from scripts.citation_graph import export_citation_graph
 
-    # create path if doesn't exist
     output_folder = Path(output_folder)
-    output_folder.mkdir(parents=True, exist_ok=True)
-    citations_path = output_folder / "citations.csv.gz"
-    citations_path.touch(mode=0o644)  # check that we have write access
-
-    # write citations.csv.gz
-    nodes = set()
-    edge_count = 0
-    chunk_size = 10000
-    query = """
-        DECLARE cite_cursor CURSOR for
-        select
-            cited_by.id, array_agg(distinct target_case.id)
-        from
-            capdb_extractedcitation ec
-            inner join
-                capdb_casemetadata target_case on ec.target_case_id = target_case.id
-            inner join
-                capdb_casemetadata cited_by on ec.cited_by_id = cited_by.id
-            inner join
-                capdb_volumemetadata target_volume on target_case.volume_id = target_volume.barcode
-        where 
-            cited_by.in_scope is true
-            and target_case.in_scope is true
-            and target_volume.out_of_scope is false
-            and cited_by.decision_date_original >= target_case.decision_date_original
-            and cited_by.id != target_case.id
-        group by cited_by.id;
-    """
-    print("Running citations query")
-    with transaction.atomic(using="capdb"), connections[
-        "capdb"
-    ].cursor() as cursor, gzip.open(str(citations_path), "wt") as f, tqdm() as pbar:
-        csv_w = csv.writer(f)
-        cursor.execute(query)
-        while True:
-            cursor.execute("FETCH %s FROM cite_cursor" % chunk_size)
-            chunk = cursor.fetchall()
-            pbar.update()
-            if not chunk:
-                break
-            for row in chunk:
-                out = [row[0]] + row[1]
-                csv_w.writerow(out)
-                nodes.update(out)
-                edge_count += len(out) - 1
-
-    # write README.txt
-    output_folder.joinpath("README.md").write_text(
-        f"Citation graph exported {timezone.now()}:\n\n"
-        f"* Nodes: {len(nodes)}\n"
-        f"* Edges: {edge_count}\n"
-    )
-
-    # write metadata.csv.gz
-    metadata_fields = [
-        "id",
-        "frontend_url",
-        "jurisdiction__name",
-        "jurisdiction_id",
-        "court__name_abbreviation",
-        "court_id",
-        "reporter__short_name",
-        "reporter_id",
-        "name_abbreviation",
-        "decision_date_original",
-        "cites",
-    ]
-    nodes = sorted(nodes)
-    print("Writing metadata")
-    metadata = {}
-    with gzip.open(str(output_folder / "metadata.csv.gz"), "wt") as f:
-        csv_w = csv.writer(f)
-        csv_w.writerow(metadata_fields)
-        query = CaseMetadata.objects.annotate(
-            cites=ArrayAgg("citations__cite")
-        ).values_list(*metadata_fields)
-        for i in tqdm(range(0, len(nodes), chunk_size)):
-            for row in query.filter(id__in=nodes[i : i + chunk_size]):
-                row = row[:-1] + ("; ".join(row[-1]),)  # combine citations
-                metadata[row[0]] = row
-                csv_w.writerow(row)
-
-    ### write outputs per-jurisdiction --
-    print("Writing jurisdiction files")
-
-    # read back through the adjacency list and write each row to the appropriate subfolder
-    jurisdictions = {}
-    jurs_folder = output_folder / "by_jurisdiction"
-    jurs_folder.mkdir(parents=True, exist_ok=True)
-    jurs_folder.joinpath("README.md").write_text(
-        "Subsets of the full graph consisting only of citations between cases within a particular jurisdiction."
-    )
-    with gzip.open(str(citations_path), "rt") as f:
-        reader = csv.reader(f)
-        for ids in tqdm(reader):
-            # filter to only in-jurisdiction cites
-            ids = [int(i) for i in ids]
-            jur_name = metadata[ids[0]][2]
-            ids = [id for id in ids if metadata[id][2] == jur_name]
-            if len(ids) < 2:
-                continue
-
-            # if this is the first time we're seeing this jurisdiction, set up output streams for the
-            # adjacency list and metadata
-            if jur_name not in jurisdictions:
-                jur_folder = jurs_folder / jur_name
-                jur_folder.mkdir(parents=True, exist_ok=True)
-                graph_file = gzip.open(str(jur_folder / "citations.csv.gz"), "wt")
-                graph_file_writer = csv.writer(graph_file)
-                metadata_file = gzip.open(str(jur_folder / "metadata.csv.gz"), "wt")
-                metadata_file_writer = csv.writer(metadata_file)
-                metadata_file_writer.writerow(metadata_fields)
-                nodes = set()
-                jurisdictions[jur_name] = {
-                    "name": jur_name,
-                    "folder": jur_folder,
-                    "nodes": nodes,
-                    "graph_file": graph_file,
-                    "graph_file_writer": graph_file_writer,
-                    "metadata_file": metadata_file,
-                    "metadata_file_writer": metadata_file_writer,
-                    "edge_count": 0,
-                }
+    export_citation_graph(output_folder, resume=resume == "true")
 
-            # write out adjacency list and metadata
-            jur = jurisdictions[jur_name]
-            nodes = jur["nodes"]
-            metadata_file_writer = jur["metadata_file_writer"]
-            jur["graph_file_writer"].writerow(ids)
-            jur["edge_count"] += len(ids) - 1
-            for id in ids:
-                if id not in nodes:
-                    nodes.add(id)
-                    metadata_file_writer.writerow(metadata[id])
-
-    # close streams for each jurisdiction and write out metadata
-    for jur in jurisdictions.values():
-        jur["graph_file"].close()
-        jur["metadata_file"].close()
-        jur["folder"].joinpath("README.md").write_text(
-            f"Citation graph for {jur['name']} exported {timezone.now()}:\n\n"
-            f"* Nodes: {len(jur['nodes'])}\n"
-            f"* Edges: {jur['edge_count']}\n"
-        )
+    print("Calling load_pagerank_scores")
+    load_pagerank_scores(output_folder / "pagerank_scores.csv.gz")
 
-    print("Calling count_cites_by_year")
-    count_cites_by_year(output_folder, output_folder / "aggregations")
 
-    print("Calling calculate_pagerank_scores")
-    calculate_pagerank_scores(
-        output_folder / "citations.csv.gz", output_folder / "pagerank_scores.csv.gz"
-    )
+@task
+def update_citation_graph(output_folder="graph"):
+    """Apply citation changes since the last export or update to the citation graph and its PageRank scores."""
+    from scripts.citation_graph import update_citation_graph
 
-    print("Calling load_pagerank_scores")
-    load_pagerank_scores(output_folder / "pagerank_scores.csv.gz")
+    update_citation_graph(output_folder)
 
 
 @task
 def count_cites_by_year(folder, output_folder):
     """Write summaries from citation graph in folder to output_folder."""
-    folder = Path(folder)
-    output_folder = Path(output_folder)
-    output_folder.mkdir(parents=True, exist_ok=True)
-
-    print("Loading metadata")
-    metadata = {}
-    with gzip.open(str(folder / "metadata.csv.gz"), "rt") as f:
-        for row in tqdm(csv.DictReader(f)):
-            metadata[int(row["id"])] = (
-                int(row["jurisdiction_id"]),
-                int(row["decision_date_original"][:4]),
-            )
-    cites_per_jurisdiction = defaultdict(int)
-    totals = defaultdict(lambda: defaultdict(int))
-    totals_by_year = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
-
-    print("Counting totals")
-    with gzip.open(str(folder / "citations.csv.gz"), "rt") as f:
-        for row in tqdm(csv.reader(f)):
-            from_id, *to_ids = [int(i) for i in row]
-            from_jur_id, year = metadata[from_id]
-            cites_per_jurisdiction[from_jur_id] += len(to_ids)
-            for to_id in to_ids:
-                to_jur_id = metadata[to_id][0]
-                totals[from_jur_id][to_jur_id] += 1
-                totals_by_year[year][from_jur_id][to_jur_id] += 1
-
-    print("Writing output")
-    jurisdiction_metadata = [
-        {
-            "id": j.id,
-            "slug": j.slug,
-            "name": j.name,
-            "name_long": j.name_long,
-            "cites": cites_per_jurisdiction[j.id],
-        }
-        for j in Jurisdiction.objects.filter(
-            id__in=cites_per_jurisdiction.keys()
-        ).order_by("name")
-    ]
-    output_folder.joinpath("jurisdictions.json").write_text(
-        json.dumps(jurisdiction_metadata)
-    )
-    output_folder.joinpath("totals.json").write_text(json.dumps(totals))
-    output_folder.joinpath("totals_by_year.json").write_text(json.dumps(totals_by_year))
-    output_folder.joinpath("README.md").write_text(
-        "This directory contains aggregations of data by jurisdiction from the citation graph:\n\n"
-        "* jurisdictions.json: citation counts by citing jurisdiction\n"
-        "* totals.json: citation counts from each jurisdiction to each jurisdiction\n"
-        "* totals_by_year.json: citation counts from each jurisdiction to each jurisdiction for each year\n"
-    )
+    from scripts.citation_graph import count_cites_by_year
+
+    count_cites_by_year(folder, output_folder)
 
 
 @task
@@ -1751,27 +1661,16 @@ def calculate_pagerank_scores(
     citation_graph_path="graph/citations.csv.gz",
     pagerank_score_output="graph/pagerank_scores.csv.gz",
 ):
-    """Generate pageranks scores for all nodes in the given citation graph"""
-    import networkx as nx
+    """Generate pageranks scores for all nodes in the given citation graph (a citations.csv.gz file or export folder)"""
+    from scripts.citation_graph import CitationGraph, load_citation_graph, write_pagerank_scores
 
     print("Reading citation graph")
-    graph = nx.read_adjlist(
-        citation_graph_path, delimiter=",", create_using=nx.DiGraph()
-    )
-    print("Calculating PageRank")
-    pagerank_scores = sorted(nx.pagerank(graph).items(), key=lambda x: x[1])
-    print("Writing output")
-    with gzip.open(pagerank_score_output, "wt") as f:
-        csv_output = csv.writer(f)
-        csv_output.writerow(["id", "raw_score", "percentile"])
-        last_score = 0
-        percentile = 0
-        total_rows = len(pagerank_scores)
-        for i, [id, score] in tqdm(enumerate(pagerank_scores)):
-            if score > last_score:
-                percentile = i
-            csv_output.writerow([id, score, percentile / total_rows])
-            last_score = score
+    citation_graph_path = Path(citation_graph_path)
+    if citation_graph_path.is_dir():
+        graph = load_citation_graph(citation_graph_path)
+    else:
+        graph = CitationGraph.from_adjacency_csv(citation_graph_path)
+    write_pagerank_scores(graph, pagerank_score_output)
 
 
 @task
@@ -1812,6 +1711,54 @@ def ingest_courtlistener(download_dir="/tmp", start_from=None):
     ingest_courtlistener(download_dir, start_from)
 
 
+@task
+def build_simhash_index(bands=None, version=None):
+    """Write the simhash near-duplicate index for all documents in the citation resolver index, using the most common simhash version unless version is given."""
+    from scripts.simhash import build_simhash_index
+
+    build_simhash_index(bands=int(bands) if bands else None, version=int(version) if version else None)
+
+
+@task
+def find_near_duplicates(out_path="near_duplicates.csv", max_distance=None):
+    """Write a CSV of all pairs of documents whose simhashes differ by at most max_distance bits."""
+    from scripts.simhash import write_near_duplicates
+
+    write_near_duplicates(out_path, int(max_distance) if max_distance else None)
+
+
+@task
+def build_cite_index():
+    """Write the cite index used to resolve extracted citations without querying the database."""
+    from scripts.cite_index import build_cite_index
+
+    build_cite_index()
+
+
+@task
+def update_cite_index():
+    """Apply changes to cases and citations since the cite index was last built or updated."""
+    from scripts.cite_index import update_cite_index
+
+    update_cite_index()
+
+
+@task
+def build_cited_by_index():
+    """Write the reverse citation index used to answer cites_to__* filters without searching for cited case ids."""
+    from scripts.cited_by import build_cited_by_index
+
+    build_cited_by_index()
+
+
+@task
+def build_body_store():
+    """Write the file of case xml and html served by the API when settings.ELASTICSEARCH_BODY_STORE is 'file'."""
+    from scripts.body_store import build_body_store
+
+    build_body_store()
+
+
 @task
 def print_harvard_ip_ranges():
     """Fetch IP ranges for known Harvard ASNs. Manually copy results to settings.HARVARD_IP_RANGES."""
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+
+from django.conf import settings
+from django.utils import timezone
+
+
+# case body formats that can be kept outside of the elasticsearch _source
+BODY_FORMATS = ('xml', 'html')
+
+
+def body_ref(xml, html):
+    """
+        Return the reference stored in elasticsearch in place of a case's xml and html, used to check that a copy in
+        a BodyStore file matches what was indexed.
+        >>> assert body_ref('<a/>', '<b></b>') == body_ref('<a/>', '<b></b>') != body_ref('<b></b>', '<a/>')
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for body in (xml, html):
+        body = (body or '').encode('utf8')
+        digest.update(struct.pack('<Q', len(body)))
+        digest.update(body)
+    return digest.hexdigest()
+
+
+class BodyStore:
+    """
+        Read-only, memory-mapped store of the redacted xml and html of each case, each compressed with zlib, for
+        serving case bodies that aren't kept in the elasticsearch _source. Written by BodyStore.write(), and built
+        from CaseBodyCache by build_body_store().
+
+        Each case is stored with its body_ref(), and get_bodies() only returns a copy if that matches the body_ref
+        elasticsearch has, so a store built before a case was edited never serves the old version.
+
+        File layout:
+            b'CAPBDY01'
+            <uint32 header length> <header json: {"timestamp": <isoformat>}>
+            <uint64 case count> <uint64 blob bytes> <padding to 8 bytes>
+            <int64 case ids, sorted>
+            <uint64 body_ref of each case>
+            <int64 offset of each case's xml and html in the blob bytes, plus the end offset>
+            <compressed blob bytes>
+
+        Usage:
+            store = BodyStore(path)
+            store.get_bodies({1: '0123456789abcdef'}, 'html')  # => {1: '<section class="casebody" ...'}
+    """
+    magic = b'CAPBDY01'
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(self.magic)] != self.magic:
+            raise ValueError("%s is not a body store" % path)
+        pos = len(self.magic)
+        header_length, = struct.unpack_from('<I', self.mmap, pos)
+        pos += 4
+        header = json.loads(self.mmap[pos:pos+header_length])
+        pos += header_length
+        case_count, blob_bytes = struct.unpack_from('<QQ', self.mmap, pos)
+        pos += 16
+        pos += -pos % 8
+        self.timestamp = header['timestamp']
+        self.case_ids = np.frombuffer(self.mmap, dtype='<i8', count=case_count, offset=pos)
+        pos += case_count * 8
+        self.refs = np.frombuffer(self.mmap, dtype='<u8', count=case_count, offset=pos)
+        pos += case_count * 8
+        self.offsets = np.frombuffer(self.mmap, dtype='<i8', count=case_count * len(BODY_FORMATS) + 1, offset=pos)
+        pos += (case_count * len(BODY_FORMATS) + 1) * 8
+        self.blob_start = pos
+
+    def __len__(self):
+        return len(self.case_ids)
+
+    def get_bodies(self, refs_by_id, body_format):
+        """ Given {case_id: body_ref}, return {case_id: body} for each case stored with a matching body_ref. """
+        if not refs_by_id or not len(self):
+            return {}
+        column = BODY_FORMATS.index(body_format)
+        ids = np.array(list(refs_by_id), dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.case_ids, ids), len(self) - 1)
+        bodies = {}
+        for case_id, row in zip(ids.tolist(), rows.tolist()):
+            if self.case_ids[row] != case_id or '%016x' % self.refs[row] != refs_by_id[case_id]:
+                continue
+            i = row * len(BODY_FORMATS) + column
+            start, end = self.blob_start + int(self.offsets[i]), self.blob_start + int(self.offsets[i + 1])
+            bodies[case_id] = zlib.decompress(self.mmap[start:end]).decode('utf8')
+        return bodies
+
+    @classmethod
+    def write(cls, path, rows, timestamp):
+        """
+            Atomically write a store for rows, an iterable of (case_id, xml, html) sorted by case_id, where xml and
+            html are already redacted. Return number of cases written.
+        """
+        ids = []
+        refs = []
+        offsets = [0]
+        temp_dir = os.path.dirname(os.path.abspath(path))
+        with tempfile.TemporaryFile(dir=temp_dir) as blobs:
+            for case_id, xml, html in rows:
+                ids.append(case_id)
+                refs.append(int(body_ref(xml, html), 16))
+                for body in (xml, html):
+                    offsets.append(offsets[-1] + blobs.write(zlib.compress((body or '').encode('utf8'))))
+            header = json.dumps({'timestamp': timestamp.isoformat()}).encode('utf8')
+            temp_path = path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                out = bytearray(cls.magic)
+                out += struct.pack('<I', len(header)) + header
+                out += struct.pack('<QQ', len(ids), offsets[-1])
+                out += bytes(-len(out) % 8)
+                f.write(out)
+                f.write(np.array(ids, dtype='<i8').tobytes())
+                f.write(np.array(refs, dtype='<u8').tobytes())
+                f.write(np.array(offsets, dtype='<i8').tobytes())
+                blobs.seek(0)
+                shutil.copyfileobj(blobs, f)
+            os.replace(temp_path, path)
+        return len(ids)
+
+
+_body_store_cache = {}
+
+
+def get_body_store():
+    """
+        Return the memory-mapped BodyStore at settings.BODY_STORE_PATH, reloaded if the file is replaced, or None if
+        it hasn't been built.
+    """
+    path = settings.BODY_STORE_PATH
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    file_key = (path, stat.st_ino, stat.st_mtime_ns)
+    if _body_store_cache.get('file_key') != file_key:
+        _body_store_cache.update(file_key=file_key, value=BodyStore(path))
+    return _body_store_cache['value']
+
+
+def get_bodies_from_db(case_ids, body_format):
+    """ Return {case_id: body} with the redacted body_format of each case in case_ids, from CaseBodyCache. """
+    from capdb.models import CaseMetadata  # avoid circular imports
+
+    cases = (CaseMetadata.objects
+        .filter(id__in=case_ids, body_cache__isnull=False)
+        .select_related('body_cache')
+        .only('id', 'no_index_redacted', 'body_cache__%s' % body_format))
+    return {case.id: case.redact_obj(getattr(case.body_cache, body_format)) for case in cases}
+
+
+def get_bodies(refs_by_id, body_format):
+    """
+        Given {case_id: body_ref} from elasticsearch, return {case_id: body} with the redacted body_format of each
+        case. If settings.ELASTICSEARCH_BODY_STORE is 'file', bodies are read from the BodyStore where possible, and
+        otherwise from CaseBodyCache.
+    """
+    bodies = {}
+    if settings.ELASTICSEARCH_BODY_STORE == 'file':
+        store = get_body_store()
+        if store is not None:
+            bodies = store.get_bodies(refs_by_id, body_format)
+    missing = [case_id for case_id in refs_by_id if case_id not in bodies]
+    if missing:
+        bodies.update(get_bodies_from_db(missing, body_format))
+    return bodies
+
+
+def build_body_store(path=None, chunk_size=1000):
+    """ Write the body store for all in-scope cases. """
+    from capapi.response_cache import advance_response_cache_watermark  # avoid circular imports
+    from capdb.models import CaseMetadata
+
+    path = path or settings.BODY_STORE_PATH
+    timestamp = timezone.now()
+    cases = (CaseMetadata.objects
+        .filter(in_scope=True, body_cache__isnull=False)
+        .select_related('body_cache')
+        .only('id', 'no_index_redacted', 'body_cache__xml', 'body_cache__html')
+        .order_by('id'))
+    rows = ((c.id, c.redact_obj(c.body_cache.xml), c.redact_obj(c.body_cache.html)) for c in cases.iterator(chunk_size=chunk_size))
+    case_count = BodyStore.write(path, rows, timestamp)
+    print("Wrote %s cases to %s" % (case_count, path))
+    advance_response_cache_watermark()
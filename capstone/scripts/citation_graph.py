@@ -0,0 +1,594 @@
+import csv
+import gzip
+import json
+import shutil
+from array import array
+from collections import Counter
+from datetime import datetime
+from multiprocessing.pool import Pool
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+
+from capapi.response_cache import advance_response_cache_watermark
+from capdb.models import CaseMetadata, Jurisdiction, CaseAnalysis, CaseLastUpdate, CaseDeleted, ExtractedCitation
+
+
+METADATA_FIELDS = [
+    "id",
+    "frontend_url",
+    "jurisdiction__name",
+    "jurisdiction_id",
+    "court__name_abbreviation",
+    "court_id",
+    "reporter__short_name",
+    "reporter_id",
+    "name_abbreviation",
+    "decision_date_original",
+    "cites",
+]
+
+
+def adjacency_edges(rows):
+    """
+        Return (<citing ids>, <edge citing ids>, <edge cited ids>) arrays for adjacency list rows of
+        [<citing id>, <cited id>, <cited id> ...].
+        >>> [a.tolist() for a in adjacency_edges([[3, 1, 2], [4]])]
+        [[3, 4], [3, 3], [1, 2]]
+    """
+    node_ids = array('q')
+    edge_sources = array('q')
+    edge_targets = array('q')
+    for from_id, *to_ids in rows:
+        node_ids.append(from_id)
+        edge_sources.extend([from_id] * len(to_ids))
+        edge_targets.extend(to_ids)
+    return (
+        np.frombuffer(node_ids, dtype=np.int64),
+        np.frombuffer(edge_sources, dtype=np.int64),
+        np.frombuffer(edge_targets, dtype=np.int64))
+
+
+class CitationGraph:
+    """
+        Citation graph in compressed sparse row form. Nodes are numbered by position in `ids`, the sorted case ids,
+        and node i cites nodes targets[offsets[i]:offsets[i+1]]. Node metadata is stored as columns aligned with ids.
+
+        save() writes each array as a .npy file in a folder, which load() memory-maps, so the per-jurisdiction
+        exports, aggregations and PageRank can all share one copy of the graph. The folder also keeps the timestamp
+        the graph was current as of, and the last PageRank scores and stored percentiles, so update_citation_graph()
+        can apply later changes incrementally.
+
+        >>> graph = CitationGraph.from_adjacency([[3, 1, 2], [2, 1], [4]])
+        >>> graph.ids.tolist(), graph.offsets.tolist(), graph.targets.tolist()
+        ([1, 2, 3, 4], [0, 0, 1, 3, 3], [0, 0, 1])
+        >>> [graph.ids[graph.cited(i)].tolist() for i in range(graph.node_count)]
+        [[], [1], [1, 2], []]
+    """
+    arrays = ('ids', 'offsets', 'targets', 'jurisdiction_ids', 'years')
+    optional_arrays = ('pagerank_scores', 'pagerank_percentiles')
+
+    def __init__(self, ids, offsets, targets, jurisdiction_ids=None, years=None, pagerank_scores=None,
+                 pagerank_percentiles=None, jurisdiction_names=None, timestamp=None):
+        self.ids = ids
+        self.offsets = offsets
+        self.targets = targets
+        self.jurisdiction_ids = np.zeros(len(ids), dtype=np.int32) if jurisdiction_ids is None else jurisdiction_ids
+        self.years = np.zeros(len(ids), dtype=np.int16) if years is None else years
+        self.pagerank_scores = pagerank_scores
+        self.pagerank_percentiles = pagerank_percentiles
+        self.jurisdiction_names = jurisdiction_names or {}
+        self.timestamp = timestamp
+
+    @property
+    def node_count(self):
+        return len(self.ids)
+
+    @property
+    def edge_count(self):
+        return len(self.targets)
+
+    def out_degrees(self):
+        return np.diff(self.offsets)
+
+    def sources(self, nodes=None):
+        """ Return the citing node of each edge, or of each edge from `nodes` if provided, as an int32 array. """
+        if nodes is None:
+            return np.repeat(np.arange(self.node_count, dtype=np.int32), self.out_degrees())
+        return np.repeat(nodes.astype(np.int32), self.offsets[nodes + 1] - self.offsets[nodes])
+
+    def edges_from(self, nodes):
+        """ Return positions in self.targets of every edge from nodes, in order. """
+        starts = self.offsets[nodes]
+        counts = self.offsets[nodes + 1] - starts
+        edge_starts = np.cumsum(counts) - counts
+        return np.repeat(starts - edge_starts, counts) + np.arange(counts.sum())
+
+    def cited(self, node):
+        return self.targets[self.offsets[node]:self.offsets[node+1]]
+
+    def index_of(self, ids):
+        return np.searchsorted(self.ids, ids)
+
+    def edge_ids(self):
+        """ Return (<citing case id of each edge>, <cited case id of each edge>). """
+        return self.ids[self.sources()], self.ids[self.targets]
+
+    @classmethod
+    def from_adjacency(cls, rows):
+        """
+            Build a graph from adjacency list rows of [<citing id>, <cited id>, <cited id> ...]. Repeated edges are
+            dropped.
+        """
+        return cls.from_edges(*adjacency_edges(rows))
+
+    @classmethod
+    def from_edges(cls, node_ids, edge_sources, edge_targets):
+        """ Build a graph from arrays of case ids: nodes, plus the citing and cited case of each edge. """
+        ids = np.unique(np.concatenate([node_ids, edge_sources, edge_targets]))
+
+        # sort and dedupe edges by (source, target) node number
+        edges = np.unique(np.searchsorted(ids, edge_sources) << 32 | np.searchsorted(ids, edge_targets))
+        targets = (edges & 0xffffffff).astype(np.int32)
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(edges >> 32, minlength=len(ids)), out=offsets[1:])
+        return cls(ids, offsets, targets)
+
+    @classmethod
+    def from_adjacency_csv(cls, path):
+        with gzip.open(str(path), "rt") as f:
+            return cls.from_adjacency([int(i) for i in row] for row in tqdm(csv.reader(f)))
+
+    def load_metadata_csv(self, path):
+        """ Fill in metadata columns from a metadata.csv.gz written by export_citation_graph(). """
+        with gzip.open(str(path), "rt") as f:
+            for row in tqdm(csv.DictReader(f)):
+                node = self.index_of(int(row["id"]))
+                self.jurisdiction_ids[node] = int(row["jurisdiction_id"])
+                self.years[node] = int(row["decision_date_original"][:4])
+                self.jurisdiction_names[int(row["jurisdiction_id"])] = row["jurisdiction__name"]
+
+    def save(self, folder):
+        """ Atomically replace folder with this graph's arrays. """
+        folder = Path(folder)
+        temp_folder = folder.with_name(folder.name + ".tmp")
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        temp_folder.mkdir(parents=True)
+        for name in self.arrays + self.optional_arrays:
+            if getattr(self, name) is not None:
+                np.save(temp_folder / f"{name}.npy", getattr(self, name))
+        temp_folder.joinpath("info.json").write_text(json.dumps({
+            "jurisdictions": self.jurisdiction_names,
+            "timestamp": self.timestamp,
+        }))
+        shutil.rmtree(folder, ignore_errors=True)
+        temp_folder.rename(folder)
+
+    @classmethod
+    def load(cls, folder):
+        folder = Path(folder)
+        info = json.loads(folder.joinpath("info.json").read_text())
+        return cls(
+            *[np.load(folder / f"{name}.npy", mmap_mode="r") for name in cls.arrays],
+            *[np.load(folder / f"{name}.npy", mmap_mode="r") if folder.joinpath(f"{name}.npy").exists() else None
+              for name in cls.optional_arrays],
+            jurisdiction_names={int(k): v for k, v in info["jurisdictions"].items()},
+            timestamp=info["timestamp"],
+        )
+
+    def pagerank(self, alpha=0.85, max_iter=100, tol=1.0e-6, x0=None):
+        """
+            Return PageRank score for each node, by power iteration over the sparse graph. This matches
+            networkx.pagerank() with default arguments: rank from nodes that cite nothing is spread evenly over all
+            nodes, and iteration stops when the summed change is less than node_count * tol.
+            x0 is an optional starting vector, such as scores from before the graph changed; it is normalized to sum to 1.
+
+            >>> graph = CitationGraph.from_adjacency([[1, 1, 3], [2, 3]])
+            >>> [round(x, 6) for x in graph.pagerank().tolist()]
+            [0.326397, 0.187679, 0.485924]
+        """
+        n = self.node_count
+        if not n:
+            return np.zeros(0)
+        out_degrees = self.out_degrees()
+        dangling = out_degrees == 0
+        sources = self.sources()
+        x = np.full(n, 1.0 / n) if x0 is None else x0 / x0.sum()
+        for _ in range(max_iter):
+            x_last = x
+            weights = np.divide(x_last, out_degrees, out=np.zeros(n), where=~dangling)
+            x = alpha * np.bincount(self.targets, weights=weights[sources], minlength=n)
+            x += (alpha * x_last[dangling].sum() + 1.0 - alpha) / n
+            if np.abs(x - x_last).sum() < n * tol:
+                return x
+        raise RuntimeError("PageRank failed to converge in %s iterations" % max_iter)
+
+
+def load_citation_graph(folder):
+    """
+        Load the memory-mapped graph in folder/csr, building it from folder/citations.csv.gz and
+        folder/metadata.csv.gz if this export predates it.
+    """
+    folder = Path(folder)
+    csr_folder = folder / "csr"
+    if not csr_folder.exists():
+        print("Building CSR graph")
+        graph = CitationGraph.from_adjacency_csv(folder / "citations.csv.gz")
+        if folder.joinpath("metadata.csv.gz").exists():
+            graph.load_metadata_csv(folder / "metadata.csv.gz")
+        graph.save(csr_folder)
+    return CitationGraph.load(csr_folder)
+
+
+def iter_citation_rows(chunk_size=10000, cited_by_ids=None):
+    """
+        Yield [<citing case id>, <cited case id>, ...] for each case with citations that belong in the graph,
+        or only for cited_by_ids if provided.
+    """
+    query = """
+        DECLARE cite_cursor CURSOR for
+        select
+            cited_by.id, array_agg(distinct target_case.id)
+        from
+            capdb_extractedcitation ec
+            inner join
+                capdb_casemetadata target_case on ec.target_case_id = target_case.id
+            inner join
+                capdb_casemetadata cited_by on ec.cited_by_id = cited_by.id
+            inner join
+                capdb_volumemetadata target_volume on target_case.volume_id = target_volume.barcode
+        where
+            cited_by.in_scope is true
+            and target_case.in_scope is true
+            and target_volume.out_of_scope is false
+            and cited_by.decision_date_original >= target_case.decision_date_original
+            and cited_by.id != target_case.id
+            %s
+        group by cited_by.id;
+    """ % ("and cited_by.id = any(%s)" if cited_by_ids is not None else "")
+    with transaction.atomic(using="capdb"), connections["capdb"].cursor() as cursor, tqdm() as pbar:
+        cursor.execute(query, [cited_by_ids] if cited_by_ids is not None else None)
+        while True:
+            cursor.execute("FETCH %s FROM cite_cursor" % chunk_size)
+            chunk = cursor.fetchall()
+            pbar.update()
+            if not chunk:
+                break
+            for row in chunk:
+                yield [row[0]] + row[1]
+
+
+def export_citation_graph(output_folder="graph", resume=False, processes=None):
+    """
+        Write citations.csv.gz, metadata.csv.gz, the memory-mapped CSR graph in csr/, per-jurisdiction subgraphs,
+        aggregations and PageRank scores to output_folder. If resume is true and the graph has already been exported
+        to output_folder, skip the database queries and only regenerate files derived from the graph.
+    """
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    citations_path = output_folder / "citations.csv.gz"
+    metadata_path = output_folder / "metadata.csv.gz"
+    csr_folder = output_folder / "csr"
+
+    if resume and csr_folder.exists():
+        print("Resuming from existing graph")
+        graph = CitationGraph.load(csr_folder)
+    else:
+        citations_path.touch(mode=0o644)  # check that we have write access
+        timestamp = timezone.now()
+
+        # write citations.csv.gz, and build graph from the same rows
+        print("Running citations query")
+        def write_rows():
+            with gzip.open(str(citations_path), "wt") as f:
+                csv_w = csv.writer(f)
+                for row in iter_citation_rows():
+                    csv_w.writerow(row)
+                    yield row
+        graph = CitationGraph.from_adjacency(write_rows())
+
+        # write metadata.csv.gz, and fill in metadata columns
+        print("Writing metadata")
+        write_metadata(graph, metadata_path)
+        graph.timestamp = timestamp.isoformat()
+        graph.save(csr_folder)
+        graph = CitationGraph.load(csr_folder)
+
+    # write README.md
+    output_folder.joinpath("README.md").write_text(
+        f"Citation graph exported {timezone.now()}:\n\n"
+        f"* Nodes: {graph.node_count}\n"
+        f"* Edges: {graph.edge_count}\n"
+    )
+
+    print("Writing jurisdiction files")
+    write_jurisdiction_graphs(csr_folder, metadata_path, output_folder / "by_jurisdiction", processes)
+
+    print("Counting cites by year")
+    count_cites_by_year(output_folder, output_folder / "aggregations")
+
+    print("Calculating PageRank")
+    graph.pagerank_scores, graph.pagerank_percentiles = write_pagerank_scores(graph, output_folder / "pagerank_scores.csv.gz")
+    graph.save(csr_folder)  # store scores for update_citation_graph()
+
+
+def write_metadata(graph, metadata_path, chunk_size=10000):
+    """ Write metadata.csv.gz for each node in graph, and fill in the graph's metadata columns. """
+    query = CaseMetadata.objects.annotate(cites=ArrayAgg("citations__cite")).values_list(*METADATA_FIELDS)
+    node_fields = [METADATA_FIELDS.index(f) for f in ("id", "jurisdiction_id", "jurisdiction__name", "decision_date_original")]
+    ids = graph.ids.tolist()
+    with gzip.open(str(metadata_path), "wt") as f:
+        csv_w = csv.writer(f)
+        csv_w.writerow(METADATA_FIELDS)
+        for i in tqdm(range(0, len(ids), chunk_size)):
+            rows = [row[:-1] + ("; ".join(row[-1]),) for row in query.filter(id__in=ids[i:i + chunk_size])]  # combine citations
+            csv_w.writerows(rows)
+            set_node_metadata(graph, [[row[i] for i in node_fields] for row in rows])
+
+
+def set_node_metadata(graph, rows):
+    """ Fill in graph metadata columns from rows of (id, jurisdiction_id, jurisdiction__name, decision_date_original). """
+    rows = list(rows)
+    if not rows:
+        return
+    nodes = graph.index_of([row[0] for row in rows])
+    graph.jurisdiction_ids[nodes] = [row[1] or 0 for row in rows]
+    graph.years[nodes] = [int(row[3][:4]) for row in rows]
+    graph.jurisdiction_names.update((row[1], row[2]) for row in rows if row[1])
+
+
+def write_jurisdiction_graph(args):
+    """
+        Write citations.csv.gz for the subgraph of citations within one jurisdiction. Return (jurisdiction_id,
+        <sorted array of case ids in subgraph>, <edge count>). This is called within a process pool; see
+        write_jurisdiction_graphs for how it's used.
+    """
+    csr_folder, jurisdiction_id, jur_folder = args
+    graph = CitationGraph.load(csr_folder)
+    nodes = np.flatnonzero(graph.jurisdiction_ids == jurisdiction_id)
+    edges = graph.edges_from(nodes)
+    targets = graph.targets[edges]
+    in_jurisdiction = graph.jurisdiction_ids[targets] == jurisdiction_id
+    sources = graph.sources(nodes)[in_jurisdiction]
+    targets = targets[in_jurisdiction]
+    if not len(targets):
+        return jurisdiction_id, np.zeros(0, dtype=np.int64), 0
+
+    jur_folder.mkdir(parents=True, exist_ok=True)
+    with gzip.open(str(jur_folder / "citations.csv.gz"), "wt") as f:
+        csv_w = csv.writer(f)
+        row_starts = np.flatnonzero(np.r_[True, sources[1:] != sources[:-1]])
+        target_ids = np.split(graph.ids[targets], row_starts[1:])
+        for source, row_target_ids in zip(graph.ids[sources[row_starts]].tolist(), target_ids):
+            csv_w.writerow([source] + row_target_ids.tolist())
+    return jurisdiction_id, graph.ids[np.union1d(sources, targets)], len(targets)
+
+
+def write_jurisdiction_graphs(csr_folder, metadata_path, jurs_folder, processes=None):
+    """
+        Write subsets of the graph consisting only of citations between cases within each jurisdiction.
+        Each jurisdiction's citations.csv.gz is written in parallel from the shared memory-mapped graph, and then all
+        the metadata.csv.gz files are written in a single pass through the full metadata file.
+    """
+    graph = CitationGraph.load(csr_folder)
+    jurs_folder.mkdir(parents=True, exist_ok=True)
+    jurs_folder.joinpath("README.md").write_text(
+        "Subsets of the full graph consisting only of citations between cases within a particular jurisdiction."
+    )
+
+    jurisdictions = {}
+    jobs = [(csr_folder, jur_id, jurs_folder / jur_name) for jur_id, jur_name in graph.jurisdiction_names.items()]
+    with Pool(processes) as pool:
+        for jur_id, node_ids, edge_count in tqdm(pool.imap_unordered(write_jurisdiction_graph, jobs), total=len(jobs)):
+            if edge_count:
+                jurisdictions[jur_id] = {"name": graph.jurisdiction_names[jur_id], "node_ids": node_ids, "edge_count": edge_count}
+
+    # write out metadata for each jurisdiction's nodes
+    jur_files = {}
+    try:
+        for jur_id, jur in jurisdictions.items():
+            jur_files[jur_id] = f = gzip.open(str(jurs_folder / jur["name"] / "metadata.csv.gz"), "wt")
+            jur["metadata_file_writer"] = csv.writer(f)
+            jur["metadata_file_writer"].writerow(METADATA_FIELDS)
+        with gzip.open(str(metadata_path), "rt") as f:
+            reader = csv.reader(f)
+            next(reader)
+            for row in tqdm(reader):
+                jur = jurisdictions.get(int(row[METADATA_FIELDS.index("jurisdiction_id")]))
+                if jur:
+                    case_id = int(row[0])
+                    i = np.searchsorted(jur["node_ids"], case_id)
+                    if i < len(jur["node_ids"]) and jur["node_ids"][i] == case_id:
+                        jur["metadata_file_writer"].writerow(row)
+    finally:
+        for f in jur_files.values():
+            f.close()
+
+    for jur in jurisdictions.values():
+        jurs_folder.joinpath(jur["name"], "README.md").write_text(
+            f"Citation graph for {jur['name']} exported {timezone.now()}:\n\n"
+            f"* Nodes: {len(jur['node_ids'])}\n"
+            f"* Edges: {jur['edge_count']}\n"
+        )
+
+
+def count_cites_by_year(folder, output_folder, chunk_size=1000000):
+    """ Write summaries from citation graph in folder to output_folder. """
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    graph = load_citation_graph(folder)
+
+    # count edges by (citing jurisdiction, cited jurisdiction, citing year), a chunk of citing nodes at a time
+    counts = Counter()
+    for start in tqdm(range(0, graph.node_count, chunk_size)):
+        nodes = np.arange(start, min(start + chunk_size, graph.node_count))
+        sources = graph.sources(nodes)
+        keys = (
+            graph.jurisdiction_ids[sources].astype(np.int64) << 40
+            | graph.jurisdiction_ids[graph.targets[graph.edges_from(nodes)]].astype(np.int64) << 16
+            | graph.years[sources].astype(np.int64)
+        )
+        keys, key_counts = np.unique(keys, return_counts=True)
+        counts.update(dict(zip(keys.tolist(), key_counts.tolist())))
+
+    cites_per_jurisdiction = Counter()
+    totals = {}
+    totals_by_year = {}
+    for key in sorted(counts):
+        from_jur_id, to_jur_id, year, count = key >> 40, key >> 16 & 0xffffff, key & 0xffff, counts[key]
+        cites_per_jurisdiction[from_jur_id] += count
+        totals.setdefault(from_jur_id, Counter())[to_jur_id] += count
+        totals_by_year.setdefault(year, {}).setdefault(from_jur_id, Counter())[to_jur_id] += count
+
+    print("Writing output")
+    jurisdiction_metadata = [
+        {
+            "id": j.id,
+            "slug": j.slug,
+            "name": j.name,
+            "name_long": j.name_long,
+            "cites": cites_per_jurisdiction[j.id],
+        }
+        for j in Jurisdiction.objects.filter(
+            id__in=cites_per_jurisdiction.keys()
+        ).order_by("name")
+    ]
+    output_folder.joinpath("jurisdictions.json").write_text(
+        json.dumps(jurisdiction_metadata)
+    )
+    output_folder.joinpath("totals.json").write_text(json.dumps(totals))
+    output_folder.joinpath("totals_by_year.json").write_text(json.dumps(totals_by_year))
+    output_folder.joinpath("README.md").write_text(
+        "This directory contains aggregations of data by jurisdiction from the citation graph:\n\n"
+        "* jurisdictions.json: citation counts by citing jurisdiction\n"
+        "* totals.json: citation counts from each jurisdiction to each jurisdiction\n"
+        "* totals_by_year.json: citation counts from each jurisdiction to each jurisdiction for each year\n"
+    )
+
+
+def pagerank_percentiles(scores):
+    """
+        Return the percentile of each score: the fraction of scores lower than it.
+        >>> pagerank_percentiles(np.array([0.3, 0.1, 0.3, 0.2])).tolist()
+        [0.5, 0.0, 0.5, 0.25]
+    """
+    order = np.argsort(scores, kind="stable")
+    sorted_scores = scores[order]
+
+    # nodes with equal scores share the percentile of the first of them
+    run_starts = np.where(np.r_[True, sorted_scores[1:] > sorted_scores[:-1]], np.arange(len(order)), 0)
+    percentiles = np.empty(len(order))
+    percentiles[order] = np.maximum.accumulate(run_starts) / max(len(order), 1)
+    return percentiles
+
+
+def write_pagerank_scores(graph, pagerank_score_output):
+    """
+        Write raw PageRank score and percentile for each node in graph, from lowest to highest score.
+        Return (scores, percentiles), aligned with graph.ids.
+    """
+    scores = graph.pagerank()
+    percentiles = pagerank_percentiles(scores)
+    order = np.argsort(scores, kind="stable")
+
+    print("Writing output")
+    with gzip.open(str(pagerank_score_output), "wt") as f:
+        csv_output = csv.writer(f)
+        csv_output.writerow(["id", "raw_score", "percentile"])
+        csv_output.writerows(zip(graph.ids[order].tolist(), scores[order].tolist(), percentiles[order].tolist()))
+    return scores, percentiles
+
+
+def update_citation_graph(output_folder="graph", percentile_tolerance=None, chunk_size=10000):
+    """
+        Apply citation changes since the graph in output_folder/csr was last updated, warm-start PageRank from the
+        previous scores, and upsert pagerank CaseAnalysis rows only for cases whose percentile moved by more than
+        percentile_tolerance, so unchanged cases aren't reindexed. Aggregations are regenerated from the updated
+        graph; citations.csv.gz, metadata.csv.gz and by_jurisdiction/ are only rewritten by export_citation_graph().
+    """
+    output_folder = Path(output_folder)
+    csr_folder = output_folder / "csr"
+    graph = CitationGraph.load(csr_folder)
+    if graph.timestamp is None or graph.pagerank_percentiles is None:
+        raise ValueError("%s has no PageRank scores to update; run export_citation_graph first" % csr_folder)
+    if percentile_tolerance is None:
+        percentile_tolerance = settings.PAGERANK_PERCENTILE_TOLERANCE
+    # changes made while this runs are picked up next time; writing pagerank scores doesn't count as a change,
+    # because the last_update trigger only moves graph_timestamp for fields that affect the graph
+    timestamp = timezone.now()
+
+    # find cases whose citations, scope or decision date may have changed
+    since = datetime.fromisoformat(graph.timestamp)
+    changed_ids = set(CaseLastUpdate.objects.filter(graph_timestamp__gte=since).values_list('case_id', flat=True))
+    changed_ids.update(CaseDeleted.objects.filter(timestamp__gte=since).values_list('case_id', flat=True))
+    changed_ids = np.array(sorted(changed_ids), dtype=np.int64)
+    print("Found %s changed cases" % len(changed_ids))
+
+    # rows of the adjacency list to replace are those for changed cases, cases already citing them, and cases with
+    # extracted citations that now point to them
+    edge_sources, edge_targets = graph.edge_ids()
+    affected_ids = set(changed_ids.tolist())
+    affected_ids.update(np.unique(edge_sources[np.isin(edge_targets, changed_ids)]).tolist())
+    for i in range(0, len(changed_ids), chunk_size):
+        affected_ids.update(ExtractedCitation.objects.filter(
+            target_case_id__in=changed_ids[i:i + chunk_size].tolist()
+        ).values_list('cited_by_id', flat=True).distinct())
+    affected_ids = np.array(sorted(affected_ids), dtype=np.int64)
+
+    print("Querying citations for %s cases" % len(affected_ids))
+    keep = ~np.isin(edge_sources, affected_ids)
+    node_ids, new_sources, new_targets = adjacency_edges(
+        iter_citation_rows(cited_by_ids=affected_ids.tolist()) if len(affected_ids) else [])
+    new_graph = CitationGraph.from_edges(
+        node_ids,
+        np.concatenate([edge_sources[keep], new_sources]),
+        np.concatenate([edge_targets[keep], new_targets]))
+
+    # carry over metadata and scores for unchanged nodes, and look up metadata for new and changed nodes
+    old_nodes = np.minimum(graph.index_of(new_graph.ids), max(graph.node_count - 1, 0))
+    existing = (graph.ids[old_nodes] == new_graph.ids) if graph.node_count else np.zeros(new_graph.node_count, dtype=bool)
+    unchanged = existing & ~np.isin(new_graph.ids, changed_ids)
+    new_graph.jurisdiction_names = dict(graph.jurisdiction_names)
+    new_graph.jurisdiction_ids[unchanged] = graph.jurisdiction_ids[old_nodes[unchanged]]
+    new_graph.years[unchanged] = graph.years[old_nodes[unchanged]]
+    lookup_ids = new_graph.ids[~unchanged].tolist()
+    for i in range(0, len(lookup_ids), chunk_size):
+        set_node_metadata(new_graph, CaseMetadata.objects.filter(id__in=lookup_ids[i:i + chunk_size]).values_list(
+            'id', 'jurisdiction_id', 'jurisdiction__name', 'decision_date_original'))
+
+    print("Calculating PageRank")
+    x0 = np.full(new_graph.node_count, 1.0 / max(graph.node_count, 1))
+    x0[existing] = graph.pagerank_scores[old_nodes[existing]]
+    scores = new_graph.pagerank(x0=x0)
+    percentiles = pagerank_percentiles(scores)
+    stored_percentiles = np.full(new_graph.node_count, np.nan)
+    stored_percentiles[existing] = graph.pagerank_percentiles[old_nodes[existing]]
+
+    # upsert scores whose percentile moved, and delete scores for cases no longer in the graph
+    to_update = np.flatnonzero(~(np.abs(percentiles - stored_percentiles) <= percentile_tolerance))
+    print("Updating PageRank for %s cases" % len(to_update))
+    for i in range(0, len(to_update), chunk_size):
+        nodes = to_update[i:i + chunk_size]
+        CaseAnalysis.bulk_upsert([
+            CaseAnalysis(case_id=case_id, key="pagerank", value={"raw": raw, "percentile": percentile})
+            for case_id, raw, percentile in zip(new_graph.ids[nodes].tolist(), scores[nodes].tolist(), percentiles[nodes].tolist())
+        ])
+    stored_percentiles[to_update] = percentiles[to_update]
+    removed_ids = np.setdiff1d(graph.ids, new_graph.ids).tolist()
+    for i in range(0, len(removed_ids), chunk_size):
+        CaseAnalysis.objects.filter(key="pagerank", case_id__in=removed_ids[i:i + chunk_size]).delete()
+
+    new_graph.pagerank_scores = scores
+    new_graph.pagerank_percentiles = stored_percentiles
+    new_graph.timestamp = timestamp.isoformat()
+    new_graph.save(csr_folder)
+    advance_response_cache_watermark()
+
+    print("Counting cites by year")
+    count_cites_by_year(output_folder, output_folder / "aggregations")
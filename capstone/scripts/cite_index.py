@@ -0,0 +1,286 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from django.conf import settings
+from django.utils import timezone
+
+
+CITE_TYPES = ('cite', 'normalized_cite', 'rdb_cite', 'rdb_normalized_cite')
+CITE_ROW_FIELDS = ['case_id', 'case__decision_date_original', 'case__frontend_url'] + list(CITE_TYPES)
+
+# the parts of a CaseMetadata object that citation resolution needs
+CiteTarget = namedtuple('CiteTarget', ['id', 'decision_date_original', 'frontend_url'])
+
+
+def key_hash(cite_type, cite):
+    """
+        Return the 64-bit key used to look up `cite` as a `cite_type` in a CiteIndex.
+        >>> assert key_hash('cite', '1 U.S. 1') != key_hash('rdb_cite', '1 U.S. 1')
+    """
+    digest = hashlib.blake2b(('%s\0%s' % (cite_type, cite)).encode('utf8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def gather_bytes(blob, starts, lengths):
+    """
+        Return the concatenation of blob[start:start+length] for each start and length, as a uint8 array.
+        >>> blob = np.frombuffer(b'abcdef', dtype=np.uint8)
+        >>> assert gather_bytes(blob, np.array([4, 0]), np.array([2, 3])).tobytes() == b'efabc'
+    """
+    total = int(lengths.sum())
+    if not total:
+        return np.zeros(0, dtype=np.uint8)
+    ends = np.cumsum(lengths)
+    positions = np.arange(total, dtype=np.int64) + np.repeat(starts - (ends - lengths), lengths)
+    return blob[positions]
+
+
+class CiteIndex:
+    """
+        Read-only, memory-mapped index from each form of a case citation to the in-scope cases it refers to, so
+        citations can be resolved without querying the database. Written by CiteIndex.write(), and built or
+        incrementally updated from the Citation table by build_cite_index() and update_cite_index().
+
+        Each key is a 64-bit hash of a cite type (one of CITE_TYPES) and cite string. With tens of millions of keys,
+        the chance of any given lookup colliding with an unrelated key is around 1 in 10^12, so keys aren't stored.
+
+        File layout:
+            b'CAPCIX01'
+            <uint32 header length> <header json: {"timestamp": <isoformat>, "date_width": <max decision date length>}>
+            <uint64 case count> <uint64 key count> <uint64 url bytes> <padding to 8 bytes>
+            <int64 case ids, sorted>
+            <int64 offset of each case's frontend_url in the url bytes, plus the end offset>
+            <uint64 key hashes, sorted> <int64 case row for each key>
+            <decision_date_original of each case, null-padded to date_width bytes>
+            <utf8 frontend_url bytes>
+
+        Usage:
+            index = CiteIndex(path)
+            index.lookup({'cite': ['1 U.S. 1']})  # => {'cite': {'1 U.S. 1': {CiteTarget(1, '1900-01-01', '/us/1/1/')}}, ...}
+            index.case_ids(['1us1'], ['normalized_cite', 'rdb_normalized_cite'])  # => [1]
+    """
+    magic = b'CAPCIX01'
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(self.magic)] != self.magic:
+            raise ValueError("%s is not a cite index" % path)
+        pos = len(self.magic)
+        header_length, = struct.unpack_from('<I', self.mmap, pos)
+        pos += 4
+        header = json.loads(self.mmap[pos:pos+header_length])
+        pos += header_length
+        case_count, key_count, url_bytes = struct.unpack_from('<QQQ', self.mmap, pos)
+        pos += 24
+        pos += -pos % 8
+        self.timestamp = header['timestamp']
+        self.case_ids_array = np.frombuffer(self.mmap, dtype='<i8', count=case_count, offset=pos)
+        pos += case_count * 8
+        self.url_offsets = np.frombuffer(self.mmap, dtype='<i8', count=case_count + 1, offset=pos)
+        pos += (case_count + 1) * 8
+        self.keys = np.frombuffer(self.mmap, dtype='<u8', count=key_count, offset=pos)
+        pos += key_count * 8
+        self.key_rows = np.frombuffer(self.mmap, dtype='<i8', count=key_count, offset=pos)
+        pos += key_count * 8
+        self.decision_dates = np.frombuffer(self.mmap, dtype='S%s' % header['date_width'], count=case_count, offset=pos)
+        pos += case_count * header['date_width']
+        self.urls = np.frombuffer(self.mmap, dtype=np.uint8, count=url_bytes, offset=pos)
+
+    def __len__(self):
+        return len(self.case_ids_array)
+
+    def get_case(self, row):
+        """ Return the CiteTarget stored in the given case row. """
+        start, end = self.url_offsets[row], self.url_offsets[row + 1]
+        return CiteTarget(
+            int(self.case_ids_array[row]),
+            self.decision_dates[row].decode('utf8'),
+            self.urls[start:end].tobytes().decode('utf8') or None)
+
+    def lookup_rows(self, cite_type, cites):
+        """ Yield (cite, case rows) for each of cites that matches at least one case as a cite_type. """
+        cites = [c for c in set(cites) if c]
+        if not cites:
+            return
+        probes = np.array([key_hash(cite_type, c) for c in cites], dtype=np.uint64)
+        starts = np.searchsorted(self.keys, probes, side='left')
+        ends = np.searchsorted(self.keys, probes, side='right')
+        for cite, start, end in zip(cites, starts, ends):
+            if start < end:
+                yield cite, self.key_rows[start:end]
+
+    def lookup(self, cites_by_type):
+        """
+            Given {cite_type: [cite strings]}, return {cite_type: {cite: set(CiteTarget)}} for every cite that
+            matches a case. Every cite_type in CITE_TYPES is included, so results can be read with .get().
+        """
+        cases_by_cite = {cite_type: {} for cite_type in CITE_TYPES}
+        cases_by_row = {}
+        for cite_type, cites in cites_by_type.items():
+            for cite, rows in self.lookup_rows(cite_type, cites):
+                cases = cases_by_cite[cite_type][cite] = set()
+                for row in rows.tolist():
+                    if row not in cases_by_row:
+                        cases_by_row[row] = self.get_case(row)
+                    cases.add(cases_by_row[row])
+        return cases_by_cite
+
+    def case_ids(self, cites, cite_types=CITE_TYPES):
+        """ Return sorted ids of all cases matching any of cites as any of cite_types. """
+        rows = [rows for cite_type in cite_types for _, rows in self.lookup_rows(cite_type, cites)]
+        if not rows:
+            return []
+        return self.case_ids_array[np.unique(np.concatenate(rows))].tolist()
+
+    @classmethod
+    def write(cls, path, rows, timestamp, base=None, replace_ids=()):
+        """
+            Atomically write an index for rows, an iterable of
+            (case_id, decision_date_original, frontend_url, cite, normalized_cite, rdb_cite, rdb_normalized_cite),
+            one per Citation. If base is an existing CiteIndex, its cases are kept, except for replace_ids, which
+            are dropped before rows are added. Return number of cases written.
+        """
+        # collect new cases and keys
+        new_cases = {}
+        key_hashes = []
+        key_case_ids = []
+        for case_id, decision_date, frontend_url, *cites in rows:
+            new_cases[case_id] = ((decision_date or '').encode('utf8'), (frontend_url or '').encode('utf8'))
+            for cite_type, cite in zip(CITE_TYPES, cites):
+                if cite:
+                    key_hashes.append(key_hash(cite_type, cite))
+                    key_case_ids.append(case_id)
+        new_ids = np.array(sorted(new_cases), dtype=np.int64)
+        new_urls = [new_cases[i][1] for i in new_ids.tolist()]
+        new_lengths = np.array([len(u) for u in new_urls], dtype=np.int64)
+        ids = [new_ids]
+        dates = [np.array([new_cases[i][0] for i in new_ids.tolist()], dtype=bytes)]
+        url_blobs = [np.frombuffer(b''.join(new_urls), dtype=np.uint8)]
+        url_lengths = [new_lengths]
+        keys = [np.array(key_hashes, dtype=np.uint64)]
+        key_ids = [np.array(key_case_ids, dtype=np.int64)]
+
+        # carry over cases from base index
+        if base is not None and len(base):
+            replace_ids = np.union1d(np.array(list(replace_ids), dtype=np.int64), new_ids)
+            keep = ~np.isin(base.case_ids_array, replace_ids)
+            lengths = np.diff(base.url_offsets)
+            ids.append(base.case_ids_array[keep])
+            dates.append(base.decision_dates[keep])
+            url_blobs.append(gather_bytes(base.urls, base.url_offsets[:-1][keep], lengths[keep]))
+            url_lengths.append(lengths[keep])
+            keep_keys = keep[base.key_rows]
+            keys.append(base.keys[keep_keys])
+            key_ids.append(base.case_ids_array[base.key_rows[keep_keys]])
+
+        # merge and sort
+        ids = np.concatenate(ids)
+        order = np.argsort(ids, kind='stable')
+        ids = ids[order]
+        date_width = max(max((d.dtype.itemsize for d in dates)), 1)
+        dates = np.concatenate([d.astype('S%s' % date_width) for d in dates])[order]
+        url_lengths = np.concatenate(url_lengths)
+        url_starts = np.cumsum(url_lengths) - url_lengths
+        urls = gather_bytes(np.concatenate(url_blobs), url_starts[order], url_lengths[order])
+        url_offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(url_lengths[order], out=url_offsets[1:])
+        keys = np.concatenate(keys)
+        key_rows = np.searchsorted(ids, np.concatenate(key_ids))
+        key_order = np.lexsort((key_rows, keys))
+        keys, key_rows = keys[key_order], key_rows[key_order]
+        # a case can have the same key more than once, e.g. from duplicate Citation rows
+        unique = np.ones(len(keys), dtype=bool)
+        unique[1:] = (keys[1:] != keys[:-1]) | (key_rows[1:] != key_rows[:-1])
+        keys, key_rows = keys[unique], key_rows[unique]
+
+        header = json.dumps({'timestamp': timestamp.isoformat(), 'date_width': date_width}).encode('utf8')
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            out = bytearray(cls.magic)
+            out += struct.pack('<I', len(header)) + header
+            out += struct.pack('<QQQ', len(ids), len(keys), len(urls))
+            out += bytes(-len(out) % 8)
+            f.write(out)
+            f.write(ids.astype('<i8').tobytes())
+            f.write(url_offsets.astype('<i8').tobytes())
+            f.write(keys.astype('<u8').tobytes())
+            f.write(key_rows.astype('<i8').tobytes())
+            f.write(dates.tobytes())
+            f.write(urls.tobytes())
+        os.replace(temp_path, path)
+        return len(ids)
+
+
+_cite_index_cache = {}
+
+
+def get_cite_index():
+    """
+        Return the memory-mapped CiteIndex at settings.CITE_INDEX_PATH, reloaded if the file is replaced, or None if
+        it hasn't been built or was last updated more than settings.CITE_INDEX_MAX_AGE_HOURS ago. Pages are shared
+        between all processes on a host that load the same file.
+    """
+    path = settings.CITE_INDEX_PATH
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    file_key = (path, stat.st_ino, stat.st_mtime_ns)
+    if _cite_index_cache.get('file_key') != file_key:
+        _cite_index_cache.update(file_key=file_key, value=CiteIndex(path))
+    index = _cite_index_cache['value']
+    if datetime.fromisoformat(index.timestamp) < timezone.now() - timedelta(hours=settings.CITE_INDEX_MAX_AGE_HOURS):
+        return None
+    return index
+
+
+def iter_cite_rows(case_ids=None, chunk_size=10000):
+    """ Yield rows for CiteIndex.write() for all in-scope cases, or for those in-scope cases in case_ids. """
+    from capdb.models import Citation  # avoid circular imports
+
+    citations = Citation.objects.filter(case__in_scope=True).order_by()
+    if case_ids is None:
+        yield from citations.values_list(*CITE_ROW_FIELDS).iterator(chunk_size=chunk_size)
+        return
+    for i in range(0, len(case_ids), chunk_size):
+        yield from citations.filter(case_id__in=case_ids[i:i + chunk_size]).values_list(*CITE_ROW_FIELDS)
+
+
+def build_cite_index(path=None):
+    """ Write the cite index for all in-scope cases. """
+    from capapi.response_cache import advance_response_cache_watermark  # avoid circular imports
+
+    path = path or settings.CITE_INDEX_PATH
+    case_count = CiteIndex.write(path, iter_cite_rows(), timezone.now())
+    print("Wrote %s cases to %s" % (case_count, path))
+    advance_response_cache_watermark()
+
+
+def update_cite_index(path=None):
+    """
+        Rewrite the cite index with changes to cases and citations since it was last built or updated. Only changed
+        cases are queried from the database; everything else is copied from the existing index.
+    """
+    from capapi.response_cache import advance_response_cache_watermark  # avoid circular imports
+    from capdb.models import CaseLastUpdate, CaseDeleted
+
+    path = path or settings.CITE_INDEX_PATH
+    index = CiteIndex(path)
+    timestamp = timezone.now()
+    since = datetime.fromisoformat(index.timestamp)
+    changed_ids = set(CaseLastUpdate.objects.filter(timestamp__gte=since).values_list('case_id', flat=True))
+    changed_ids.update(CaseDeleted.objects.filter(timestamp__gte=since).values_list('case_id', flat=True))
+    changed_ids = sorted(changed_ids)
+    print("Found %s changed cases" % len(changed_ids))
+    case_count = CiteIndex.write(path, iter_cite_rows(changed_ids), timestamp, base=index, replace_ids=changed_ids)
+    print("Wrote %s cases to %s" % (case_count, path))
+    advance_response_cache_watermark()
+
@@ -0,0 +1,255 @@
+import json
+import mmap
+import os
+import struct
+from array import array
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from django.conf import settings
+from django.utils import timezone
+
+
+class CitedByIndex:
+    """
+        Read-only, memory-mapped reverse citation index: for each case, the cases whose extracted citations have it in
+        target_cases, as in the casebody_data.text.opinions.extracted_citations.target_cases field in elasticsearch.
+        Written by CitedByIndex.write(), and built from ExtractedCitation by build_cited_by_index().
+
+        Cases are numbered by position in case_ids, and the cases citing node i are nodes
+        citing[offsets[i]:offsets[i+1]], sorted. Postings store int32 node numbers rather than case ids, at half the
+        size. The jurisdiction, court, reporter and decision year of each in-scope case are stored as columns aligned
+        with case_ids, so that cites_to filters on those fields can pick target cases, and citing cases can be counted
+        by jurisdiction and year, without searching elasticsearch; cases that aren't in scope have -1.
+
+        File layout:
+            b'CAPCBY02'
+            <uint32 header length> <header json: {"timestamp": <isoformat>, "jurisdictions": {slug: id}, "courts": {slug: id}}>
+            <uint64 case count> <uint64 posting count> <padding to 8 bytes>
+            <int64 case ids, sorted>
+            <int64 offset of each case's postings, plus the end offset>
+            <int32 jurisdiction id of each case> <int32 court id of each case> <int32 reporter id of each case>
+            <int32 decision year of each case> <padding to 8 bytes>
+            <int32 citing node numbers>
+
+        >>> index = CitedByIndex.from_arrays([5, 6, 6, 7], [7, 7, 5, 5])
+        >>> index.citing_ids(index.nodes([7])).tolist(), index.citing_ids(index.nodes([5, 7, 9])).tolist()
+        ([5, 6], [5, 6, 7])
+        >>> index = CitedByIndex.from_arrays([5, 6, 7], [7, 7, 5], [5, 6, 7], [1, 2, 1], [0, 0, 0], [0, 0, 0], [1990, 1991, 1990])
+        >>> index.citing_counts(index.nodes([5, 7]))
+        {1: {1990: 2}, 2: {1991: 1}}
+    """
+    magic = b'CAPCBY02'
+    columns = ('jurisdiction_ids', 'court_ids', 'reporter_ids', 'years')
+
+    # cites_to filters that can be answered from the columns, with the column they match
+    filter_columns = {
+        'jurisdiction': 'jurisdiction_ids',
+        'court': 'court_ids',
+        'court_id': 'court_ids',
+        'reporter': 'reporter_ids',
+    }
+
+    def __init__(self, path=None, arrays=None, header=None):
+        if path is None:
+            # in-memory index, for from_arrays()
+            self.mmap = None
+            self.case_ids, self.offsets, self.citing = arrays[:3]
+            for name, column in zip(self.columns, arrays[3:]):
+                setattr(self, name, column)
+            header = header or {}
+        else:
+            with open(path, 'rb') as f:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.mmap[:len(self.magic)] != self.magic:
+                raise ValueError("%s is not a cited-by index" % path)
+            pos = len(self.magic)
+            header_length, = struct.unpack_from('<I', self.mmap, pos)
+            pos += 4
+            header = json.loads(self.mmap[pos:pos+header_length])
+            pos += header_length
+            case_count, posting_count = struct.unpack_from('<QQ', self.mmap, pos)
+            pos += 16
+            pos += -pos % 8
+            self.case_ids = np.frombuffer(self.mmap, dtype='<i8', count=case_count, offset=pos)
+            pos += case_count * 8
+            self.offsets = np.frombuffer(self.mmap, dtype='<i8', count=case_count + 1, offset=pos)
+            pos += (case_count + 1) * 8
+            for name in self.columns:
+                setattr(self, name, np.frombuffer(self.mmap, dtype='<i4', count=case_count, offset=pos))
+                pos += case_count * 4
+            pos += -pos % 8
+            self.citing = np.frombuffer(self.mmap, dtype='<i4', count=posting_count, offset=pos)
+        self.timestamp = header.get('timestamp')
+        self.jurisdictions = header.get('jurisdictions', {})
+        self.courts = header.get('courts', {})
+
+    def __len__(self):
+        return len(self.case_ids)
+
+    @classmethod
+    def from_arrays(cls, citing_ids, target_ids, metadata_ids=(), jurisdiction_ids=(), court_ids=(), reporter_ids=(),
+                    years=(), header=None):
+        """
+            Build an in-memory index from the citing and target case id of each citation, and the metadata columns of
+            each in-scope case. Repeated citations are dropped.
+        """
+        from scripts.citation_graph import CitationGraph  # avoid loading capdb.models with this module
+
+        citing_ids = np.asarray(citing_ids, dtype=np.int64)
+        target_ids = np.asarray(target_ids, dtype=np.int64)
+        metadata_ids = np.asarray(metadata_ids, dtype=np.int64)
+
+        # a citation graph with edges reversed, so each case's row lists the cases citing it
+        graph = CitationGraph.from_edges(metadata_ids, target_ids, citing_ids)
+        columns = []
+        nodes = graph.index_of(metadata_ids)
+        for values in (jurisdiction_ids, court_ids, reporter_ids, years):
+            column = np.full(graph.node_count, -1, dtype=np.int32)
+            column[nodes] = values
+            columns.append(column)
+        return cls(arrays=[graph.ids, graph.offsets, graph.targets, *columns], header=header)
+
+    def nodes(self, case_ids):
+        """ Return node numbers of each of case_ids that is in the index. """
+        case_ids = np.asarray(case_ids, dtype=np.int64)
+        if not len(self) or not len(case_ids):
+            return np.zeros(0, dtype=np.int64)
+        nodes = np.minimum(np.searchsorted(self.case_ids, case_ids), len(self) - 1)
+        return nodes[self.case_ids[nodes] == case_ids]
+
+    def select(self, params):
+        """
+            Given cites_to filter params like {'jurisdiction': 'ill'}, return node numbers of in-scope cases that match
+            all of them, or None if any param can't be answered from the columns. Slugs the index doesn't know are
+            left to the search path, which rejects invalid ones and finds ones added since the index was built.
+        """
+        if not params or any(key not in self.filter_columns for key in params):
+            return None
+        mask = np.ones(len(self), dtype=bool)
+        for key, value in params.items():
+            if key == 'jurisdiction':
+                value = self.jurisdictions.get(value)
+            elif key == 'court':
+                value = self.courts.get(value)
+            else:
+                try:
+                    value = int(value)
+                except ValueError:
+                    return None
+            if value is None:
+                return None
+            mask &= getattr(self, self.filter_columns[key]) == value
+        return np.flatnonzero(mask)
+
+    def citing_nodes(self, nodes):
+        """ Return the sorted, distinct node numbers of cases citing any of nodes. """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        starts = self.offsets[nodes]
+        counts = self.offsets[nodes + 1] - starts
+        edge_starts = np.cumsum(counts) - counts
+        edges = np.repeat(starts - edge_starts, counts) + np.arange(counts.sum())
+        return np.unique(self.citing[edges])
+
+    def citing_ids(self, nodes):
+        """ Return the sorted, distinct ids of cases citing any of nodes. """
+        return self.case_ids[self.citing_nodes(nodes)]
+
+    def citing_counts(self, nodes):
+        """ Count the distinct in-scope cases citing any of nodes, as {jurisdiction id: {decision year: count}}. """
+        citing = self.citing_nodes(nodes)
+        jurisdiction_ids = self.jurisdiction_ids[citing]
+        years = self.years[citing]
+        in_scope = (jurisdiction_ids >= 0) & (years >= 0)
+        pairs, counts = np.unique(
+            np.stack([jurisdiction_ids[in_scope], years[in_scope]]).astype(np.int64), axis=1, return_counts=True)
+        out = {}
+        for (jurisdiction_id, year), count in zip(pairs.T.tolist(), counts.tolist()):
+            out.setdefault(jurisdiction_id, {})[year] = count
+        return out
+
+    def write(self, path):
+        """ Atomically write this index to path. """
+        header = json.dumps({
+            'timestamp': self.timestamp,
+            'jurisdictions': self.jurisdictions,
+            'courts': self.courts,
+        }).encode('utf8')
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            out = bytearray(self.magic)
+            out += struct.pack('<I', len(header)) + header
+            out += struct.pack('<QQ', len(self), len(self.citing))
+            out += bytes(-len(out) % 8)
+            f.write(out)
+            pos = len(out)
+            for values, dtype in [(self.case_ids, '<i8'), (self.offsets, '<i8')] + [(getattr(self, name), '<i4') for name in self.columns]:
+                data = np.asarray(values).astype(dtype).tobytes()
+                f.write(data)
+                pos += len(data)
+            f.write(bytes(-pos % 8))
+            f.write(np.asarray(self.citing).astype('<i4').tobytes())
+        os.replace(temp_path, path)
+
+
+_cited_by_index_cache = {}
+
+
+def get_cited_by_index():
+    """
+        Return the memory-mapped CitedByIndex at settings.CITED_BY_INDEX_PATH, reloaded if the file is replaced, or
+        None if it hasn't been built or was built more than settings.CITED_BY_INDEX_MAX_AGE_HOURS ago.
+    """
+    path = settings.CITED_BY_INDEX_PATH
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    file_key = (path, stat.st_ino, stat.st_mtime_ns)
+    if _cited_by_index_cache.get('file_key') != file_key:
+        try:
+            index = CitedByIndex(path)
+        except ValueError:
+            # written in an older format; ignored until the next rebuild
+            return None
+        _cited_by_index_cache.update(file_key=file_key, value=index)
+    index = _cited_by_index_cache['value']
+    if not index.timestamp or datetime.fromisoformat(index.timestamp) < timezone.now() - timedelta(hours=settings.CITED_BY_INDEX_MAX_AGE_HOURS):
+        return None
+    return index
+
+
+def build_cited_by_index(path=None, chunk_size=10000):
+    """ Write the cited-by index for all extracted citations, with metadata columns for all in-scope cases. """
+    from capapi.response_cache import advance_response_cache_watermark  # avoid circular imports
+    from capdb.models import CaseMetadata, Court, ExtractedCitation, Jurisdiction
+
+    path = path or settings.CITED_BY_INDEX_PATH
+    timestamp = timezone.now()
+
+    citing_ids = array('q')
+    target_ids = array('q')
+    citations = ExtractedCitation.objects.exclude(target_cases=None).values_list('cited_by_id', 'target_cases')
+    for cited_by_id, target_cases in citations.iterator(chunk_size=chunk_size):
+        citing_ids.extend([cited_by_id] * len(target_cases))
+        target_ids.extend(target_cases)
+
+    metadata = [array('q') for _ in range(5)]
+    cases = CaseMetadata.objects.filter(in_scope=True, volume__out_of_scope=False).order_by().values_list(
+        'id', 'jurisdiction_id', 'court_id', 'reporter_id', 'decision_date__year')
+    for row in cases.iterator(chunk_size=chunk_size):
+        for column, value in zip(metadata, row):
+            column.append(-1 if value is None else value)
+
+    index = CitedByIndex.from_arrays(
+        np.frombuffer(citing_ids, dtype=np.int64), np.frombuffer(target_ids, dtype=np.int64),
+        *[np.frombuffer(column, dtype=np.int64) for column in metadata],
+        header={
+            'timestamp': timestamp.isoformat(),
+            'jurisdictions': dict(Jurisdiction.objects.values_list('slug', 'id')),
+            'courts': dict(Court.objects.values_list('slug', 'id')),
+        })
+    index.write(path)
+    print("Wrote %s cases and %s citations to %s" % (len(index), len(index.citing), path))
+    advance_response_cache_watermark()
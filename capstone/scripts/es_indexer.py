@@ -0,0 +1,235 @@
+"""
+    Streaming, concurrent bulk indexing of cases into elasticsearch.
+
+    Cases are turned into bulk actions by prepare_case_actions(), optionally in a pool of forked processes, and sent
+    by a BulkIndexer, which packs actions into bulk requests of roughly chunk_bytes, keeps several requests in flight
+    at once, and retries individual actions that elasticsearch rejects with 429 (Too Many Requests).
+
+    Usage:
+        indexer = BulkIndexer()
+        failures = indexer.index(prepare_case_actions(cases))  # {case id: error} for actions that couldn't be indexed
+"""
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
+
+import billiard
+from django.conf import settings
+from django.db import connections
+from elasticsearch import ConnectionTimeout, TransportError
+from elasticsearch.serializer import JSONSerializer
+
+
+serializer = JSONSerializer()
+
+
+### PREPARING ACTIONS ###
+
+@lru_cache(None)
+def get_documents():
+    from capapi.documents import CaseDocument, ResolveDocument  # avoid circular import
+    return CaseDocument(), ResolveDocument()
+
+
+def case_actions(case):
+    """
+        Return [(case id, op_type, bulk lines)] to index case in each document index, or to delete it from each index
+        if it is out of scope. This matches what CaseMetadata.reindex_cases() sends.
+    """
+    op_type = 'index' if case.in_scope and not case.volume.out_of_scope else 'delete'
+    actions = []
+    for document in get_documents():
+        lines = serializer.dumps({op_type: {'_index': document._index._name, '_id': document.generate_id(case)}}) + '\n'
+        if op_type == 'index':
+            lines += serializer.dumps(document.prepare(case)) + '\n'
+        actions.append((case.id, op_type, lines.encode('utf8')))
+    return actions
+
+
+# state set in each prepare worker by init_prepare_worker()
+_prepare_worker_state = {}
+
+
+def init_prepare_worker(cases):
+    """
+        Pool initializer for prepare_case_actions(processes=...). Workers are forked, so cases are a read-only
+        copy-on-write snapshot. Inherited database connections are set aside rather than closed, as in
+        capdb.models.init_render_worker().
+    """
+    _prepare_worker_state['inherited_connections'] = [connections[alias] for alias in connections]
+    for alias in connections:
+        del connections[alias]
+    _prepare_worker_state['cases'] = cases
+
+
+def prepare_case_actions_worker(i):
+    """ Pool worker for prepare_case_actions(processes=...). """
+    return case_actions(_prepare_worker_state['cases'][i])
+
+
+def prepare_case_actions(cases, processes=None):
+    """
+        Yield case_actions() for each of cases, in order. cases should be fetched with .for_indexing().
+        If processes is more than 1 (default settings.ELASTICSEARCH_INDEXER_PROCESSES), documents are prepared and
+        serialized in a pool of forked processes. The pool comes from billiard, celery's fork of multiprocessing,
+        because this runs in daemonic celery workers, which multiprocessing won't start a pool from.
+    """
+    if processes is None:
+        processes = settings.ELASTICSEARCH_INDEXER_PROCESSES
+    cases = list(cases)
+    if processes > 1 and len(cases) > 1:
+        pool = billiard.get_context('fork').Pool(
+            min(processes, len(cases)),
+            initializer=init_prepare_worker,
+            initargs=(cases,))
+        try:
+            for actions in pool.imap(prepare_case_actions_worker, range(len(cases)), chunksize=8):
+                yield from actions
+        finally:
+            pool.terminate()
+    else:
+        for case in cases:
+            yield from case_actions(case)
+
+
+### SENDING ACTIONS ###
+
+class IndexerStats:
+    """ Thread-safe counts of what a BulkIndexer has sent, printed every report_interval seconds. """
+    def __init__(self, report_interval):
+        self.report_interval = report_interval
+        self.lock = threading.Lock()
+        self.start = self.last_report = time.monotonic()
+        self.docs = self.bytes = self.requests = self.retries = self.failures = 0
+
+    def add(self, docs=0, bytes=0, requests=0, retries=0, failures=0):
+        with self.lock:
+            self.docs += docs
+            self.bytes += bytes
+            self.requests += requests
+            self.retries += retries
+            self.failures += failures
+            now = time.monotonic()
+            if self.report_interval is not None and now - self.last_report >= self.report_interval:
+                self.last_report = now
+                print(self.report())
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return "Indexed %s docs in %.1fs (%.0f docs/s, %.2f MB/s) with %s requests, %s retries, %s failures" % (
+            self.docs, elapsed, self.docs / elapsed, self.bytes / elapsed / 1024**2, self.requests, self.retries,
+            self.failures)
+
+
+class BulkIndexer:
+    """
+        Send (key, op_type, bulk lines) actions to elasticsearch in concurrent bulk requests.
+
+        Actions are packed into requests of about chunk_bytes, with up to `threads` requests in flight; reading from
+        the actions iterable pauses while all threads are busy. After each response chunk_bytes is scaled toward
+        requests that take target_seconds, within [min_chunk_bytes, max_chunk_bytes], and halved if any action was
+        rejected with 429. Rejected actions, and whole requests that got 429 or timed out, are retried on their own
+        with exponential backoff, up to max_retries times. Deleting a missing document is not an error.
+
+        Settings default to the ELASTICSEARCH_INDEXER_* settings.
+    """
+    def __init__(self, client=None, threads=None, chunk_bytes=None, min_chunk_bytes=None, max_chunk_bytes=None,
+                 target_seconds=None, max_retries=None, initial_backoff=None, max_backoff=None, report_interval=10):
+        self.client = client
+        self.threads = threads or settings.ELASTICSEARCH_INDEXER_THREADS
+        self.chunk_bytes = chunk_bytes or settings.ELASTICSEARCH_INDEXER_CHUNK_BYTES
+        self.min_chunk_bytes = min_chunk_bytes or settings.ELASTICSEARCH_INDEXER_MIN_CHUNK_BYTES
+        self.max_chunk_bytes = max_chunk_bytes or settings.ELASTICSEARCH_INDEXER_MAX_CHUNK_BYTES
+        self.target_seconds = target_seconds or settings.ELASTICSEARCH_INDEXER_TARGET_SECONDS
+        self.max_retries = settings.ELASTICSEARCH_INDEXER_MAX_RETRIES if max_retries is None else max_retries
+        self.initial_backoff = settings.ELASTICSEARCH_INDEXER_INITIAL_BACKOFF if initial_backoff is None else initial_backoff
+        self.max_backoff = settings.ELASTICSEARCH_INDEXER_MAX_BACKOFF if max_backoff is None else max_backoff
+        self.stats = IndexerStats(report_interval)
+        self.lock = threading.Lock()
+
+    def get_client(self):
+        if self.client is None:
+            self.client = get_documents()[0]._get_connection()
+        return self.client
+
+    def index(self, actions):
+        """ Send all actions, and return {key: error} for keys where any action failed. """
+        failures = {}
+        in_flight = set()
+
+        def collect(futures):
+            for future in futures:
+                for key, error in future.result().items():
+                    failures.setdefault(key, error)
+
+        with ThreadPoolExecutor(self.threads) as executor:
+            chunk = []
+            chunk_size = 0
+            for action in actions:
+                chunk.append(action)
+                chunk_size += len(action[2])
+                if chunk_size >= self.chunk_bytes:
+                    if len(in_flight) >= self.threads:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    in_flight.add(executor.submit(self.send_chunk, chunk))
+                    chunk = []
+                    chunk_size = 0
+            if chunk:
+                in_flight.add(executor.submit(self.send_chunk, chunk))
+            collect(in_flight)
+        if self.stats.report_interval is not None:
+            print(self.stats.report())
+        return failures
+
+    def backoff(self, attempt):
+        time.sleep(min(self.max_backoff, self.initial_backoff * 2 ** attempt))
+
+    def adjust_chunk_bytes(self, seconds, rejected):
+        with self.lock:
+            if rejected:
+                scale = 0.5
+            else:
+                scale = min(2, max(0.5, self.target_seconds / max(seconds, 1e-3)))
+            self.chunk_bytes = int(min(self.max_chunk_bytes, max(self.min_chunk_bytes, self.chunk_bytes * scale)))
+
+    def send_chunk(self, chunk):
+        """ Send one bulk request for chunk, retrying rejected actions, and return {key: error} for failures. """
+        client = self.get_client()
+        failures = {}
+        attempt = 0
+        while chunk:
+            start = time.monotonic()
+            try:
+                response = client.bulk(b''.join(lines for _, _, lines in chunk), filter_path='items.*.status,items.*.error')
+            except TransportError as e:
+                if (e.status_code != 429 and not isinstance(e, ConnectionTimeout)) or attempt >= self.max_retries:
+                    raise
+                self.adjust_chunk_bytes(0, True)
+                self.stats.add(requests=1, retries=len(chunk))
+                self.backoff(attempt)
+                attempt += 1
+                continue
+
+            retry = []
+            docs = 0
+            sent_bytes = 0
+            for (key, op_type, lines), item in zip(chunk, response['items']):
+                result = item[op_type]
+                status = result['status']
+                if 200 <= status < 300 or (op_type == 'delete' and status == 404):
+                    docs += 1
+                    sent_bytes += len(lines)
+                elif status == 429 and attempt < self.max_retries:
+                    retry.append((key, op_type, lines))
+                else:
+                    failures.setdefault(key, result)
+            self.adjust_chunk_bytes(time.monotonic() - start, bool(retry))
+            self.stats.add(docs=docs, bytes=sent_bytes, requests=1, retries=len(retry),
+                           failures=len(chunk) - docs - len(retry))
+            if retry:
+                self.backoff(attempt)
+                attempt += 1
+            chunk = retry
+        return failures
@@ -1,12 +1,16 @@
 import json
 import lzma
+import shutil
 import tempfile
 import zipfile
 from io import StringIO
 from datetime import date
+from itertools import islice
 from pathlib import Path
+import billiard
 from celery import shared_task
 from django.conf import settings
+from django.db import connections
 
 from django.template.loader import render_to_string
 from django.utils import timezone
@@ -16,6 +20,7 @@ from capapi.resources import call_serializer
 from capapi.serializers import NoLoginCaseDocumentSerializer, CaseDocumentSerializer
 from capdb.models import Jurisdiction, Reporter
 from capdb.storages import download_files_storage
+from scripts.body_store import get_bodies
 from scripts.helpers import HashingFile
 
 
@@ -108,12 +113,93 @@ def try_to_close(file_handle):
             pass
 
 
-def export_case_documents(cases, zip_path, filter_item, public=False):
+# state set in each export worker by init_export_worker()
+_export_worker_state = {}
+
+
+def init_export_worker(cases, formats, shard_dir, slice_count):
+    """
+        Pool initializer for export_case_documents(processes=...). Workers are forked, so database and elasticsearch
+        connections inherited from the parent are set aside without being closed, and each worker opens its own.
+    """
+    from elasticsearch_dsl.connections import connections as es_connections
+
+    _export_worker_state['inherited_connections'] = [connections[alias] for alias in connections]
+    for alias in connections:
+        del connections[alias]
+    for alias, kwargs in settings.ELASTICSEARCH_DSL.items():
+        try:
+            _export_worker_state['inherited_connections'].append(es_connections.get_connection(alias))
+        except KeyError:
+            pass
+        es_connections.remove_connection(alias)
+        es_connections.create_connection(alias, **kwargs)
+    _export_worker_state['export'] = (cases, formats, shard_dir, slice_count)
+
+
+def export_shard(slice_id):
+    """
+        Pool worker for export_case_documents(processes=...). Write the cases in one slice of the search to an .xz
+        shard file for each of formats, {format_name: (serializer, query_params)}, and return the number of cases
+        written. With one slice, this is the whole search.
+    """
+    cases, formats, shard_dir, slice_count = _export_worker_state['export']
+    if slice_count > 1:
+        cases = cases.extra(slice={'id': slice_id, 'max': slice_count})
+    out_files = {}
+    count = 0
+    try:
+        for format_name in formats:
+            out_files[format_name] = lzma.open(shard_path(shard_dir, format_name, slice_id), 'w')
+        hits = cases.scan()
+        while True:
+            batch = list(islice(hits, 1000))
+            if not batch:
+                break
+            if 'xml' in formats:
+                fetch_missing_bodies(batch, 'xml')
+            for item in batch:
+                for format_name, (serializer, query_params) in formats.items():
+                    data = call_serializer(serializer, item['_source'], query_params)
+                    out_files[format_name].write(bytes(json.dumps(data), 'utf8') + b'\n')
+            count += len(batch)
+    finally:
+        for out_file in out_files.values():
+            out_file.close()
+    return count
+
+
+def shard_path(shard_dir, format_name, slice_id):
+    return Path(shard_dir, '%s-%04d.jsonl.xz' % (format_name, slice_id))
+
+
+def fetch_missing_bodies(hits, body_format):
+    """
+        Add body_format to casebody_data for hits where it's kept outside of elasticsearch, so the serializer doesn't
+        fetch it one case at a time.
+    """
+    missing = {hit['_source']['id']: hit['_source']['casebody_data'].get('body_ref') for hit in hits
+               if body_format not in hit['_source']['casebody_data']}
+    if missing:
+        bodies = get_bodies(missing, body_format)
+        for hit in hits:
+            if hit['_source']['id'] in bodies:
+                hit['_source']['casebody_data'][body_format] = bodies[hit['_source']['id']]
+
+
+def export_case_documents(cases, zip_path, filter_item, public=False, processes=None):
     """
         Export cases in queryset to dir_name.zip.
         filter_item is the Jurisdiction or Reporter used to select the cases.
         public controls whether export is downloadable by non-researchers.
+        If processes is more than 1 (default settings.EXPORT_PROCESSES), the search is split into that many sliced
+        scrolls, each exported to compressed shards by a forked worker process. Shards are concatenated in order
+        into data.jsonl.xz, which is valid because an xz file can be made of multiple streams. Workers are forked
+        with billiard, celery's fork of multiprocessing, because the export tasks run in daemonic celery workers,
+        which multiprocessing won't start a pool from.
     """
+    if processes is None:
+        processes = settings.EXPORT_PROCESSES
 
     formats = {
         'xml': {
@@ -130,6 +216,7 @@ def export_case_documents(cases, zip_path, filter_item, public=False):
         }
     }
 
+    shard_dir = tempfile.TemporaryDirectory()
     try:
         # set up vars for each format
         for format_name, vars in list(formats.items()):
@@ -160,18 +247,36 @@ def export_case_documents(cases, zip_path, filter_item, public=False):
             vars['archive'] = zipfile.ZipFile(vars['out_spool'], 'w', zipfile.ZIP_STORED)
             vars['data_file'] = tempfile.NamedTemporaryFile()
             vars['hashing_data_file'] = HashingFile(vars['data_file'], 'sha512')
-            vars['compressed_data_file'] = lzma.open(vars['hashing_data_file'], "w")
 
-        # write each case
-        for item in cases.scan():
-            for format_name, vars in formats.items():
-                data = call_serializer(vars['serializer'], item['_source'], vars['query_params'])
-                vars['compressed_data_file'].write(bytes(json.dumps(data), 'utf8') + b'\n')
+        if not formats:
+            return
+
+        # write each slice of cases to shard files
+        shard_formats = {format_name: (vars['serializer'], vars['query_params']) for format_name, vars in formats.items()}
+        if processes > 1:
+            pool = billiard.get_context('fork').Pool(
+                processes,
+                initializer=init_export_worker,
+                initargs=(cases, shard_formats, shard_dir.name, processes))
+            try:
+                case_count = sum(pool.imap_unordered(export_shard, range(processes)))
+            finally:
+                pool.terminate()
+        else:
+            _export_worker_state['export'] = (cases, shard_formats, shard_dir.name, 1)
+            case_count = export_shard(0)
+        print("Exported %s cases for %s" % (case_count, filter_item))
 
         # finish bag for each format
         for format_name, vars in formats.items():
+            # concatenate shards into temp data file
+            for slice_id in range(max(processes, 1)):
+                path = shard_path(shard_dir.name, format_name, slice_id)
+                with path.open('rb') as shard:
+                    shutil.copyfileobj(shard, vars['hashing_data_file'], 1024 * 1024)
+                path.unlink()
+
             # write temp data file to bag
-            vars['compressed_data_file'].close()
             vars['data_file'].flush()
             vars['payload'].append("%s %s" % (vars['hashing_data_file'].hexdigest(), vars['data_file_path']))
             vars['archive'].write(vars['data_file'].name, str(vars['internal_path'] / vars['data_file_path']))
@@ -191,5 +296,6 @@ def export_case_documents(cases, zip_path, filter_item, public=False):
     finally:
         # in case of error, make sure anything opened was closed
         for format_name, vars in formats.items():
-            for file_handle in ('compressed_data_file', 'data_file', 'archive', 'out_spool'):
+            for file_handle in ('data_file', 'archive', 'out_spool'):
                 try_to_close(vars.get(file_handle))
+        shard_dir.cleanup()
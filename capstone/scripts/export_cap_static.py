@@ -13,14 +13,19 @@ from tqdm import tqdm
 from capapi.documents import CaseDocument
 from capapi.resources import call_serializer
 from capapi.serializers import VolumeSerializer, NoLoginCaseDocumentSerializer, ReporterSerializer
-from capdb.models import Reporter, VolumeMetadata, Jurisdiction, CaseMetadata
+from capdb.models import Reporter, VolumeMetadata, Jurisdiction, CaseMetadata, CaseLastUpdate
 from capdb.tasks import record_task_status_for_volume
 from capweb.helpers import select_raw_sql
 from scripts.helpers import parse_html, serialize_html
+from scripts.static_paths import build_static_path_table, get_static_paths
 from scripts.update_snippets import get_map_numbers
 
+# version of the export format recorded in ExportManifest.json
+MANIFEST_VERSION = 1
+
 # steps:
-# - export volumes: fab export_cap_static_volumes calls export_cases_by_volume()
+# - export volumes: fab export_cap_static_volumes calls export_cases_by_volume(), which skips volumes whose
+#   ExportManifest.json shows they haven't changed
 # - export reporter metadata: fab summarize_cap_static calls finalize_reporters()
 # - (not in codebase yet) copy PDFs and captars from one part of S3 to another
 
@@ -152,14 +157,20 @@ def export_cases_by_volume(self, volume_id: str, dest_dir: str) -> None:
     with record_task_status_for_volume(self, volume_id):
         volume = VolumeMetadata.objects.select_related("reporter").get(pk=volume_id)
         dest_dir = Path(dest_dir)
-        export_volume(volume, dest_dir / "redacted")
+        manifest = export_volume(volume, dest_dir / "redacted")
 
         # export unredacted version of redacted volumes
         if settings.REDACTION_KEY and volume.redacted:
+            # the unredacted export depends on the same inputs, so check them before the expensive unredact step.
+            # unredacting also touches the cases' last_updated, so record the manifest from before.
+            if manifest:
+                manifest = dict(manifest, redacted=False)
+                if volume_is_unchanged(volume, dest_dir / "unredacted", manifest):
+                    return
             # use a transaction to temporarily unredact the volume, then roll back
             with transaction.atomic('capdb'):
                 volume.unredact(replace_pdf=False)
-                export_volume(volume, dest_dir / "unredacted")
+                export_volume(volume, dest_dir / "unredacted", manifest)
                 transaction.set_rollback(True, using='capdb')
 
 
@@ -167,6 +178,7 @@ def set_case_static_file_names(missing_only=True) -> None:
     """
     Set static_file_name for all cases.
     If two cases start on page 123, they will be named '0123-01' and '0123-02'.
+    Then rebuild the static path table that export_volume() reads them from.
     """
     volumes = VolumeMetadata.objects.select_related("reporter").filter(out_of_scope=False)
     if missing_only:
@@ -186,23 +198,25 @@ def set_case_static_file_names(missing_only=True) -> None:
             case.static_file_name = f"/{reporter_prefix}/{volume_prefix}/{case.first_page:0>4}-{case_file_name_index:0>2}"
         CaseMetadata.objects.bulk_update(cases, ["static_file_name"])
 
+    # write the table of case paths used by export_volume() to link citations
+    build_static_path_table()
+
 
-def export_volume(volume: VolumeMetadata, dest_dir: Path) -> None:
+def export_volume(volume: VolumeMetadata, dest_dir: Path, manifest: dict = None) -> dict:
     """
     Write a .json file for each case per volume.
     Write an .html file for each case per volume.
     Write a .json file with all case metadata per volume.
     Write a .json file with all volume metadata for this collection.
+    Write an ExportManifest.json file with the inputs of the export, and skip the volume if they haven't changed
+    since it was last exported. If manifest is provided, it's used instead of the current inputs.
+    Return the manifest, or None if the volume has no cases.
     """
     # set up vars
     print("Exporting volume", volume.get_frontend_url())
     reporter_prefix, volume_prefix = get_prefixes(volume)
     volume_dir = dest_dir / reporter_prefix / volume_prefix
 
-    # don't overwrite existing volumes
-    if volume_dir.exists():
-        return
-
     # find cases to write
     cases = list(volume.case_metadatas.filter(in_scope=True).for_indexing().order_by('case_id'))
     if not cases:
@@ -211,11 +225,13 @@ def export_volume(volume: VolumeMetadata, dest_dir: Path) -> None:
 
     # fetch paths of cited cases
     cited_case_ids = {i for c in cases for e in c.extracted_citations.all() for i in e.target_cases or []}
-    case_paths_by_id = dict(CaseMetadata.objects.filter(
-        id__in=cited_case_ids,
-        in_scope=True,
-        volume__out_of_scope=False,
-    ).exclude(static_file_name=None).values_list("id", "static_file_name"))
+    case_paths_by_id = get_static_paths(cited_case_ids)
+
+    # don't rewrite volumes whose inputs haven't changed
+    if manifest is None:
+        manifest = get_export_manifest(volume, cases, case_paths_by_id)
+    if volume_is_unchanged(volume, dest_dir, manifest):
+        return manifest
 
     # set up temp volume dir
     temp_dir = tempfile.TemporaryDirectory()
@@ -281,7 +297,10 @@ def export_volume(volume: VolumeMetadata, dest_dir: Path) -> None:
 
         # write html file
         # update the urls inserted by scripts.extract_cites.extract_citations()
-        html = search_item["casebody_data"]["html"]
+        html = search_item["casebody_data"].get("html")
+        if html is None:
+            # left out of the search index format if settings.ELASTICSEARCH_BODY_STORE is set
+            html = case.redact_obj(case.body_cache.html)
         pq_html = parse_html(html)
         for el in pq_html("a.citation"):
             # handle citations to documents outside our collection
@@ -309,10 +328,55 @@ def export_volume(volume: VolumeMetadata, dest_dir: Path) -> None:
 
     # write metadata file
     write_json(temp_volume_dir / "CasesMetadata.json", case_metadatas)
+    write_json(temp_volume_dir / "ExportManifest.json", manifest)
 
-    # move to real directory
+    # move to real directory, replacing any previous export
     volume_dir.parent.mkdir(exist_ok=True, parents=True)
-    shutil.copytree(temp_volume_dir, volume_dir)
+    new_volume_dir = volume_dir.with_name(volume_dir.name + ".new")
+    shutil.rmtree(new_volume_dir, ignore_errors=True)
+    shutil.copytree(temp_volume_dir, new_volume_dir)
+    if volume_dir.exists():
+        shutil.rmtree(volume_dir)
+    new_volume_dir.rename(volume_dir)
+    return manifest
+
+
+def get_export_manifest(volume: VolumeMetadata, cases: list, case_paths_by_id: dict) -> dict:
+    """
+    Return the inputs that determine a volume's export: when each case was last updated, the sha256 of its text,
+    its static path, and the static paths of the cases it cites. cases must be fetched with .for_indexing().
+    Bump MANIFEST_VERSION when the export format changes, to re-export everything.
+    """
+    case_inputs = {}
+    for case in cases:
+        try:
+            last_updated = case.last_update.timestamp.isoformat()
+        except CaseLastUpdate.DoesNotExist:
+            last_updated = None
+        case_inputs[str(case.id)] = {
+            "static_file_name": case.static_file_name,
+            "last_updated": last_updated,
+            "sha256": next((a.value for a in case.analysis.all() if a.key == "sha256"), None),
+        }
+    return {
+        "version": MANIFEST_VERSION,
+        "redacted": volume.redacted,
+        "cases": case_inputs,
+        "cited_case_paths": {str(k): v for k, v in sorted(case_paths_by_id.items())},
+    }
+
+
+def volume_is_unchanged(volume: VolumeMetadata, dest_dir: Path, manifest: dict) -> bool:
+    """ Return True, and report the volume as skipped, if it was already exported to dest_dir with manifest. """
+    reporter_prefix, volume_prefix = get_prefixes(volume)
+    manifest_path = dest_dir / reporter_prefix / volume_prefix / "ExportManifest.json"
+    try:
+        unchanged = json.loads(manifest_path.read_text()) == manifest
+    except (FileNotFoundError, ValueError):
+        return False
+    if unchanged:
+        print(f"Skipping unchanged volume {volume.barcode} in {dest_dir}")
+    return unchanged
 
 
 def volume_to_dict(volume: VolumeMetadata) -> dict:
@@ -16,6 +16,7 @@ from eyecite.tokenizers import HyperscanTokenizer, EXTRACTORS
 from eyecite.utils import is_balanced_html
 
 from capweb.helpers import reverse
+from scripts.cite_index import get_cite_index
 from scripts.helpers import serialize_xml, parse_xml, serialize_html, alphanum_lower, parse_html, clean_punctuation
 
 
@@ -82,22 +83,27 @@ def extract_citations(case, html, xml):
 
     # Look up cases referred to by cites. cases_by_cite gets populated like:
     #   cases_by_cite['cite']['1 U.S. 1'] = {(<case_id>, <decision_date_original>, <frontend_url>)}
-    cases_by_cite = {c: defaultdict(set) for c in cites_by_type}
-    target_cites = (Citation
-        .objects
-        .filter(case__in_scope=True)
-        .filter(
-            Q(cite__in=cites_by_type['cite']) |
-            Q(normalized_cite__in=cites_by_type['normalized_cite']) |
-            Q(rdb_cite__in=cites_by_type['rdb_cite']) |
-            Q(rdb_normalized_cite__in=cites_by_type['rdb_normalized_cite']))
-        .select_related('case')
-    )
-    for cite in target_cites:
-        for cite_type in cites_by_type:
-            cite_str = getattr(cite, cite_type)
-            if cite_str:
-                cases_by_cite[cite_type][cite_str].add(cite.case)
+    # using the shared cite index if it has been built, or else the database.
+    cite_lookup_index = get_cite_index()
+    if cite_lookup_index:
+        cases_by_cite = cite_lookup_index.lookup(cites_by_type)
+    else:
+        cases_by_cite = {c: defaultdict(set) for c in cites_by_type}
+        target_cites = (Citation
+            .objects
+            .filter(case__in_scope=True)
+            .filter(
+                Q(cite__in=cites_by_type['cite']) |
+                Q(normalized_cite__in=cites_by_type['normalized_cite']) |
+                Q(rdb_cite__in=cites_by_type['rdb_cite']) |
+                Q(rdb_normalized_cite__in=cites_by_type['rdb_normalized_cite']))
+            .select_related('case')
+        )
+        for cite in target_cites:
+            for cite_type in cites_by_type:
+                cite_str = getattr(cite, cite_type)
+                if cite_str:
+                    cases_by_cite[cite_type][cite_str].add(cite.case)
 
     def resolve_full_cite(eyecite_cite):
         # use builtin resolver for non-case citations
@@ -107,12 +113,12 @@ def extract_citations(case, html, xml):
         normalized_forms = eyecite_cite.normalized_forms
 
         # get potential case or cases pointed to by cite
-        matches = tuple(
+        matches = tuple(sorted(
             cases_by_cite['cite'].get(normalized_forms['cite']) or
             cases_by_cite['normalized_cite'].get(normalized_forms['normalized_cite']) or
             cases_by_cite['rdb_cite'].get(normalized_forms['rdb_cite']) or
-            cases_by_cite['rdb_normalized_cite'].get(normalized_forms['rdb_normalized_cite'], set())
-        )
+            cases_by_cite['rdb_normalized_cite'].get(normalized_forms['rdb_normalized_cite'], set()),
+            key=lambda m: m.id))
 
         # filter matches by date
         if len(matches) > 1:
@@ -126,7 +132,7 @@ def extract_citations(case, html, xml):
 
     clusters = resolve_citations(eyecite_cites, resolve_full_citation=resolve_full_cite)
     # skip citations to self, typically from parallel cites in header
-    clusters = {k: v for k, v in clusters.items() if not isinstance(k, tuple) or case not in k}
+    clusters = {k: v for k, v in clusters.items() if not isinstance(k, tuple) or case.id not in {r.id for r in k}}
     resolution_by_cite = {cite: resolution for resolution, cites in clusters.items() for cite in cites}
 
     # annotate each citation:
@@ -147,7 +153,7 @@ def extract_citations(case, html, xml):
             if isinstance(resolution, Resource):
                 target_url = cite_home_url + "/citations/?q=" + urllib.parse.quote(corrected_cite)
             else:
-                # cite resolved to a tuple of CaseMetadata objects
+                # cite resolved to a tuple of CiteTarget or CaseMetadata objects
                 case_ids_attr = ','.join(sorted(str(r.id) for r in resolution))
                 if len(resolution) == 1:
                     # attempt to jump directly to cited page, if pin cite starts with digits
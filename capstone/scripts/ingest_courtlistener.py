@@ -11,15 +11,33 @@ from tqdm import tqdm
 
 from scripts.helpers import alphanum_lower
 from capapi.documents import ResolveDocument
-from scripts.simhash import get_simhash
+from scripts.simhash import get_simhashes
 
 
-def load_cluster(args):
+def load_clusters(args):
     """
-        Load a single CourtListener cluster with its opinions from disk, and return metadata.
+        Load a chunk of CourtListener clusters with their opinions from disk, and return a list of metadata.
+        Simhashes for the whole chunk are computed in a single get_simhashes() call.
         This is called within a process pool; see ingest_courtlistener for how it's used.
     """
-    cluster_member, opinions_dir = args
+    cluster_members, opinions_dir = args
+    documents = []
+    texts = []
+    for cluster_member in cluster_members:
+        result = load_cluster(cluster_member, opinions_dir)
+        if result:
+            document, text = result
+            documents.append(document)
+            texts.append(text)
+    for document, simhash in zip(documents, get_simhashes(texts)):
+        document['simhash'] = simhash
+    return documents
+
+
+def load_cluster(cluster_member, opinions_dir):
+    """
+        Load a single CourtListener cluster with its opinions from disk, and return (metadata, opinion text).
+    """
     with cluster_member.open() as f:
         cluster = json.load(f)
 
@@ -60,7 +78,7 @@ def load_cluster(args):
             'page_int': page_int,
         })
 
-    # return metadata
+    # return metadata and text to be simhashed
     return {
         'id': f"cl-{cluster['id']}",
         'source': 'cl',
@@ -71,11 +89,10 @@ def load_cluster(args):
         'decision_date': cluster['date_filed'],
         'frontend_url': 'https://www.courtlistener.com' + cluster['absolute_url'],
         'api_url': cluster['resource_uri'].replace(':80/', '/'),
-        'simhash': get_simhash("\n".join(opinion_texts))
-    }
+    }, "\n".join(opinion_texts)
 
 
-def ingest_courtlistener(download_dir='/tmp', start_from=None):
+def ingest_courtlistener(download_dir='/tmp', start_from=None, chunk_size=100):
     """ Download CourtListener cases and add metadata to citation resolver endpoint. """
     download_dir = Path(download_dir)
     opinions_file = download_dir / 'opinions.tar'
@@ -115,8 +132,9 @@ def ingest_courtlistener(download_dir='/tmp', start_from=None):
             opinions_dir.mkdir()
             run(f"tar -xOf {clusters_file} {jurisdiction_file} | tar -C {clusters_dir} -zxf -", shell=True)
             run(f"tar -xOf {opinions_file} {jurisdiction_file} | tar -C {opinions_dir} -zxf -", shell=True)
-            documents = pool.imap_unordered(load_cluster, ((cluster_member, opinions_dir) for cluster_member in clusters_dir.glob("*.json")))
-            ResolveDocument().update(tqdm(d for d in documents if d), parallel=True)
+            cluster_members = list(clusters_dir.glob("*.json"))
+            chunks = pool.imap_unordered(load_clusters, ((cluster_members[i:i+chunk_size], opinions_dir) for i in range(0, len(cluster_members), chunk_size)))
+            ResolveDocument().update(tqdm(d for chunk in chunks for d in chunk), parallel=True)
 
 
 def make_test_files(input_dir='.', output_dir='test_data/courtlistener'):
@@ -1,6 +1,12 @@
+import heapq
+import itertools
+import os
 import random
+import shutil
+import tempfile
 from queue import Queue
 from threading import Thread
+import msgpack
 import rocksdb
 import traceback
 from collections import Counter
@@ -9,16 +15,107 @@ from multiprocessing.pool import Pool
 from tqdm import tqdm
 
 from django.conf import settings
+from django.db import transaction
 
-from capdb.models import Jurisdiction, CaseMetadata, CaseBodyCache
-from capdb.storages import ngram_kv_store, KVDB, ngram_kv_store_ro
+from capapi.response_cache import advance_response_cache_watermark
+from capdb.models import Jurisdiction, CaseMetadata, CaseBodyCache, CaseLastUpdate, CaseDeleted
+from capdb.storages import ngram_kv_store, KVDB, ngram_kv_store_ro, NGRAM_VALUE_VERSION, pack_ngram_dict, \
+    get_wildcard_key, ngram_value_total, NGRAM_VERSION_KEY, new_ngram_version, NgramTotalsTable
 from scripts.helpers import ordered_query_iterator
-from scripts.tokenizer import tokenize, ngrams
+from scripts.tokenizer import tokenize, tokenize_many, ngrams
 
 
 def get_totals_key(jurisdiction_id, year, n):
     return b"totals" + KVDB.pack((jurisdiction_id, year, n))
 
+def get_case_key(case_id):
+    """
+        Key for the per-case ledger entry recording what each case contributed to the ngram counts, in the form
+        pack((<jurisdiction_id>, <year>, <utf8-encoded, space-separated tokens>)). See update_ngrams_from_queue().
+    """
+    return b"case" + KVDB.pack(case_id)
+
+def get_ledger_key(jurisdiction_id, year):
+    """
+        Key marking that a jurisdiction-year was built with per-case ledger entries. Databases built before ledgers
+        were added have totals without this key; see update_case_ngrams().
+    """
+    return b"ledger" + KVDB.pack((jurisdiction_id, year))
+
+def ngram_queryset():
+    """ CaseBodyCache objects that are counted in ngrams. """
+    return CaseBodyCache.objects.filter(metadata__duplicative=False, metadata__jurisdiction__isnull=False, metadata__court__isnull=False)
+
+
+class NgramSpiller:
+    """
+        Accumulate instance and document counts for ngrams of a single length, spilling them to sorted run files
+        in spill_dir whenever more than settings.NGRAM_SPILL_THRESHOLD distinct grams are held in memory.
+
+        Each run file is a stream of msgpack-encoded (<key>, <instance_count>, <document_count>) tuples sorted by key,
+        where key is b'<n><gram>'. Use merge_runs() to combine the run files into a single sorted stream.
+    """
+    def __init__(self, spill_dir, n, threshold=None):
+        self.spill_dir = spill_dir
+        self.key_prefix = bytes([int(n)])
+        self.threshold = threshold or settings.NGRAM_SPILL_THRESHOLD
+        self.instances = Counter()
+        self.documents = Counter()
+        self.run_paths = []
+
+    def add(self, grams):
+        """ Add the grams for a single document. """
+        self.instances.update(grams)
+        self.documents.update(set(grams))
+        if len(self.instances) >= self.threshold:
+            self.spill()
+
+    def spill(self):
+        """ Write in-memory counts to a new sorted run file and reset counters. """
+        if not self.instances:
+            return
+        fd, path = tempfile.mkstemp(dir=self.spill_dir, suffix='.run')
+        packer = msgpack.Packer(use_bin_type=True)
+        with os.fdopen(fd, 'wb') as out:
+            for gram in sorted(self.instances):
+                out.write(packer.pack((self.key_prefix+gram.encode('utf8'), self.instances[gram], self.documents[gram])))
+        self.run_paths.append(path)
+        self.instances = Counter()
+        self.documents = Counter()
+
+    def finish(self):
+        """ Spill any remaining counts and return the list of run files. """
+        self.spill()
+        return self.run_paths
+
+
+def read_run(path):
+    """ Yield (<key>, <instance_count>, <document_count>) tuples from a run file written by NgramSpiller. """
+    with open(path, 'rb') as f:
+        for key, instance_count, document_count in msgpack.Unpacker(f, raw=False):
+            yield key, instance_count, document_count
+
+
+def merge_runs(run_iters):
+    """
+        Merge sorted streams of (<key>, <instance_count>, <document_count>) tuples, summing counts for equal keys.
+        >>> list(merge_runs([[(b'a', 1, 1), (b'c', 2, 1)], [(b'a', 3, 2), (b'b', 1, 1)]]))
+        [(b'a', 4, 3), (b'b', 1, 1), (b'c', 2, 1)]
+    """
+    current_key = None
+    instance_total = document_total = 0
+    for key, instance_count, document_count in heapq.merge(*run_iters, key=lambda item: item[0]):
+        if key != current_key:
+            if current_key is not None:
+                yield current_key, instance_total, document_total
+            current_key = key
+            instance_total = document_total = 0
+        instance_total += instance_count
+        document_total += document_count
+    if current_key is not None:
+        yield current_key, instance_total, document_total
+
+
 def ngram_jurisdictions(slug=None, max_n=3):
     """
         Add jurisdiction specified by slug to rocksdb, or all jurisdictions if name not provided.
@@ -26,7 +123,13 @@ def ngram_jurisdictions(slug=None, max_n=3):
         This is the primary ngrams entrypoint. It spawns NGRAM_THREAD_COUNT worker processes to
         ngram each jurisdiction-year, plus a rocksdb worker process that pulls their work off of
         the queue and writes it to the database.
+
+        Workers keep at most NGRAM_SPILL_THRESHOLD distinct grams in memory per length, spilling the rest to
+        sorted run files in a temporary directory under NGRAM_SPILL_DIR. Only the run file paths are passed
+        through the queue; the rocksdb worker merges the runs as it writes them.
     """
+    spill_dir = tempfile.mkdtemp(prefix='ngrams-', dir=settings.NGRAM_SPILL_DIR)
+
     # process pool of workers to ngram each jurisdiction-year and return keys
     ngram_workers = Pool(settings.NGRAM_THREAD_COUNT, maxtasksperchild=1)
 
@@ -62,7 +165,7 @@ def ngram_jurisdictions(slug=None, max_n=3):
         # ngram each year
         for year in range(first_year, last_year + 1):
             # ngram_worker(queue, jurisdiction_id, year, max_n)
-            ngram_worker_results.append((jurisdiction.slug, year, ngram_workers.apply_async(ngram_worker, (ngram_worker_offsets, ngram_worker_lock, queue, jurisdiction.id, jurisdiction.slug, year, max_n))))
+            ngram_worker_results.append((jurisdiction.slug, year, ngram_workers.apply_async(ngram_worker, (ngram_worker_offsets, ngram_worker_lock, queue, jurisdiction.id, jurisdiction.slug, year, max_n, spill_dir))))
 
     # wait for all ngram workers to finish
     ngram_workers.close()
@@ -79,7 +182,14 @@ def ngram_jurisdictions(slug=None, max_n=3):
     queue.put('STOP')
     rocksdb_worker.join()
 
-def ngram_worker(ngram_worker_offsets, ngram_worker_lock, queue, jurisdiction_id, jurisdiction_slug, year, max_n):
+    shutil.rmtree(spill_dir, ignore_errors=True)
+
+    # precompute top completions for wildcard searches, and totals for NgramViewSet
+    build_wildcard_index(max_n)
+    write_totals_table()
+    advance_response_cache_watermark()
+
+def ngram_worker(ngram_worker_offsets, ngram_worker_lock, queue, jurisdiction_id, jurisdiction_slug, year, max_n, spill_dir):
     """
         Worker process to generate all ngrams for the given jurisdiction-year and add them to the queue.
     """
@@ -96,43 +206,51 @@ def ngram_worker(ngram_worker_offsets, ngram_worker_lock, queue, jurisdiction_id
         ngram_worker_offsets[line_offset] = True
     pos = 2 + settings.NGRAM_THREAD_COUNT + line_offset
 
-    # count words for each case
-    counters = {n: {'total_tokens':0, 'total_documents':0, 'instances': Counter(), 'documents': Counter()} for n in range(1, max_n + 1)}
-    queryset = CaseBodyCache.objects.filter(
-        metadata__duplicative=False, metadata__jurisdiction__isnull=False, metadata__court__isnull=False,
+    # count words for each case, recording each case's tokens in a ledger file for update_ngrams_from_queue()
+    counters = {n: {'total_tokens':0, 'total_documents':0, 'spiller': NgramSpiller(spill_dir, n)} for n in range(1, max_n + 1)}
+    queryset = ngram_queryset().filter(
         metadata__decision_date__year=year, metadata__jurisdiction__slug=jurisdiction_slug
-    ).only('text').order_by('id')
+    ).only('text', 'metadata_id').order_by('id')
+    fd, ledger_path = tempfile.mkstemp(dir=spill_dir, suffix='.ledger')
+    ledger_packer = msgpack.Packer(use_bin_type=True)
+    ledger_file = os.fdopen(fd, 'wb')
     for case_text in tqdm(ordered_query_iterator(queryset), desc="Ngram %s" % desc, position=pos, mininterval=.5):
-        tokens = list(tokenize(case_text.text))
+        tokens = list(tokenize(case_text.text, settings.NGRAM_TOKENIZER_VERSION))
+        ledger_file.write(ledger_packer.pack((get_case_key(case_text.metadata_id), (jurisdiction_id, year, ' '.join(tokens).encode('utf8')))))
         for n in range(1, max_n + 1):
             grams = list(' '.join(gram) for gram in ngrams(tokens, n))
             counters[n]['total_tokens'] = counters[n].setdefault('total_tokens', 0) + len(grams)
             counters[n]['total_documents'] = counters[n].setdefault('total_documents', 0) + 1
-            counters[n]['instances'].update(grams)
-            counters[n]['documents'].update(set(grams))
+            counters[n]['spiller'].add(grams)
+    ledger_file.write(ledger_packer.pack((get_ledger_key(jurisdiction_id, year), True)))
+
+    ledger_file.close()
 
     # enqueue data for rocksdb
     storage_year = year - 1900
     for n, counts in counters.items():
 
+        run_paths = counts['spiller'].finish()
+
         # skip storing jurisdiction-year combinations that already have ngrams
         totals_key = get_totals_key(jurisdiction_id, year, n)
         if ngram_kv_store_ro.get(totals_key):
             print(" - Length %s already in totals" % n)
+            for path in run_paths:
+                os.remove(path)
             continue
 
         # set up values for use by rocksdb_write_thread()
         totals = (totals_key, [counts['total_tokens'], counts['total_documents']])
         merge_value_prefix = (jurisdiction_id, storage_year)
 
-        # prepare list of all ngram observations to be merged into rocksdb, in the form:
-        #   merges = [
-        #     (b'<n><gram>': (<instance count>, <document count>)), ...
-        #   ]
-        key_prefix = bytes([int(n)])
-        count_pairs = zip(sorted(counts['instances'].items()), sorted(counts['documents'].items()))
-        merges = [(key_prefix+gram.encode('utf8'), (instance_count, document_count)) for (gram, instance_count), (_, document_count) in count_pairs]
-        queue.put((totals, merge_value_prefix, merges))
+        # pass the sorted run files to be merged into rocksdb; see NgramSpiller for the run file format.
+        # the ledger is written along with whichever length is written first.
+        queue.put((totals, merge_value_prefix, run_paths, ledger_path))
+        ledger_path = None
+
+    if ledger_path:
+        os.remove(ledger_path)
 
     del ngram_worker_offsets[line_offset]
 
@@ -180,7 +298,7 @@ def rocksdb_write_thread(queue):
             item = queue.get()
             if item is None:
                 break
-            totals, merge_value_prefix, merges = item
+            totals, merge_value_prefix, run_paths, ledger_path = item
 
             # skip storing jurisdiction-year combinations that already have ngrams
             if ngram_kv_store.get(totals[0]):
@@ -191,15 +309,276 @@ def rocksdb_write_thread(queue):
 
             # write each ngram, in the form (b'<n><gram>', pack(<jurisdiction_id>, <year>, <instance_count>, <document_count>))
             # see ngram_kv_store.NgramMergeOperator for how this value is merged into the existing b'<n><gram>' key
-            for k, v in tqdm(merges, desc="Current write job", mininterval=.5):
-                ngram_kv_store.merge(k, merge_value_prefix+v, packed=True, batch=batch)
+            # runs are merged lazily, so only the serialized batch is held in memory rather than python objects for every gram
+            merges = merge_runs([read_run(path) for path in run_paths])
+            for k, instance_count, document_count in tqdm(merges, desc="Current write job", mininterval=.5):
+                ngram_kv_store.merge(k, merge_value_prefix+(instance_count, document_count), packed=True, batch=batch)
+
+            # write per-case ledger entries
+            if ledger_path:
+                with open(ledger_path, 'rb') as f:
+                    for k, v in msgpack.Unpacker(f, raw=False):
+                        ngram_kv_store.put(k, v, packed=True, batch=batch)
+                run_paths = run_paths + [ledger_path]
 
             # write totals value
             ngram_kv_store.put(totals[0], totals[1], packed=True, batch=batch)
+            ngram_kv_store.put(NGRAM_VERSION_KEY, new_ngram_version(), batch=batch)
 
             # write batch
             ngram_kv_store.db.write(batch)
+
+            for path in run_paths:
+                os.remove(path)
         finally:
             # let internal_queue.join() know not to wait for this job to complete
             queue.task_done()
-            
+
+
+def update_ngrams_from_queue(max_n=3, batch_size=100):
+    """
+        Apply changes for cases in the CaseDeleted and CaseLastUpdate queues to the ngram database, in batches, until
+        we run out. This is the incremental counterpart to ngram_jurisdictions().
+
+        Each ngrammed case has a ledger entry (see get_case_key()) recording the jurisdiction, year and tokens it
+        contributed. For each queued case we subtract the grams from the ledger entry and add the grams from the
+        current text via NgramMergeOperator, adjust the matching totals, and replace the ledger entry. Cases whose
+        jurisdiction, year and tokens are unchanged are skipped. Jurisdiction-years that have not been built by
+        ngram_jurisdictions() yet are left alone, so that a later full build doesn't skip them.
+
+        Ngram databases built before per-case ledgers were added can't be updated incrementally, because a case
+        without a ledger entry would be counted twice. This raises ValueError for them; delete the database
+        and rebuild it with ngram_jurisdictions() first.
+    """
+    # check for deletes
+    while True:
+        with transaction.atomic(using='capdb'):
+            case_ids = list(CaseDeleted.objects.filter(ngrammed=False).select_for_update(skip_locked=True)[:batch_size].values_list('case_id', flat=True))
+            if case_ids:
+                update_case_ngrams(case_ids, {}, max_n)
+                CaseDeleted.objects.filter(case_id__in=case_ids).update(ngrammed=True)
+            if len(case_ids) < batch_size:
+                break
+
+    # check for updates
+    while True:
+        with transaction.atomic(using='capdb'):
+            case_ids = list(CaseLastUpdate.objects.filter(ngrammed=False).select_for_update(skip_locked=True)[:batch_size].values_list('case_id', flat=True))
+            if case_ids:
+                current = list(ngram_queryset().filter(metadata_id__in=case_ids).values_list(
+                    'metadata_id', 'metadata__jurisdiction_id', 'metadata__decision_date', 'text'))
+                tokens_by_case = tokenize_many([text or '' for _, _, _, text in current], settings.NGRAM_TOKENIZER_VERSION)
+                new_cases = {
+                    case_id: (jurisdiction_id, decision_date.year, ' '.join(tokens).encode('utf8'))
+                    for (case_id, jurisdiction_id, decision_date, _), tokens in zip(current, tokens_by_case)
+                }
+                update_case_ngrams(case_ids, new_cases, max_n)
+                CaseLastUpdate.objects.filter(case_id__in=case_ids).update(ngrammed=True)
+            if len(case_ids) < batch_size:
+                break
+
+    write_totals_table()
+    advance_response_cache_watermark()
+
+
+def write_totals_table():
+    """
+        Write the current totals and jurisdiction slugs to the NgramTotalsTable file read by NgramViewSet. The table
+        records NGRAM_VERSION_KEY, so readers can tell if it is out of date.
+    """
+    jurisdiction_id_to_slug = dict(Jurisdiction.objects.values_list('pk', 'slug'))
+    NgramTotalsTable.write(
+        ngram_kv_store.totals_table_path(),
+        ngram_kv_store.get(NGRAM_VERSION_KEY),
+        ngram_kv_store.load_totals(),
+        jurisdiction_id_to_slug)
+
+
+def update_case_ngrams(case_ids, new_cases, max_n=3):
+    """
+        Replace the ngram contributions of the given cases. new_cases maps case_id to
+        (<jurisdiction_id>, <year>, <utf8-encoded, space-separated tokens>) for each case that should be counted; case_ids missing
+        from new_cases are removed. Raises ValueError if a built jurisdiction-year has no per-case ledger.
+    """
+    # gather deltas, in the form:
+    #   grams = {(<jurisdiction_id>, <year>): {b'<n><gram>': [<instance_count>, <document_count>]}}
+    #   totals = {(<jurisdiction_id>, <year>, <n>): [<token count>, <document count>]}
+    grams = {}
+    totals = {}
+    built = {}
+    ledger_updates = {}
+
+    def is_built(jurisdiction_id, year):
+        key = (jurisdiction_id, year)
+        if key not in built:
+            built[key] = bool(ngram_kv_store.get(get_totals_key(jurisdiction_id, year, max_n)))
+            if built[key] and not ngram_kv_store.get(get_ledger_key(jurisdiction_id, year)):
+                raise ValueError(
+                    "Ngrams for jurisdiction %s, year %s were built without per-case ledger entries, so they can't be "
+                    "updated incrementally. Delete the ngram database and run `fab ngram_jurisdictions` to rebuild it." % key)
+        return built[key]
+
+    def add_case(jurisdiction_id, year, tokens, sign):
+        tokens = tokens.decode('utf8').split(' ') if tokens else []
+        gram_counts = grams.setdefault((jurisdiction_id, year), {})
+        for n in range(1, max_n + 1):
+            key_prefix = bytes([n])
+            case_grams = [key_prefix + ' '.join(gram).encode('utf8') for gram in ngrams(tokens, n)]
+            for gram, count in Counter(case_grams).items():
+                counts = gram_counts.setdefault(gram, [0, 0])
+                counts[0] += sign * count
+                counts[1] += sign
+            total = totals.setdefault((jurisdiction_id, year, n), [0, 0])
+            total[0] += sign * len(case_grams)
+            total[1] += sign
+
+    for case_id in case_ids:
+        case_key = get_case_key(case_id)
+        old = ngram_kv_store.get(case_key, packed=True)
+        old = tuple(old) if old else None
+        new = new_cases.get(case_id)
+        if old == new:
+            continue
+        if old and is_built(old[0], old[1]):
+            add_case(*old, -1)
+        if new and is_built(new[0], new[1]):
+            add_case(*new, 1)
+            ledger_updates[case_key] = new
+        else:
+            ledger_updates[case_key] = None
+
+    if not ledger_updates:
+        return
+
+    # write everything in a batch so writes succeed or fail as a group
+    batch = rocksdb.WriteBatch()
+    for (jurisdiction_id, year), gram_counts in grams.items():
+        merge_value_prefix = (jurisdiction_id, year - 1900)
+        for k, (instance_count, document_count) in sorted(gram_counts.items()):
+            if instance_count or document_count:
+                ngram_kv_store.merge(k, merge_value_prefix+(instance_count, document_count), packed=True, batch=batch)
+    for (jurisdiction_id, year, n), (token_count, document_count) in totals.items():
+        totals_key = get_totals_key(jurisdiction_id, year, n)
+        old_totals = ngram_kv_store.get(totals_key, packed=True) or [0, 0]
+        ngram_kv_store.put(totals_key, [old_totals[0] + token_count, old_totals[1] + document_count], packed=True, batch=batch)
+    if totals:
+        ngram_kv_store.put(NGRAM_VERSION_KEY, new_ngram_version(), batch=batch)
+    for case_key, value in ledger_updates.items():
+        if value:
+            ngram_kv_store.put(case_key, value, packed=True, batch=batch)
+        else:
+            ngram_kv_store.delete(case_key, batch=batch)
+    ngram_kv_store.db.write(batch)
+
+    update_wildcard_index(set(k for gram_counts in grams.values() for k in gram_counts))
+
+
+def get_gram_prefix(key):
+    """
+        Return the wildcard prefix for a gram key, i.e. everything up to the last word.
+        >>> get_gram_prefix(b'\x02foo bar')
+        b'\x02foo '
+    """
+    return key[:key.rindex(b' ')+1]
+
+
+def build_wildcard_index(max_n=3):
+    """
+        Rebuild the wildcard index, which stores the top NGRAM_WILDCARD_TOP_N completions for each prefix so that
+        NgramViewSet can answer queries like "foo *" with point lookups instead of scanning every gram under the prefix.
+        Grams sharing a prefix are adjacent in key order, so this is a single streaming pass over the gram keys.
+    """
+    top_n = settings.NGRAM_WILDCARD_TOP_N
+    batch_size = 10000
+
+    # clear old entries, which may refer to prefixes that no longer exist
+    batch = rocksdb.WriteBatch()
+    for k, _ in ngram_kv_store.get_prefix(b'wildcard'):
+        ngram_kv_store.delete(k, batch=batch)
+    ngram_kv_store.db.write(batch)
+
+    for n in range(2, max_n + 1):
+        batch = rocksdb.WriteBatch()
+        batch_count = 0
+        current_prefix = None
+        top = []
+        for k, v in tqdm(itertools.chain(ngram_kv_store.get_prefix(bytes([n])), [(None, None)]), desc="Wildcard index for length %s" % n, mininterval=.5):
+            prefix = get_gram_prefix(k) if k else None
+            if prefix != current_prefix:
+                if top:
+                    ngram_kv_store.put(get_wildcard_key(current_prefix), [[gram, total] for total, gram in sorted(top, reverse=True)], packed=True, batch=batch)
+                    batch_count += 1
+                    if batch_count >= batch_size:
+                        ngram_kv_store.db.write(batch)
+                        batch = rocksdb.WriteBatch()
+                        batch_count = 0
+                current_prefix = prefix
+                top = []
+            if k is None:
+                break
+            total = ngram_value_total(v)[0]
+            if total <= 0:
+                continue
+            if len(top) < top_n:
+                heapq.heappush(top, (total, k))
+            elif (total, k) > top[0]:
+                heapq.heapreplace(top, (total, k))
+        ngram_kv_store.db.write(batch)
+
+
+def update_wildcard_index(keys):
+    """
+        Update wildcard index entries after the values for the given gram keys have changed. Entries are rebuilt
+        from a prefix scan only if one of their full list of completions lost count, since then an unlisted gram may
+        now belong in the list.
+    """
+    top_n = settings.NGRAM_WILDCARD_TOP_N
+    keys_by_prefix = {}
+    for k in keys:
+        if k[0] > 1:
+            keys_by_prefix.setdefault(get_gram_prefix(k), []).append(k)
+
+    batch = rocksdb.WriteBatch()
+    for prefix, prefix_keys in keys_by_prefix.items():
+        wildcard_key = get_wildcard_key(prefix)
+        entry = ngram_kv_store.get(wildcard_key, packed=True) or []
+        top = {gram: total for gram, total in entry}
+        rescan = False
+        for k, v in ngram_kv_store.get_many(prefix_keys):
+            total = ngram_value_total(v)[0] if v else 0
+            if k in top and total < top[k] and len(entry) >= top_n:
+                rescan = True
+                break
+            top[k] = total
+        if rescan:
+            entry = ngram_kv_store.top_completions(prefix, top_n)
+        else:
+            entry = sorted(([gram, total] for gram, total in top.items() if total > 0), key=lambda i: (i[1], i[0]), reverse=True)[:top_n]
+        if entry:
+            ngram_kv_store.put(wildcard_key, entry, packed=True, batch=batch)
+        else:
+            ngram_kv_store.delete(wildcard_key, batch=batch)
+    ngram_kv_store.db.write(batch)
+
+
+def migrate_ngram_values(max_n=3, batch_size=10000):
+    """
+        Rewrite ngram values stored in the legacy msgpack format with capdb.storages.pack_ngram_value().
+        Legacy values are also converted whenever they are merged, and readers handle both formats, so this is only
+        needed to shrink an existing database. Safe to re-run.
+    """
+    for n in range(1, max_n + 1):
+        batch = rocksdb.WriteBatch()
+        batch_count = 0
+        for k, v in tqdm(ngram_kv_store.get_prefix(bytes([n])), desc="Migrating length %s" % n, mininterval=.5):
+            if v[0] == NGRAM_VALUE_VERSION:
+                continue
+            ngram_kv_store.put(k, pack_ngram_dict(KVDB.unpack(v)), batch=batch)
+            batch_count += 1
+            if batch_count >= batch_size:
+                ngram_kv_store.db.write(batch)
+                batch = rocksdb.WriteBatch()
+                batch_count = 0
+        if batch_count:
+            ngram_kv_store.db.write(batch)
+    ngram_kv_store.db.compact_range()
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import fitz
+from django.conf import settings
+from django.core.cache import cache
+
+
+METRICS = ('hits', 'misses', 'evictions')
+
+
+def slice_pdf(pdf_path, first_page, last_page):
+    """
+        Return a new PDF made of pages first_page through last_page (1-indexed, inclusive) of pdf_path.
+        `fitz` is the PyMuPDF library.
+    """
+    doc = fitz.open(pdf_path)
+    doc.select(range(first_page - 1, last_page))
+    return doc.write(garbage=2)
+
+
+def record_metric(name, count=1):
+    """ Add count to a PDF cache counter shared through the django cache. """
+    key = 'pdf_cache:%s' % name
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key, count)
+    except ValueError:
+        # key was evicted between add() and incr()
+        cache.set(key, count, timeout=None)
+
+
+def get_metrics():
+    """ Return {'hits': ..., 'misses': ..., 'evictions': ...} counted since the django cache was last cleared. """
+    return {name: cache.get('pdf_cache:%s' % name, 0) for name in METRICS}
+
+
+class PdfSliceCache:
+    """
+        Size-bounded, content-addressed disk cache of case PDFs sliced from volume PDFs.
+
+        Slices are keyed by the sha256 of the volume PDF, the page range, and whether the volume is redacted, so a
+        volume PDF that is replaced (e.g. when a volume is unredacted) never serves stale slices. Checksums are
+        computed once per version of each volume PDF, identified by its path, inode, size and mtime, and
+        remembered in checksums/. When the cache grows beyond max_bytes, least recently used slices are deleted
+        until it is below `low_water` of max_bytes.
+
+        The total size is tracked in the django cache as slices are written, so the cache directory is only scanned
+        by evict() when the tracked size passes max_bytes or has been lost. Sizes tracked by concurrent writers can
+        overcount but not undercount, and each scan resets the tracked size to the real one.
+
+        Usage:
+            pdf_cache = PdfSliceCache('/tmp/pdf_cache', 10 * 1024**3)
+            pdf = pdf_cache.get_pdf('/path/to/volume.pdf', 3, 5, redacted=False)
+    """
+    low_water = 0.9
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.size_key = 'pdf_cache:bytes:%s' % hashlib.sha256(str(self.cache_dir).encode('utf8')).hexdigest()[:16]
+
+    def volume_checksum(self, pdf_path):
+        """ Return sha256 of the file at pdf_path, computed only once per version of the file. """
+        stat = os.stat(pdf_path)
+        version = [str(pdf_path), stat.st_ino, stat.st_size, stat.st_mtime_ns]
+        record_path = self.cache_dir / 'checksums' / ('%s.json' % hashlib.sha256(str(pdf_path).encode('utf8')).hexdigest())
+        try:
+            record = json.loads(record_path.read_text())
+            if record['version'] == version:
+                return record['sha256']
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        checksum = hashlib.sha256()
+        with open(pdf_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                checksum.update(chunk)
+        checksum = checksum.hexdigest()
+        self.write_atomic(record_path, json.dumps({'version': version, 'sha256': checksum}).encode('utf8'))
+        return checksum
+
+    def slice_path(self, pdf_path, first_page, last_page, redacted):
+        """ Return path where the given slice of pdf_path is cached. """
+        key = hashlib.sha256(('%s:%s-%s:%s' % (
+            self.volume_checksum(pdf_path), first_page, last_page, 'redacted' if redacted else 'unredacted'
+        )).encode('utf8')).hexdigest()
+        return self.cache_dir / 'slices' / key[:2] / ('%s.pdf' % key)
+
+    def get_pdf(self, pdf_path, first_page, last_page, redacted):
+        """ Return pages first_page through last_page of pdf_path, from the cache if possible. """
+        path = self.slice_path(pdf_path, first_page, last_page, redacted)
+        try:
+            pdf = path.read_bytes()
+        except FileNotFoundError:
+            pass
+        else:
+            # bump mtime so eviction treats the slice as recently used
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+            record_metric('hits')
+            return pdf
+        record_metric('misses')
+        pdf = slice_pdf(pdf_path, first_page, last_page)
+        self.write_atomic(path, pdf)
+        self.add_size(len(pdf))
+        return pdf
+
+    def warm(self, pdf_path, first_page, last_page, redacted):
+        """ Cache the given slice of pdf_path if it isn't already cached, without counting a hit or miss. """
+        path = self.slice_path(pdf_path, first_page, last_page, redacted)
+        if path.exists():
+            return False
+        pdf = slice_pdf(pdf_path, first_page, last_page)
+        self.write_atomic(path, pdf)
+        self.add_size(len(pdf))
+        return True
+
+    def write_atomic(self, path, data):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, suffix='.tmp', delete=False) as f:
+            f.write(data)
+        os.replace(f.name, path)
+
+    def iter_slices(self):
+        """ Yield (mtime, size, path) for each cached slice. """
+        slices_dir = self.cache_dir / 'slices'
+        if not slices_dir.exists():
+            return
+        for dir_entry in os.scandir(slices_dir):
+            for entry in os.scandir(dir_entry.path):
+                if entry.name.endswith('.pdf'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield stat.st_mtime_ns, stat.st_size, entry.path
+
+    def size(self):
+        """ Return total bytes of cached slices. """
+        return sum(size for _, size, _ in self.iter_slices())
+
+    def add_size(self, size):
+        """ Add size bytes to the tracked cache size, and evict if the cache is now over max_bytes or its size is unknown. """
+        try:
+            total = cache.incr(self.size_key, size)
+        except ValueError:
+            total = None
+        if total is None or total > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """ If the cache is over max_bytes, delete least recently used slices until it is under the low water mark. """
+        slices = list(self.iter_slices())
+        total = sum(size for _, size, _ in slices)
+        if total <= self.max_bytes:
+            cache.set(self.size_key, total, timeout=None)
+            return
+        target = self.max_bytes * self.low_water
+        evicted = 0
+        for _, size, path in sorted(slices):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        cache.set(self.size_key, total, timeout=None)
+        record_metric('evictions', evicted)
+
+
+def get_pdf_slice_cache():
+    """ Return a PdfSliceCache for settings.PDF_CACHE_DIR, or None if caching is turned off. """
+    if not settings.PDF_CACHE_DIR:
+        return None
+    return PdfSliceCache(settings.PDF_CACHE_DIR, settings.PDF_CACHE_MAX_BYTES)
+
+
+def get_case_pdf(pdf_path, first_page, last_page, redacted):
+    """ Return a case PDF sliced from its volume PDF, using the PDF slice cache if configured. """
+    pdf_cache = get_pdf_slice_cache()
+    if pdf_cache is None:
+        return slice_pdf(pdf_path, first_page, last_page)
+    return pdf_cache.get_pdf(pdf_path, first_page, last_page, redacted)
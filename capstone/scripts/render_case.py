@@ -1,7 +1,9 @@
 import json
+import re
 from contextlib import contextmanager
 from copy import deepcopy
 
+import lxml.html
 from lxml import etree, sax
 from pyquery import PyQuery
 
@@ -594,3 +596,174 @@ class VolumeRenderer:
             self.open_font_tags(tag_stack, open_font_tags)
         else:
             yield
+
+
+### JSON AND TEXT EXTRACTION ###
+
+# text extraction matches PyQuery.text(), from pyquery.text.extract_text(): block elements and <br> become newlines,
+# and runs of HTML whitespace within each stretch of text are squashed to a single space
+INLINE_TAGS = {
+    'a', 'abbr', 'acronym', 'b', 'bdo', 'big', 'br', 'button', 'cite',
+    'code', 'dfn', 'em', 'i', 'img', 'input', 'kbd', 'label', 'map',
+    'object', 'q', 'samp', 'script', 'select', 'small', 'span', 'strong',
+    'sub', 'sup', 'textarea', 'time', 'tt', 'var'
+}
+SEPARATOR_TAGS = {'br'}
+HTML_WHITESPACE_RE = re.compile('[\x20\x09\x0C\u200B\x0A\x0D]+')
+
+# page numbers and footnote numbers are left out of json and text: elements with these classes, and <a> elements
+# directly inside a .footnote
+json_skip_classes = {'page-label', 'footnotemark', 'bracketnum'}
+# PyQuery.remove() moves the tail of a removed element onto the text before it; before pyquery 2.0 it also put a
+# space in front. Whether that space is there changes the output when the text before ends in a character that isn't
+# HTML whitespace, so match whichever version is installed.
+REMOVED_TAIL_PREFIX = ' ' if PyQuery('<p>a<i></i>b</p>').remove('i').text() == 'a b' else ''
+# elements whose text is included in json
+json_classes = {'head-matter', 'opinion', 'author', 'judges', 'attorneys', 'parties', 'corrections'}
+
+
+def parse_case_html(html):
+    """ Parse html the way PyQuery(html) does: as XML if it's well-formed, otherwise as HTML. """
+    try:
+        return etree.fromstring(html)
+    except etree.XMLSyntaxError:
+        return lxml.html.fromstring(html)
+
+
+def parts_to_text(parts):
+    """
+        Join a list of text strings, None (block element boundary), and True (<br>) into text, like
+        pyquery.text.extract_text(). Consecutive strings are joined and squashed, empty strings are dropped, runs of
+        block boundaries become a single newline, and leading and trailing boundaries are dropped.
+        >>> assert parts_to_text([None, ' a ', None, '\\n', None, 'b', 'c  d', True, None, 'e', None]) == 'a\\nbc d\\n\\ne'
+    """
+    out = []
+    run = []
+    for part in parts:
+        if part.__class__ is str:
+            run.append(part)
+            continue
+        if run:
+            text = HTML_WHITESPACE_RE.sub(' ', ''.join(run)).strip()
+            if text:
+                out.append(text)
+            run = []
+        if part is None and out and out[-1] is None:
+            continue
+        out.append(part)
+    if run:
+        text = HTML_WHITESPACE_RE.sub(' ', ''.join(run)).strip()
+        if text:
+            out.append(text)
+    start = 0
+    while start < len(out) and out[start].__class__ is not str:
+        start += 1
+    end = len(out)
+    while end > start and out[end - 1].__class__ is not str:
+        end -= 1
+    return ''.join('\n' if part is None or part is True else part for part in out[start:end]).strip()
+
+
+def extract_json_from_html(html):
+    """
+        Return (json, text) for rendered case html, in a single walk of the parsed tree. This produces the same output
+        as selecting each of json_classes with PyQuery and calling .text() after removing page and footnote numbers.
+
+        The walk appends each element's text to one flat list of parts, the same way extract_text() builds them for
+        a single element, and records where each element of interest starts and ends in that list, so each one's
+        text can be read off without walking it again.
+        >>> html = ('<section class="casebody"><section class="head-matter"><h4 class="parties">A v. B</h4></section>'
+        ...         '<article class="opinion" data-type="majority"><p class="author">Smith, J.</p>'
+        ...         '<p>Text<a class="page-label">*2</a> here.<br/>More.</p></article></section>')
+        >>> json, text = extract_json_from_html(html)
+        >>> assert json['opinions'] == [
+        ...     {'type': 'head_matter', 'author': 'head_matter', 'text': 'A v. B'},
+        ...     {'type': 'majority', 'author': 'Smith, J.', 'text': 'Smith, J.\\nText here.\\nMore.'}]
+        >>> assert json['parties'] == ['A v. B'] and json['corrections'] == ''
+        >>> assert text == 'A v. B\\nSmith, J.\\nText here.\\nMore.\\n'
+    """
+    root = parse_case_html(html)
+    parts = []
+    spans = {c: [] for c in json_classes}  # class: [[start, end, element, element number, end element number]]
+    append = parts.append
+    element_count = 0
+
+    def walk(el, classes):
+        nonlocal element_count
+        tag = el.tag
+        start = len(parts)
+        element_number = element_count
+        element_count += 1
+        block = tag not in INLINE_TAGS
+        if block:
+            append(None)
+        elif tag in SEPARATOR_TAGS:
+            append(True)
+        entries = []
+        if classes:
+            for cls in json_classes.intersection(classes):
+                entry = [start, None, el, element_number, None]
+                spans[cls].append(entry)
+                entries.append(entry)
+        if el.text is not None:
+            append(el.text)
+        in_footnote = 'footnote' in classes
+        for child in el:
+            child_tag = child.tag
+            if child_tag.__class__ is str:  # skip comments and processing instructions
+                child_classes = child.get('class')
+                if child_classes:
+                    child_classes = child_classes.split()
+                    skip = not json_skip_classes.isdisjoint(child_classes)
+                else:
+                    skip = False
+                if skip or (in_footnote and child_tag == 'a'):
+                    # PyQuery.remove() keeps the tail of a removed element
+                    if child.tail:
+                        append(REMOVED_TAIL_PREFIX + child.tail)
+                    continue
+                if not child_classes and not len(child) and child_tag in INLINE_TAGS and child_tag not in SEPARATOR_TAGS:
+                    # fast path for plain inline elements like <em>
+                    element_count += 1
+                    if child.text is not None:
+                        append(child.text)
+                else:
+                    walk(child, child_classes or ())
+            if child.tail is not None:
+                append(child.tail)
+        if block and tag not in SEPARATOR_TAGS:
+            append(None)
+        for entry in entries:
+            entry[1] = len(parts)
+            entry[4] = element_count
+
+    root_classes = root.get('class')
+    walk(root, root_classes.split() if root_classes else ())
+
+    def texts(cls, within=None):
+        """ Return text of each element with class cls, optionally only those inside (or equal to) element entry `within`. """
+        return [parts_to_text(parts[start:end]) for start, end, _, number, _ in spans[cls]
+                if within is None or within[3] <= number < within[4]]
+
+    opinions = [{
+        'type': 'head_matter',
+        'author': 'head_matter',
+        'text': ' '.join(texts('head-matter')),
+    }]
+    for opinion in spans['opinion']:
+        start, end, el = opinion[:3]
+        opinions.append({
+            'type': el.get('data-type'),
+            'author': ' '.join(texts('author', opinion)) or None,
+            'text': parts_to_text(parts[start:end]),
+        })
+    json = {
+        'judges': texts('judges'),
+        'attorneys': texts('attorneys'),
+        'parties': texts('parties'),
+        'opinions': opinions,
+        'corrections': ' '.join(texts('corrections')),
+    }
+    text = "\n".join([o['text'] for o in json['opinions']] + [json['corrections']])
+    return json, text
+
@@ -69,16 +69,19 @@ def update_postgres_env(db='capdb'):
                     'in_scope',
                     'no_index_redacted',
                 ],
+                # fields read by scripts.citation_graph.iter_citation_rows()
+                'graph_fields': ['decision_date_original', 'jurisdiction_id', 'volume_id', 'in_scope'],
             },
             {
                 'model': Citation,
                 'case_field': 'case_id',
-                'fields': ['type', 'cite'],
+                # normalized and rdb cites are read by scripts.cite_index.iter_cite_rows()
+                'fields': ['type', 'cite', 'normalized_cite', 'rdb_cite', 'rdb_normalized_cite'],
             },
             {
                 'model': CaseBodyCache,
                 'case_field': 'metadata_id',
-                'fields': ['json', 'html'],
+                'fields': ['json', 'html', 'text'],  # text is used by scripts.ngrams.update_ngrams_from_queue
             },
             {
                 'model': ExtractedCitation,
@@ -96,6 +99,7 @@ def update_postgres_env(db='capdb'):
                     'category',
                     'reporter',
                 ],
+                'graph_fields': ['target_case_id'],
             },
             {
                 'model': CaseAnalysis,
@@ -128,15 +132,17 @@ def update_postgres_env(db='capdb'):
         def get_change_query(fields):
             return " or ".join('$1.%s IS DISTINCT FROM $2.%s' % (f, f) for f in fields)
         for model in last_update_models:
+            graph_fields = model.get('graph_fields', [])
+            fields = model['fields'] + [f for f in graph_fields if f not in model['fields']]
             cursor.execute("""
                     DROP TRIGGER IF EXISTS last_update_trigger ON {table};
                     CREATE TRIGGER last_update_trigger
                     AFTER INSERT OR DELETE OR UPDATE OF {fields}
                         ON {table}
                         FOR EACH ROW
-                    EXECUTE PROCEDURE track_last_update(%s, %s);
-                """.format(table=model['model']._meta.db_table, fields=", ".join(model['fields'])),
-                (model['case_field'], get_change_query(model['fields'])),
+                    EXECUTE PROCEDURE track_last_update(%s, %s, %s);
+                """.format(table=model['model']._meta.db_table, fields=", ".join(fields)),
+                (model['case_field'], get_change_query(fields), get_change_query(graph_fields) if graph_fields else 'false'),
             )
         for model in fkey_update_models:
             cursor.execute("""
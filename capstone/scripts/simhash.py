@@ -1,10 +1,20 @@
+import csv
 import hashlib
+import itertools
+import json
+import mmap
+import os
 import re
+import struct
+from collections import Counter
+
 import numpy as np
 
 
 # increment this whenever get_simhash() output changes, e.g. because of new tokenizer or hash function
-SIMHASH_VERSION = 1
+#   version 1: md5 of each 3-shingle
+#   version 2: 64-bit mix of per-word blake2b hashes, computed for each 3-shingle in bulk by get_simhashes()
+SIMHASH_VERSION = 2
 
 
 def hashfunc(obj):
@@ -20,42 +30,320 @@ def shingles(tokens, n):
     return zip(*[tokens[i:-n + i + 1 or None] for i in range(n)])
 
 
+def words(text):
+    """
+        Return text as normalized words -- lowercased and split on non-word characters:
+        >>> assert words("Hasta mañana, say we’ll meet again.") == ['hasta', 'mañana', 'say', 'we', 'll', 'meet', 'again']
+    """
+    return [t for t in re.split(r'\W+', text.lower()) if t]
+
+
 def tokenize(text):
     """
         Return text as normalized shingles -- lowercased, split on non-word characters, as 3-shingles:
         >>> assert tokenize("Hasta mañana, say we’ll meet again.") == ['hasta mañana say', 'mañana say we', 'say we ll', 'we ll meet', 'll meet again']
     """
-    tokens = [t for t in re.split(r'\W+', text.lower()) if t]
-    return [' '.join(s) for s in shingles(tokens, 3)]
+    return [' '.join(s) for s in shingles(words(text), 3)]
+
 
+def mix64(h):
+    """ splitmix64 finalizer, applied elementwise to a uint64 array. """
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return h ^ (h >> np.uint64(31))
 
-def get_simhash(text):
+
+def get_shingle_hashes(texts, version=SIMHASH_VERSION):
     """
-        Return `version:hex-encoded simhash`, based on tokenizer and hashfunc defined above.
-        >>> assert get_simhash("Hasta mañana, say we’ll meet again.") == '1:f30f534aac9db398'
+        Return (<uint64 array of shingle hashes for all texts, concatenated>, <array of shingle count for each text>).
+    """
+    if version == 1:
+        text_shingles = [tokenize(text) for text in texts]
+        counts = np.array([len(s) for s in text_shingles], dtype=np.int64)
+        bytestring = b''.join(hashfunc(s) for shingle_list in text_shingles for s in shingle_list)
+        return np.frombuffer(bytestring, dtype='>u8').astype(np.uint64), counts
+
+    if version != 2:
+        raise ValueError("Unknown simhash version %s" % version)
+
+    # hash each distinct word in the batch once
+    word_lists = [words(text) for text in texts]
+    word_ids = {}
+    all_word_ids = np.array([word_ids.setdefault(w, len(word_ids)) for word_list in word_lists for w in word_list], dtype=np.int64)
+    word_hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(w.encode('utf8'), digest_size=8).digest(), 'big') for w in word_ids],
+        dtype=np.uint64)[all_word_ids]
+
+    # shingle i of the concatenated word list covers words i, i+1 and i+2; keep only shingles within a single text
+    word_counts = np.array([len(w) for w in word_lists], dtype=np.int64)
+    counts = np.maximum(word_counts - 2, 0)
+    if not counts.sum():
+        return np.zeros(0, dtype=np.uint64), counts
+    all_hashes = mix64(mix64(mix64(word_hashes[:-2]) ^ word_hashes[1:-1]) ^ word_hashes[2:])
+    text_starts = np.cumsum(word_counts) - word_counts
+    shingle_starts = np.cumsum(counts) - counts
+    keep = np.repeat(text_starts - shingle_starts, counts) + np.arange(counts.sum())
+    return all_hashes[keep], counts
+
+
+def get_simhashes(texts, version=SIMHASH_VERSION):
+    """
+        Return `version:hex-encoded simhash` for each of texts. Shingle hashes for all texts are computed together,
+        and bits are summed for every text in a single matrix operation, so this is much faster than calling
+        get_simhash() for each text. Memory use is about 64 bytes per shingle, so pass texts in batches, e.g. a
+        volume at a time.
+
+        Use version=1 to reproduce simhashes stored before SIMHASH_VERSION 2:
+        >>> assert get_simhashes(["Hasta mañana, say we’ll meet again.", ""], version=1) == ['1:f30f534aac9db398', '1:0000000000000000']
     """
-    tokens = tokenize(text)
+    hashes, counts = get_shingle_hashes(texts, version)
 
-    # equivalent to:
+    # equivalent to, for each text:
     #   pip install simhash
     #   import simhash
     #   value = simhash.Simhash(tokenize(text), hashfunc=hashfunc).value.to_bytes(8, byteorder='big')
     # but faster
-    bytestring = b''.join(hashfunc(f) for f in tokens)
-    bitarray = np.unpackbits(np.frombuffer(bytestring, dtype='>B'))
-    rows = np.reshape(bitarray, (-1, 64))
-    sums = np.sum(rows, 0)
-    value = np.packbits(sums > len(tokens) // 2).tobytes()
+    values = np.zeros((len(texts), 8), dtype=np.uint8)
+    nonempty = counts > 0
+    if nonempty.any():
+        bits = np.unpackbits(hashes.astype('>u8').view(np.uint8)).reshape(-1, 64)
+        sums = np.add.reduceat(bits, (np.cumsum(counts) - counts)[nonempty], axis=0, dtype=np.int64)
+        values[nonempty] = np.packbits(sums > (counts[nonempty] // 2)[:, None], axis=1)
+
+    return [f"{version}:{value.tobytes().hex()}" for value in values]
 
-    return f"{SIMHASH_VERSION}:{value.hex()}"
+
+def get_simhash(text, version=SIMHASH_VERSION):
+    """
+        Return `version:hex-encoded simhash`, based on tokenizer and hashfunc defined above.
+        >>> assert get_simhash("Hasta mañana, say we’ll meet again.") == '2:ec79d95138369a02'
+        >>> assert get_simhash("Hasta mañana, say we’ll meet again.", version=1) == '1:f30f534aac9db398'
+    """
+    return get_simhashes([text], version)[0]
 
 
 def get_distance(s1, s2):
     """
-        Get Hamming distance of simhashes from get_simhash().
-        >>> assert get_distance(get_simhash("This is a brown dog"), get_simhash("This is a brown doggy")) == 17
-        >>> assert get_distance(get_simhash("This is a brown dog"), get_simhash("That is a brown doggy")) == 25
+        Get Hamming distance of simhashes from get_simhash(). Simhashes from different versions can't be compared.
+        >>> assert get_distance(get_simhash("This is a brown dog", 1), get_simhash("This is a brown doggy", 1)) == 17
+        >>> assert get_distance(get_simhash("This is a brown dog", 1), get_simhash("That is a brown doggy", 1)) == 25
+    """
+    v1, s1 = s1.split(':', 1)
+    v2, s2 = s2.split(':', 1)
+    if v1 != v2:
+        raise ValueError("Can't compare simhashes from different versions: %s and %s" % (v1, v2))
+    return bin(int(s1, 16) ^ int(s2, 16)).count('1')
+
+
+def simhash_value(simhash):
+    """
+        Return the integer value of a `version:hex-encoded simhash` string.
+        >>> assert simhash_value('2:00000000000000ff') == 255
+    """
+    return int(simhash.split(':', 1)[1], 16)
+
+
+def popcount(values):
+    """
+        Return the number of set bits in each element of a uint64 array.
+        >>> assert popcount(np.array([0, 1, 3, 2**64-1], dtype=np.uint64)).tolist() == [0, 1, 2, 64]
+    """
+    return np.unpackbits(values.astype('>u8').view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+
+def flip_masks(width, radius):
+    """
+        Return a uint64 array of every mask of `width` bits with at most `radius` bits set.
+        >>> assert sorted(flip_masks(3, 1).tolist()) == [0, 1, 2, 4]
+    """
+    masks = [0]
+    for r in range(1, radius + 1):
+        masks.extend(sum(1 << b for b in bits) for bits in itertools.combinations(range(width), r))
+    return np.array(masks, dtype=np.uint64)
+
+
+class SimhashIndex:
+    """
+        Read-only, memory-mapped multi-index hash table of simhashes, for finding every document within a given Hamming
+        distance of a simhash without comparing it to every document. Written by SimhashIndex.write(), and built for
+        CAP and CourtListener documents by build_simhash_index().
+
+        Each 64-bit simhash is split into `bands` bands. Two simhashes that differ by at most k bits must have at least
+        one band that differs by at most k // bands bits, so a query only looks up band values within that radius of
+        its own bands, and then checks the full distance for those candidates.
+
+        File layout:
+            b'CAPSHI01'
+            <uint32 header length> <header json: {"version": <simhash version>, "bands": <band count>, "id_width": <max id length>}>
+            <uint64 row count> <padding to 8 bytes>
+            <uint64 simhash values> -- in order of id
+            for each band: <uint64 band values, sorted> <int64 row number of each band value>
+            <ids, null-padded to id_width bytes, sorted>
+
+        Usage:
+            index = SimhashIndex(path)
+            index.query('2:ec79d95138369a02', 6)  # => [('cap-1', 0), ('cl-2', 4)]
+            index.query_id('cap-1', 6)  # => [('cap-1', 0), ('cl-2', 4)]
+    """
+    magic = b'CAPSHI01'
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(self.magic)] != self.magic:
+            raise ValueError("%s is not a simhash index" % path)
+        pos = len(self.magic)
+        header_length, = struct.unpack_from('<I', self.mmap, pos)
+        pos += 4
+        header = json.loads(self.mmap[pos:pos+header_length])
+        pos += header_length
+        row_count, = struct.unpack_from('<Q', self.mmap, pos)
+        pos += 8
+        pos += -pos % 8
+        self.version = header['version']
+        self.shifts, self.widths = self.band_layout(header['bands'])
+        self.hashes = np.frombuffer(self.mmap, dtype='<u8', count=row_count, offset=pos)
+        pos += row_count * 8
+        self.bands = []
+        for _ in self.shifts:
+            band_values = np.frombuffer(self.mmap, dtype='<u8', count=row_count, offset=pos)
+            rows = np.frombuffer(self.mmap, dtype='<i8', count=row_count, offset=pos + row_count*8)
+            self.bands.append((band_values, rows))
+            pos += row_count * 16
+        self.ids = np.frombuffer(self.mmap, dtype='S%s' % header['id_width'], count=row_count, offset=pos)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @staticmethod
+    def band_layout(bands):
+        """
+            Return (shifts, widths) of each band when splitting 64 bits into `bands` nearly equal bands.
+            >>> assert SimhashIndex.band_layout(3) == ([42, 21, 0], [22, 21, 21])
+        """
+        widths = [64 // bands + (1 if i < 64 % bands else 0) for i in range(bands)]
+        shifts = [64 - sum(widths[:i+1]) for i in range(bands)]
+        return shifts, widths
+
+    def query_value(self, value, max_distance):
+        """ Return [(row number, distance)] for all rows within max_distance bits of the integer simhash value. """
+        value = np.uint64(value)
+        radius = max_distance // len(self.bands)
+        candidates = []
+        for shift, width, (band_values, rows) in zip(self.shifts, self.widths, self.bands):
+            band_value = (value >> np.uint64(shift)) & np.uint64((1 << width) - 1)
+            probes = band_value ^ flip_masks(width, radius)
+            starts = np.searchsorted(band_values, probes, side='left')
+            ends = np.searchsorted(band_values, probes, side='right')
+            for start, end in zip(starts[starts < ends], ends[starts < ends]):
+                candidates.append(rows[start:end])
+        if not candidates:
+            return []
+        candidates = np.unique(np.concatenate(candidates))
+        distances = popcount(self.hashes[candidates] ^ value)
+        matches = distances <= max_distance
+        return sorted(zip(candidates[matches].tolist(), distances[matches].tolist()), key=lambda m: (m[1], m[0]))
+
+    def query(self, simhash, max_distance):
+        """ Return [(id, distance)] for all documents within max_distance bits of simhash, closest first. """
+        if int(simhash.split(':', 1)[0]) != self.version:
+            raise ValueError("Simhash %s doesn't match index version %s" % (simhash, self.version))
+        return [(self.ids[row].decode('utf8'), distance) for row, distance in self.query_value(simhash_value(simhash), max_distance)]
+
+    def get_row(self, id):
+        """ Return row number of id, or None if id isn't in the index. """
+        id = id.encode('utf8')
+        row = np.searchsorted(self.ids, id)
+        if row < len(self.ids) and self.ids[row] == id:
+            return int(row)
+        return None
+
+    def query_id(self, id, max_distance):
+        """ Return [(id, distance)] for all documents within max_distance bits of the document with the given id. """
+        row = self.get_row(id)
+        if row is None:
+            return []
+        return [(self.ids[row].decode('utf8'), distance) for row, distance in self.query_value(self.hashes[row], max_distance)]
+
+    def near_duplicates(self, max_distance):
+        """ Yield (id, other_id, distance) once for each pair of documents within max_distance bits. """
+        for row, value in enumerate(self.hashes):
+            for other_row, distance in self.query_value(value, max_distance):
+                if other_row > row:
+                    yield self.ids[row].decode('utf8'), self.ids[other_row].decode('utf8'), distance
+
+    @classmethod
+    def write(cls, path, simhashes, bands, version=None):
+        """
+            Atomically write an index for simhashes, an iterable of (id, `version:hex-encoded simhash`).
+            Simhashes from versions other than `version` are skipped, since they can't be compared; by default the
+            index uses the most common stored version. Raises ValueError instead of writing an empty index.
+            Return (version, number of rows written, number of simhashes skipped).
+
+            >>> import tempfile
+            >>> with tempfile.TemporaryDirectory() as tmp:
+            ...     SimhashIndex.write(tmp + '/index', [('a', '1:00'), ('b', '1:ff'), ('c', '2:0f'), ('d', None)], 4)
+            (1, 2, 1)
+        """
+        simhashes = [(id, simhash) for id, simhash in simhashes if simhash]
+        if version is None:
+            version_counts = Counter(int(simhash.split(':', 1)[0]) for id, simhash in simhashes)
+            version = max(version_counts, key=lambda v: (version_counts[v], v), default=SIMHASH_VERSION)
+        prefix = '%s:' % version
+        rows = sorted((id.encode('utf8'), simhash_value(simhash)) for id, simhash in simhashes if simhash.startswith(prefix))
+        if not rows:
+            raise ValueError("No version %s simhashes to index out of %s" % (version, len(simhashes)))
+        id_width = max((len(r[0]) for r in rows), default=1)
+        ids = np.array([r[0] for r in rows], dtype='S%s' % id_width)
+        hashes = np.array([r[1] for r in rows], dtype='<u8')
+        header = json.dumps({'version': version, 'bands': bands, 'id_width': id_width}).encode('utf8')
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            out = bytearray(cls.magic)
+            out += struct.pack('<I', len(header)) + header
+            out += struct.pack('<Q', len(rows))
+            out += bytes(-len(out) % 8)
+            f.write(out)
+            f.write(hashes.tobytes())
+            for shift, width in zip(*cls.band_layout(bands)):
+                band_values = (hashes >> np.uint64(shift)) & np.uint64((1 << width) - 1)
+                order = np.argsort(band_values, kind='stable').astype('<i8')
+                f.write(band_values[order].astype('<u8').tobytes())
+                f.write(order.tobytes())
+            f.write(ids.tobytes())
+        os.replace(temp_path, path)
+        return version, len(rows), len(simhashes) - len(rows)
+
+
+def build_simhash_index(path=None, bands=None, version=None):
     """
-    s1_int = int(s1.split(':', 1)[1], 16)
-    s2_int = int(s2.split(':', 1)[1], 16)
-    return bin(s1_int ^ s2_int).count('1')
+        Write a SimhashIndex of every CAP and CourtListener document in the citation resolver index, using simhashes
+        of the given version, or the most common stored version by default.
+    """
+    from django.conf import settings
+    from capapi.documents import ResolveDocument  # local import to avoid circular import
+    from capapi.response_cache import advance_response_cache_watermark
+
+    path = path or settings.SIMHASH_INDEX_PATH
+    bands = bands or settings.SIMHASH_INDEX_BANDS
+    ResolveDocument._index.refresh()
+    search = ResolveDocument.search().source(['simhash']).params(size=10000)
+    simhashes = ((hit.meta.id, getattr(hit, 'simhash', None)) for hit in search.scan())
+    version, count, skipped = SimhashIndex.write(path, simhashes, bands, version)
+    print("Wrote %s version %s simhashes to %s, skipping %s of other versions" % (count, version, path, skipped))
+    advance_response_cache_watermark()
+
+
+def write_near_duplicates(out_path, max_distance=None, path=None):
+    """
+        Write a CSV of each pair of documents in the simhash index within max_distance bits of each other.
+    """
+    from django.conf import settings
+    from tqdm import tqdm
+
+    index = SimhashIndex(path or settings.SIMHASH_INDEX_PATH)
+    max_distance = settings.SIMHASH_MAX_DISTANCE if max_distance is None else max_distance
+    with open(out_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['id', 'other_id', 'distance'])
+        writer.writerows(tqdm(index.near_duplicates(max_distance), unit=' pairs'))
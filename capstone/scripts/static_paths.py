@@ -0,0 +1,154 @@
+import json
+import mmap
+import os
+import struct
+from array import array
+
+import numpy as np
+
+from django.conf import settings
+from django.utils import timezone
+
+from scripts.cite_index import gather_bytes
+
+
+class StaticPathTable:
+    """
+        Read-only, memory-mapped table from case id to static_file_name, for every case that can be linked to in the
+        static export. Written by StaticPathTable.write(), and built by build_static_path_table(), which
+        set_case_static_file_names() calls. All export workers on a host share the same pages, instead of each
+        volume export querying the paths of the cases it cites.
+
+        File layout:
+            b'CAPSPT01'
+            <uint32 header length> <header json: {"timestamp": <isoformat>}>
+            <uint64 case count> <uint64 path bytes> <padding to 8 bytes>
+            <int64 case ids, sorted>
+            <int64 offset of each case's static_file_name in the path bytes, plus the end offset>
+            <utf8 path bytes>
+
+        Usage:
+            table = StaticPathTable(path)
+            table.lookup([1, 2, 3])  # => {1: '/us/1/0001-01', 3: '/us/1/0003-01'}
+    """
+    magic = b'CAPSPT01'
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(self.magic)] != self.magic:
+            raise ValueError("%s is not a static path table" % path)
+        pos = len(self.magic)
+        header_length, = struct.unpack_from('<I', self.mmap, pos)
+        pos += 4
+        header = json.loads(self.mmap[pos:pos+header_length])
+        pos += header_length
+        case_count, path_bytes = struct.unpack_from('<QQ', self.mmap, pos)
+        pos += 16
+        pos += -pos % 8
+        self.timestamp = header['timestamp']
+        self.case_ids = np.frombuffer(self.mmap, dtype='<i8', count=case_count, offset=pos)
+        pos += case_count * 8
+        self.offsets = np.frombuffer(self.mmap, dtype='<i8', count=case_count + 1, offset=pos)
+        pos += (case_count + 1) * 8
+        self.paths_start = pos
+
+    def __len__(self):
+        return len(self.case_ids)
+
+    def lookup(self, case_ids):
+        """ Return {case_id: static_file_name} for each of case_ids in the table. """
+        case_ids = np.array(sorted(set(case_ids)), dtype=np.int64)
+        if not len(case_ids) or not len(self):
+            return {}
+        rows = np.minimum(np.searchsorted(self.case_ids, case_ids), len(self) - 1)
+        found = self.case_ids[rows] == case_ids
+        paths = {}
+        for case_id, row in zip(case_ids[found].tolist(), rows[found].tolist()):
+            start, end = self.paths_start + int(self.offsets[row]), self.paths_start + int(self.offsets[row + 1])
+            paths[case_id] = self.mmap[start:end].decode('utf8')
+        return paths
+
+    @classmethod
+    def write(cls, path, rows, timestamp):
+        """ Atomically write a table for rows, an iterable of (case_id, static_file_name). Return number of cases written. """
+        ids = array('q')
+        lengths = array('q')
+        blob = bytearray()
+        for case_id, static_file_name in rows:
+            static_file_name = static_file_name.encode('utf8')
+            ids.append(case_id)
+            lengths.append(len(static_file_name))
+            blob += static_file_name
+        ids = np.frombuffer(ids, dtype=np.int64)
+        lengths = np.frombuffer(lengths, dtype=np.int64)
+        paths = np.frombuffer(blob, dtype=np.uint8)
+        if len(ids) and np.any(ids[1:] < ids[:-1]):
+            order = np.argsort(ids, kind='stable')
+            starts = np.cumsum(lengths) - lengths
+            ids, lengths, paths = ids[order], lengths[order], gather_bytes(paths, starts[order], lengths[order])
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        header = json.dumps({'timestamp': timestamp.isoformat()}).encode('utf8')
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            out = bytearray(cls.magic)
+            out += struct.pack('<I', len(header)) + header
+            out += struct.pack('<QQ', len(ids), int(offsets[-1]))
+            out += bytes(-len(out) % 8)
+            f.write(out)
+            f.write(ids.astype('<i8').tobytes())
+            f.write(offsets.astype('<i8').tobytes())
+            f.write(paths.tobytes())
+        os.replace(temp_path, path)
+        return len(ids)
+
+
+_static_path_table_cache = {}
+
+
+def get_static_path_table():
+    """
+        Return the memory-mapped StaticPathTable at settings.STATIC_PATH_TABLE_PATH, reloaded if the file is replaced,
+        or None if it hasn't been built or the setting is None.
+    """
+    path = settings.STATIC_PATH_TABLE_PATH
+    if not path:
+        return None
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    file_key = (path, stat.st_ino, stat.st_mtime_ns)
+    if _static_path_table_cache.get('file_key') != file_key:
+        _static_path_table_cache.update(file_key=file_key, value=StaticPathTable(path))
+    return _static_path_table_cache['value']
+
+
+def static_path_queryset():
+    """ Cases that can be linked to in the static export. """
+    from capdb.models import CaseMetadata  # avoid circular imports
+
+    return CaseMetadata.objects.filter(
+        in_scope=True,
+        volume__out_of_scope=False,
+    ).exclude(static_file_name=None)
+
+
+def get_static_paths(case_ids):
+    """ Return {case_id: static_file_name} for each of case_ids that can be linked to, from the table if it's built. """
+    table = get_static_path_table()
+    if table is not None:
+        return table.lookup(case_ids)
+    return dict(static_path_queryset().filter(id__in=case_ids).values_list("id", "static_file_name"))
+
+
+def build_static_path_table(path=None):
+    """ Write the static path table for all cases that can be linked to, unless settings.STATIC_PATH_TABLE_PATH is None. """
+    path = path or settings.STATIC_PATH_TABLE_PATH
+    if not path:
+        return
+    rows = static_path_queryset().order_by().values_list("id", "static_file_name").iterator(chunk_size=10000)
+    case_count = StaticPathTable.write(path, rows, timezone.now())
+    print("Wrote %s cases to %s" % (case_count, path))
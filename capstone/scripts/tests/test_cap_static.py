@@ -2,15 +2,15 @@ import shutil
 from pathlib import Path
 
 import pytest
-from django.conf import settings
 
-from capdb.models import VolumeMetadata
+from capdb.models import CaseMetadata, VolumeMetadata
 from fabfile import export_cap_static_volumes, summarize_cap_static, set_case_static_file_names
+from scripts.static_paths import get_static_path_table
 from test_data.test_fixtures.helpers import check_path, set_case_text
 
 
 @pytest.mark.django_db(databases=['capdb'])
-def test_export_cap_static(reset_sequences, case_factory, jurisdiction_factory, court_factory, redacted_case_factory, volume_metadata_factory, reporter_factory, tmp_path, pytestconfig, django_assert_num_queries):
+def test_export_cap_static(reset_sequences, case_factory, jurisdiction_factory, court_factory, redacted_case_factory, volume_metadata_factory, reporter_factory, tmp_path, tmp_path_factory, pytestconfig, django_assert_num_queries, settings):
     # set up a reporter with two volumes, each with three cases
     jurisdiction = jurisdiction_factory(name_long="United States", name="U.S.", slug='us')
     jurisdiction2 = jurisdiction_factory(name_long="Massachusetts", name="Mass.", slug='mass')
@@ -18,6 +18,7 @@ def test_export_cap_static(reset_sequences, case_factory, jurisdiction_factory,
     reporter = reporter_factory(full_name="United States Reports", short_name="U.S.", short_name_slug='us')
     reporter.jurisdictions.set([jurisdiction, jurisdiction2])
     volumes = [volume_metadata_factory(volume_number=volume_number, reporter=reporter, redacted=True, barcode=f"123456789{volume_number}") for volume_number in ("1", "2")]
+    citing_cases = []
     for volume in volumes:
         case_factory(volume=volume, first_page="1", reporter=reporter, jurisdiction=jurisdiction, citations__cite="1 U.S. 1", court=court)
         c2 = case_factory(volume=volume, first_page="2", reporter=reporter, jurisdiction=jurisdiction, citations__cite="1 U.S. 2", court=court)
@@ -26,29 +27,54 @@ def test_export_cap_static(reset_sequences, case_factory, jurisdiction_factory,
         # add cite from c2 to c1
         set_case_text(c2, "Cite to 1 U.S. 1")
         c2.sync_case_body_cache()
-    # make sure CaseMetadata.static_file_name is set
+        citing_cases.append(c2)
+    # make sure CaseMetadata.static_file_name is set, and the static path table is built from it
+    settings.STATIC_PATH_TABLE_PATH = str(tmp_path_factory.mktemp('static_paths') / 'static_paths.table')
     set_case_static_file_names()
+    assert get_static_path_table().lookup(c.id for c in citing_cases) == {c.id: c.static_file_name for c in CaseMetadata.objects.filter(id__in=[c.id for c in citing_cases])}
     # for some reason case_factory is creating extra volumes, so delete those
     VolumeMetadata.objects.exclude(pk__in=[v.pk for v in volumes]).update(out_of_scope=True)
 
     # run export to temp dir
-    with django_assert_num_queries(select=41, update=10, insert=2, delete=2, rollback=2):
+    with django_assert_num_queries(select=37, update=10, insert=2, delete=2, rollback=2):
         export_cap_static_volumes(dest_dir=str(tmp_path))
     with django_assert_num_queries(select=8):
         summarize_cap_static(str(tmp_path))
 
     # compare temp dir to test_data/cap_static
+    # (ExportManifest.json files record case timestamps, so they change each run)
+    manifest_paths = sorted(str(p.relative_to(tmp_path)) for p in tmp_path.rglob('ExportManifest.json'))
+    assert manifest_paths == ['redacted/us/1/ExportManifest.json', 'redacted/us/2/ExportManifest.json',
+                              'unredacted/us/1/ExportManifest.json', 'unredacted/us/2/ExportManifest.json']
     cap_static_dir = Path(settings.BASE_DIR, 'test_data/cap_static')
     if pytestconfig.getoption('recreate_files'):
         # if --recreate_files was passed, copy temp dir to test_data/cap_static instead of checking
         if cap_static_dir.exists():
             shutil.rmtree(cap_static_dir)
-        shutil.copytree(tmp_path, cap_static_dir)
+        shutil.copytree(tmp_path, cap_static_dir, ignore=shutil.ignore_patterns('ExportManifest.json'))
     else:
         cap_static_paths = {p.relative_to(cap_static_dir) for p in cap_static_dir.rglob('*')}
-        tmp_paths = {p.relative_to(tmp_path) for p in tmp_path.rglob('*')}
+        tmp_paths = {p.relative_to(tmp_path) for p in tmp_path.rglob('*') if p.name != 'ExportManifest.json'}
         assert cap_static_paths == tmp_paths, "Missing or extra files in cap_static export."
         for path in tmp_path.rglob('*'):
-            if not path.is_file():
+            if not path.is_file() or path.name == 'ExportManifest.json':
                 continue
             check_path(pytestconfig, path, cap_static_dir / path.relative_to(tmp_path))
+
+    # exporting again skips unchanged volumes
+    def get_mtimes(volume_number):
+        return {p: p.stat().st_mtime_ns for p in tmp_path.glob(f'*/us/{volume_number}/**/*') if p.is_file()}
+    mtimes = {n: get_mtimes(n) for n in ('1', '2')}
+    export_cap_static_volumes(dest_dir=str(tmp_path))
+    assert {n: get_mtimes(n) for n in ('1', '2')} == mtimes
+
+    # a changed case causes only its volume to be exported again
+    citing_cases[0].refresh_from_db()
+    set_case_text(citing_cases[0], "Changed cite to 1 U.S. 1")
+    citing_cases[0].sync_case_body_cache()
+    export_cap_static_volumes(dest_dir=str(tmp_path))
+    new_mtimes = get_mtimes('1')
+    assert new_mtimes.keys() == mtimes['1'].keys()
+    assert all(new_mtimes[p] != mtimes['1'][p] for p in new_mtimes)
+    assert get_mtimes('2') == mtimes['2']
+    assert 'Changed cite' in (tmp_path / 'redacted/us/1/html' / (citing_cases[0].static_file_name.rsplit('/', 1)[-1] + '.html')).read_text()
@@ -0,0 +1,50 @@
+import json
+
+import pytest
+from elasticsearch import NotFoundError
+
+from capapi.documents import CaseDocument, ResolveDocument
+from capdb.models import CaseMetadata
+from scripts.es_indexer import BulkIndexer, prepare_case_actions
+
+
+class RejectFirstAttempt:
+    """ Elasticsearch client that answers the first bulk request for each document with 429, like a full queue. """
+    def __init__(self, client):
+        self.client = client
+        self.seen = set()
+
+    def bulk(self, body, **kwargs):
+        actions = [line for line in body.split(b'\n') if line.startswith((b'{"index"', b'{"delete"'))]
+        if self.seen.issuperset(actions):
+            return self.client.bulk(body, **kwargs)
+        self.seen.update(actions)
+        return {'items': [{next(iter(json.loads(action))): {'status': 429}} for action in actions]}
+
+
+@pytest.mark.django_db(databases=['capdb'])
+@pytest.mark.parametrize("processes", [1, 2])
+def test_bulk_indexer(case_factory, elasticsearch, processes):
+    cases = [case_factory() for _ in range(5)]
+    cases[0].duplicative = True
+    cases[0].save()
+    cases = list(CaseMetadata.objects.filter(id__in=[c.id for c in cases]).for_indexing().order_by('id'))
+
+    # small requests, one document per request, so each one is rejected once and then retried
+    indexer = BulkIndexer(chunk_bytes=1, min_chunk_bytes=1, max_chunk_bytes=1, threads=2, initial_backoff=0, report_interval=None)
+    indexer.client = RejectFirstAttempt(indexer.get_client())
+    assert indexer.index(prepare_case_actions(cases, processes=processes)) == {}
+    assert indexer.stats.docs == 10
+    assert indexer.stats.retries == 10
+
+    for case in cases[1:]:
+        assert CaseDocument.get(case.id).name_abbreviation == case.name_abbreviation
+        assert ResolveDocument.get(case.id).frontend_url.endswith(case.frontend_url)
+    with pytest.raises(NotFoundError):
+        CaseDocument.get(cases[0].id)
+
+    # documents that keep getting rejected are reported as failures
+    indexer = BulkIndexer(max_retries=0, report_interval=None)
+    indexer.client = RejectFirstAttempt(indexer.get_client())
+    failures = indexer.index(prepare_case_actions(cases[1:2]))
+    assert failures == {cases[1].id: {'status': 429}}
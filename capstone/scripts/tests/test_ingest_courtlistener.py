@@ -34,7 +34,7 @@ def test_ingest_courtlistener(client, elasticsearch):
                 'decision_date': '2011-06-13',
                 'frontend_url': 'https://www.courtlistener.com/opinion/891689/state-v-ramirez/',
                 'api_url': 'https://www.courtlistener.com/api/rest/v3/clusters/891689/',
-                'simhash': '1:b862eaa3efce3d01'
+                'simhash': '2:ae491fa8a37a4bd3'
             }
         ]
     }
@@ -1,6 +1,9 @@
+import pytest
 from flaky import flaky
 
 from capapi.views.api_views import NgramViewSet
+from capdb.storages import NgramTotalsTable
+from capdb.models import Citation, CaseStructure, ExtractedCitation, CaseBodyCache, CaseLastUpdate, CaseMetadata
 
 
 @flaky(max_runs=10)  # ngrammed_cases call to ngram_jurisdictions doesn't reliably work because it uses multiprocessing within pytest environment
@@ -21,3 +24,93 @@ def test_ngrams(request):
     assert trigrams == set(stored.keys())
     assert stored["one two three"] == {None: {None: [2, 2], 100: [2, 2]}, ngrammed_cases[0].jurisdiction_id: [100, 1, 1], ngrammed_cases[1].jurisdiction_id: [100, 1, 1]}
 
+    # check totals table shared by API workers
+    table = NgramTotalsTable(ngram_kv_store_ro.totals_table_path())
+    assert table[(None, None, 3)] == [6, 3]
+    assert table[(ngrammed_cases[1].jurisdiction_id, 2000, 3)] == [4, 2]
+    assert table.jurisdiction_id_to_slug[ngrammed_cases[1].jurisdiction_id] == 'jur1'
+    assert isinstance(NgramViewSet.get_totals()[1], NgramTotalsTable)
+
+    # check wildcard index
+    assert ngram_kv_store_ro.get(b"wildcard\3two three ", packed=True) == [[b"\3two three don't", 2], [b"\3two three four", 1]]
+
+
+
+def test_ngram_spiller(tmpdir):
+    from scripts.ngrams import NgramSpiller, merge_runs, read_run
+
+    # a threshold of 2 forces a spill after every document here
+    spiller = NgramSpiller(str(tmpdir), 2, threshold=2)
+    spiller.add(["one two", "two three", "one two"])
+    spiller.add(["two three", "three four"])
+    spiller.add(["one two"])
+    run_paths = spiller.finish()
+    assert len(run_paths) == 3
+
+    assert list(merge_runs([read_run(path) for path in run_paths])) == [
+        (b"\x02one two", 3, 2),
+        (b"\x02three four", 1, 1),
+        (b"\x02two three", 2, 2),
+    ]
+
+
+@flaky(max_runs=10)  # see test_ngrams
+def test_ngrams_with_spill(request, settings):
+    settings.NGRAM_SPILL_THRESHOLD = 1
+    ngrammed_cases = request.getfixturevalue('ngrammed_cases')
+    from capdb.storages import ngram_kv_store_ro
+
+    # spilling to disk on every document gives the same results as counting in memory
+    stored = {k.decode('utf8')[1:]: v for k, v in ngram_kv_store_ro.get_prefix(b'\3', packed=True)}
+    assert stored["one two three"] == {None: {None: [2, 2], 100: [2, 2]}, ngrammed_cases[0].jurisdiction_id: [100, 1, 1], ngrammed_cases[1].jurisdiction_id: [100, 1, 1]}
+
+
+@flaky(max_runs=10)  # see test_ngrams
+def test_update_ngrams_from_queue(request):
+    ngrammed_cases = request.getfixturevalue('ngrammed_cases')
+    from capdb.storages import ngram_kv_store_ro
+    from scripts.ngrams import update_ngrams_from_queue
+
+    # cases that were already counted by the full build are unchanged
+    update_ngrams_from_queue()
+    ngram_kv_store_ro.open()
+    assert NgramViewSet.load_totals()[(None, None, 3)] == [6, 3]
+
+    # edit one case and delete another
+    jur0_id, jur1_id = ngrammed_cases[0].jurisdiction_id, ngrammed_cases[1].jurisdiction_id
+    body_cache = ngrammed_cases[0].body_cache
+    body_cache.text = body_cache.html = "Four five six."
+    body_cache.save()
+    deleted_case = ngrammed_cases[2]
+    Citation.objects.filter(case=deleted_case).delete()
+    CaseStructure.objects.filter(metadata=deleted_case).delete()
+    ExtractedCitation.objects.filter(cited_by=deleted_case).delete()
+    CaseBodyCache.objects.filter(metadata=deleted_case).delete()
+    CaseLastUpdate.objects.filter(case=deleted_case).delete()
+    CaseMetadata.objects.filter(id=deleted_case.id).delete()
+    update_ngrams_from_queue()
+
+    # the API catches up with the update without a restart
+    assert NgramViewSet.get_totals()[1][(jur0_id, 2000, 3)] == [1, 1]
+    assert isinstance(NgramViewSet.get_totals()[1], NgramTotalsTable)
+    ngram_kv_store_ro.open()
+
+    totals = NgramViewSet.load_totals()
+    assert totals[(jur0_id, 2000, 3)] == [1, 1]
+    assert totals[(jur1_id, 2000, 3)] == [2, 1]
+    stored = {k.decode('utf8')[1:]: v for k, v in ngram_kv_store_ro.get_prefix(b'\3', packed=True)}
+    assert stored["one two three"] == {None: {None: [1, 1], 100: [1, 1]}, jur1_id: [100, 1, 1]}
+    assert stored["four five six"] == {None: {None: [1, 1], 100: [1, 1]}, jur0_id: [100, 1, 1]}
+    assert stored["three don't don't"] == {None: {None: [0, 0]}}
+    assert ngram_kv_store_ro.get(b"wildcard\3two three ", packed=True) == [[b"\3two three don't", 1]]
+    assert ngram_kv_store_ro.get(b"wildcard\3three don't ", packed=True) is None
+
+    # databases built before per-case ledgers can't be updated incrementally
+    from capdb.storages import ngram_kv_store
+    from scripts.ngrams import get_ledger_key
+    ngram_kv_store.delete(get_ledger_key(jur1_id, 2000))
+    body_cache = ngrammed_cases[1].body_cache
+    body_cache.text = body_cache.html = "Seven eight nine."
+    body_cache.save()
+    with pytest.raises(ValueError, match="without per-case ledger entries"):
+        update_ngrams_from_queue()
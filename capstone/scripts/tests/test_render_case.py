@@ -0,0 +1,115 @@
+import json
+import random
+from pathlib import Path
+
+import pytest
+from django.conf import settings
+from pyquery import PyQuery
+
+from scripts.render_case import extract_json_from_html
+
+
+def extract_json_from_html_pyquery(html):
+    """
+        Reference version of extract_json_from_html() using PyQuery, which selects and walks the tree once per field.
+        Also timed against it by `fab benchmark_json_extraction`.
+    """
+    casebody_pq = PyQuery(html)
+    casebody_pq.remove(
+        '.page-label,.footnotemark,.bracketnum,.footnote > a')  # remove page numbers and footnote numbers from text/json
+
+    # extract each opinion into a dictionary
+    opinions = []
+    opinions.append({
+        'type': 'head_matter',
+        'author': 'head_matter',
+        'text': casebody_pq('.head-matter').text(),
+    })
+    for opinion in casebody_pq.items('.opinion'):
+        opinions.append({
+            'type': opinion.attr['data-type'],
+            'author': opinion('.author').text() or None,
+            'text': opinion.text(),
+        })
+    json = {
+        'judges': [judge.text() for judge in casebody_pq('.judges').items()],
+        'attorneys': [attorney.text() for attorney in casebody_pq('.attorneys').items()],
+        'parties': [party.text() for party in casebody_pq('.parties').items()],
+        'opinions': opinions,
+        'corrections': casebody_pq('.corrections').text(),
+    }
+
+    text = "\n".join([o['text'] for o in json['opinions']] + [json['corrections']])
+    return json, text
+
+
+def test_extract_json_from_html_golden():
+    # output matches the PyQuery version for each exported html fixture
+    html_paths = sorted(Path(settings.BASE_DIR, 'test_data/cap_static').glob('*/*/*/html/*.html'))
+    assert html_paths
+    for html_path in html_paths:
+        html = html_path.read_text()
+        assert extract_json_from_html(html) == extract_json_from_html_pyquery(html), html_path
+
+    # and the exported json for an unredacted case
+    html_path = Path(settings.BASE_DIR, 'test_data/cap_static/unredacted/us/1/html/0002-01.html')
+    casebody = json.loads(Path(settings.BASE_DIR, 'test_data/cap_static/unredacted/us/1/cases/0002-01.json').read_text())['casebody']
+    extracted, text = extract_json_from_html(html_path.read_text())
+    assert extracted['opinions'].pop(0)['text'] == casebody.pop('head_matter')
+    assert extracted == casebody
+    assert text == 'Case text 0\nCase text 1Case text 2\nCase text 3\n'
+
+
+@pytest.mark.parametrize("html", [
+    # page numbers, footnote marks and footnote numbers are removed, keeping the text after them
+    '<section class="casebody"><section class="head-matter"><h4 class="parties">A v. B</h4>'
+    '<p class="judges">J<a class="page-label">*1</a>ones</p></section>'
+    '<article class="opinion" data-type="majority"><p class="author">Smith, J.</p>'
+    '<p>Text<a class="footnotemark">1</a>here.<br/>More <em>text</em>.</p>'
+    '<aside class="footnote"><a href="#ref1">1</a><p>Note <span class="bracketnum">[1]</span>.</p></aside>'
+    '</article><article class="opinion" data-type="dissent"><p>No author.</p></article>'
+    '<section class="corrections">Fixed</section></section>',
+    # nested classes of interest, whitespace and comments
+    '<section class="casebody"><section class="head-matter parties"><p class="attorneys"> a \n\t b\xa0c<!-- x --></p>'
+    '</section><article class="opinion"><div class="author"><span class="author">X</span></div></article></section>',
+    # malformed html falls back to the html parser
+    '<section class="casebody"><article class="opinion"><p>one<p>two</article></section>',
+])
+def test_extract_json_from_html_matches_pyquery(html):
+    assert extract_json_from_html(html) == extract_json_from_html_pyquery(html)
+
+
+def random_case_html(rand, texts, depth=0):
+    """ Return random html made of elements with the classes extract_json_from_html() looks for, and texts. """
+    tags = ['p', 'a', 'span', 'em', 'br', 'section', 'article', 'aside', 'h4', 'blockquote']
+    classes = ['head-matter', 'opinion', 'author', 'judges', 'attorneys', 'parties', 'corrections', 'page-label',
+               'footnotemark', 'bracketnum', 'footnote', 'other']
+    out = []
+    for _ in range(rand.randint(0, 4)):
+        if depth > 4 or rand.random() < 0.35:
+            out.append(rand.choice(texts))
+            continue
+        tag = rand.choice(tags)
+        attrs = ' class="%s"' % ' '.join(rand.sample(classes, rand.randint(0, 2)))
+        if rand.random() < 0.5:
+            attrs += ' data-type="type%s"' % rand.randint(0, 2)
+        out.append('<%s%s/>' % (tag, attrs) if tag == 'br' else '<%s%s>%s</%s>' % (tag, attrs, random_case_html(rand, texts, depth + 1), tag))
+    return ''.join(out)
+
+
+def test_extract_json_from_html_matches_pyquery_random():
+    rand = random.Random(1)
+    texts = ['', ' ', 'a', ' b ', '\n\t c  d ', '\xa0e', '&amp;']
+    for _ in range(500):
+        html = '<section class="casebody">%s</section>' % random_case_html(rand, texts)
+        assert extract_json_from_html(html) == extract_json_from_html_pyquery(html), html
+
+
+def test_extract_json_from_html_matches_pyquery_whitespace():
+    # text next to removed page labels and footnote marks, ending in characters that are HTML whitespace but not
+    # python whitespace, or the other way around
+    rand = random.Random(2)
+    texts = ['', ' ', 'x', 'y&amp;', 'x\u200b', '\u200by', 'x\r', '\r\ny', '\xa0', '\u200b \r']
+    for _ in range(5000):
+        html = '<section class="casebody">%s</section>' % random_case_html(rand, texts)
+        assert extract_json_from_html(html) == extract_json_from_html_pyquery(html), html
@@ -0,0 +1,26 @@
+from pathlib import Path
+
+import pytest
+from django.conf import settings
+
+from scripts.helpers import parse_html
+from scripts.tokenizer import tokenize, tokenize_many
+
+
+def test_tokenizer_versions_match():
+    texts = [
+        "Mr. Smith's dog, (age 3) ran. It's “fast”... See U.S. v. Jones, 1 F.2d 2 (1st Cir. 1999); Id. at 3.",
+        "\"Quoted.\" (Parenthetical.) Then -- dashes—and 'single quotes.' Cost: $3.88, or 3,000 £; 10% & more?!",
+        "J. Bach wrote it. No. 5 is next.\n\nA new paragraph... and an ellipsis. ΟΔΟΣ, ΟΔΟΣ.",
+        "",
+    ]
+    # real case text
+    for path in sorted(Path(settings.BASE_DIR, 'test_data/fastcase').glob('*/*/*.html'))[:10]:
+        texts.append(parse_html(path.read_text()).text())
+    assert tokenize_many(texts, 2) == tokenize_many(texts, 1)
+    assert list(tokenize(texts[0], 2)) == list(tokenize(texts[0], 1)) == [
+        'mr.', "smith's", 'dog', 'age', '3', 'ran', "it's", 'fast', 'see', 'u.s.', 'v.', 'jones', '1', 'f.2d', '2',
+        '1st', 'cir', '1999', 'id', 'at', '3']
+
+    with pytest.raises(ValueError):
+        tokenize(texts[0], 3)
@@ -1,33 +1,42 @@
 import copy
-import nltk
+import json
+import re
+from functools import lru_cache
 
 from django.conf import settings
 
 
-nltk.data.path = settings.NLTK_PATH
-unicode_translate_table = dict((ord(a), ord(b)) for a, b in zip(u'\u201c\u201d\u2018\u2019', u'""\'\''))
-
-# custom tokenizer to disable separating contractions and possessives into separate words
-tokenizer = copy.copy(nltk.tokenize._treebank_word_tokenizer)
-tokenizer.CONTRACTIONS2 = tokenizer.CONTRACTIONS3 = []
-tokenizer.ENDING_QUOTES = tokenizer.ENDING_QUOTES[:-2]
+# Tokenizer versions. Ngram and text analysis outputs opt into a version with settings.NGRAM_TOKENIZER_VERSION and
+# settings.TEXT_ANALYSIS_TOKENIZER_VERSION; changing either means those outputs should be rebuilt.
+#   version 1: nltk's punkt sentence tokenizer, then nltk's treebank word tokenizer for each sentence
+#   version 2: the same tokens from a port of punkt's sentence break decisions and a single pass of the treebank
+#              regexes over all sentences at once, without loading nltk
+TOKENIZER_VERSIONS = (1, 2)
 
 strip_chars = """`~!@#$%^&*()-_=+[{]}\|;:'",<>/?¡°¿‡†—•■"""
 strip_right_chars = strip_chars + "£$©"
 strip_left_chars = strip_chars + ".®"
 
 
-def tokenize(text):
-    # clean up input
-    text = text.translate(unicode_translate_table)\
-        .replace(u"\u2014", u" \u2014 ")  # add spaces around m-dashes
+def clean_text(text):
+    """ Normalize curly quotes and add spaces around m-dashes. """
+    return text.replace('“', '"').replace('”', '"').replace('‘', "'").replace('’', "'").replace("—", " — ")
 
-    # yield each valid token
-    for sentence in nltk.sent_tokenize(text):
-        for token in tokenizer.tokenize(sentence):
-            token = token.lower().rstrip(strip_right_chars).lstrip(strip_left_chars)
-            if token:
-                yield token
+
+def tokenize(text, version=1):
+    """ Return an iterable of lowercased word tokens for text, using the given tokenizer version. """
+    if version == 1:
+        return nltk_tokenize(text)
+    if version == 2:
+        return tokenize_many([text], version)[0]
+    raise ValueError("Unknown tokenizer version %s" % version)
+
+
+def tokenize_many(texts, version=1):
+    """ Return a list of tokens for each of texts, using the given tokenizer version. """
+    if version == 2:
+        return regex_tokenize_many(texts)
+    return [list(tokenize(text, version)) for text in texts]
 
 
 def ngrams(words, n):
@@ -37,4 +46,330 @@ def ngrams(words, n):
     """
     words = list(words)
     word_lists = [words[i:-n+i+1 or None] for i in range(n)]
-    return zip(*word_lists)
\ No newline at end of file
+    return zip(*word_lists)
+
+
+### version 1: nltk ###
+
+@lru_cache(None)
+def get_nltk_tokenizers():
+    """ Return (sent_tokenize, word tokenizer). nltk is imported here so workers that don't use it don't load it. """
+    import nltk
+
+    nltk.data.path = settings.NLTK_PATH
+
+    # custom tokenizer to disable separating contractions and possessives into separate words
+    tokenizer = copy.copy(nltk.tokenize._treebank_word_tokenizer)
+    tokenizer.CONTRACTIONS2 = tokenizer.CONTRACTIONS3 = []
+    tokenizer.ENDING_QUOTES = tokenizer.ENDING_QUOTES[:-2]
+
+    return nltk.sent_tokenize, tokenizer
+
+
+def nltk_tokenize(text):
+    sent_tokenize, tokenizer = get_nltk_tokenizers()
+
+    # yield each valid token
+    for sentence in sent_tokenize(clean_text(text)):
+        for token in tokenizer.tokenize(sentence):
+            token = token.lower().rstrip(strip_right_chars).lstrip(strip_left_chars)
+            if token:
+                yield token
+
+
+def export_punkt_params(path=None):
+    """
+        Write the parameters of nltk's english punkt model to path (default settings.PUNKT_PARAMS_PATH) as json, for
+        PunktSentenceSplitter.
+    """
+    import nltk
+
+    nltk.data.path = settings.NLTK_PATH
+    params = nltk.data.load('tokenizers/punkt/english.pickle')._params
+    with open(path or settings.PUNKT_PARAMS_PATH, 'w') as f:
+        json.dump({
+            'abbrev_types': sorted(params.abbrev_types),
+            'collocations': sorted(params.collocations),
+            'sent_starters': sorted(params.sent_starters),
+            'ortho_context': dict(sorted(params.ortho_context.items())),
+        }, f, ensure_ascii=False, indent=0)
+
+
+### version 2: regexes ###
+
+## sentence splitting, ported from nltk.tokenize.punkt.PunktSentenceTokenizer (nltk 3.7) ##
+
+# orthographic contexts in which a word type was seen in training: BEG=beginning, MID=middle, UNK=unknown position in
+# a sentence; UC=uppercase, LC=lowercase
+ORTHO_BEG_UC, ORTHO_MID_UC, ORTHO_UNK_UC, ORTHO_BEG_LC, ORTHO_MID_LC, ORTHO_UNK_LC = (1 << i for i in range(1, 7))
+ORTHO_UC = ORTHO_BEG_UC + ORTHO_MID_UC + ORTHO_UNK_UC
+ORTHO_LC = ORTHO_BEG_LC + ORTHO_MID_LC + ORTHO_UNK_LC
+
+PUNKT_NON_WORD = r"(?:[)\";}\]\*:@\'\({\[?!])"
+PUNKT_MULTI_CHAR = r"(?:\-{2,}|\.{2,}|(?:\.\s){2,}\.)"
+PUNKT_WORD_RE = re.compile(r"""(
+        %(MultiChar)s
+        |
+        (?=%(WordStart)s)\S+?  # Accept word characters until end is found
+        (?= # Sequences marking a word's end
+            \s|                                 # White-space
+            $|                                  # End-of-string
+            %(NonWord)s|%(MultiChar)s|          # Punctuation
+            ,(?=$|\s|%(NonWord)s|%(MultiChar)s) # Comma if at end of word
+        )
+        |
+        \S
+    )""" % {
+    'NonWord': PUNKT_NON_WORD,
+    'MultiChar': PUNKT_MULTI_CHAR,
+    'WordStart': r"[^\(\"\`{\[:;&\#\*@\)}\]\-,]",
+}, re.UNICODE | re.VERBOSE)
+PUNKT_PERIOD_CONTEXT_RE = re.compile(r"""
+    [\.\?!]                      # a potential sentence ending
+    (?=(?P<after_tok>
+        %s                       # either other punctuation
+        |
+        \s+(?P<next_tok>\S+)     # or whitespace and some other token
+    ))""" % PUNKT_NON_WORD, re.UNICODE | re.VERBOSE)
+PUNKT_BOUNDARY_REALIGNMENT_RE = re.compile(r'["\')\]}]+?(?:\s+|(?=--)|$)', re.MULTILINE)
+PUNKT_NUMERIC_RE = re.compile(r"^-?[\.,]?\d[\d,\.-]*\.?$")
+PUNKT_INITIAL_RE = re.compile(r"[^\W\d]\.$", re.UNICODE)
+PUNKT_ELLIPSIS_RE = re.compile(r"\.\.+$")
+PUNKT_SENT_END_CHARS = ('.', '?', '!')
+PUNKT_PUNCTUATION = tuple(";:,.!?")
+
+# first pass annotations of a token
+SENTBREAK, ABBR, ELLIPSIS = 'sentbreak', 'abbr', 'ellipsis'
+
+
+class PunktSentenceSplitter:
+    """
+        Find sentence boundaries the same way as nltk's PunktSentenceTokenizer.tokenize(), given the same parameters,
+        without building a PunktToken object for each word: only the few words around each candidate sentence break
+        are examined, and only for the decisions that tokenize() actually depends on.
+        >>> splitter = PunktSentenceSplitter({
+        ...     'abbrev_types': ['mr'], 'collocations': [], 'sent_starters': [], 'ortho_context': {}})
+        >>> assert splitter.sentences('Mr. Smith sued. He lost (on appeal.) Then he paid!') == [
+        ...     'Mr. Smith sued.', 'He lost (on appeal.)', 'Then he paid!']
+    """
+    def __init__(self, params):
+        self.abbrev_types = set(params['abbrev_types'])
+        self.collocations = set(tuple(c) for c in params['collocations'])
+        self.sent_starters = set(params['sent_starters'])
+        self.ortho_context = params['ortho_context']
+
+    def sentences(self, text):
+        return [text[start:end] for start, end in self.spans(text)]
+
+    def spans(self, text):
+        """ Return (start, end) of each sentence in text. """
+        # find candidate breaks, with the word before each, from right to left, skipping candidates inside the word
+        # before a candidate to their right -- see PunktSentenceTokenizer._match_potential_end_contexts
+        candidates = []
+        before_start = 0
+        for match in reversed(list(PUNKT_PERIOD_CONTEXT_RE.finditer(text))):
+            if candidates and match.end() > before_start:
+                continue
+            # equivalent to text[:match.start()].rsplit(maxsplit=1), without copying text
+            word_end = match.start()
+            while word_end and text[word_end - 1].isspace():
+                word_end -= 1
+            word_start = word_end
+            while word_start and not text[word_start - 1].isspace():
+                word_start -= 1
+            before_start = word_start
+            while before_start and text[before_start - 1].isspace():
+                before_start -= 1
+            candidates.append((match, text[word_start:word_end]))
+
+        # see PunktSentenceTokenizer._slices_from_text
+        slices = []
+        last_break = 0
+        for match, before_word in reversed(candidates):
+            if self.contains_sentbreak(before_word + match.group() + match.group('after_tok')):
+                slices.append((last_break, match.end()))
+                last_break = match.start('next_tok') if match.group('next_tok') else match.end()
+        slices.append((last_break, len(text.rstrip())))
+
+        # move closing quotes and brackets after a break into the sentence before it -- see
+        # PunktSentenceTokenizer._realign_boundaries
+        spans = []
+        realign = 0
+        for i, (start, end) in enumerate(slices):
+            start += realign
+            if i + 1 == len(slices):
+                if end > start:
+                    spans.append((start, end))
+                continue
+            next_start, next_end = slices[i + 1]
+            m = PUNKT_BOUNDARY_REALIGNMENT_RE.match(text, next_start, next_end)
+            if m:
+                spans.append((start, next_start + len(m.group(0).rstrip())))
+                realign = m.end() - next_start
+            else:
+                realign = 0
+                if end > start:
+                    spans.append((start, end))
+        return spans
+
+    def contains_sentbreak(self, text):
+        """ Return True if any token in text other than the last is a sentence break. """
+        tokens = [token for line in text.split('\n') for token in PUNKT_WORD_RE.findall(line)]
+        for i in range(len(tokens) - 1):
+            if self.is_sentbreak(tokens[i], tokens[i + 1]):
+                return True
+        return False
+
+    def first_pass(self, token):
+        """ Return SENTBREAK, ABBR, ELLIPSIS or None for token, based on its type alone. """
+        if token in PUNKT_SENT_END_CHARS:
+            return SENTBREAK
+        if PUNKT_ELLIPSIS_RE.match(token):
+            return ELLIPSIS
+        if token.endswith('.') and not token.endswith('..'):
+            typ = token[:-1].lower()
+            if typ in self.abbrev_types or typ.split('-')[-1] in self.abbrev_types:
+                return ABBR
+            return SENTBREAK
+        return None
+
+    def is_sentbreak(self, token, next_token):
+        """ Return True if token is a sentence break, given the token after it. See _second_pass_annotation. """
+        annotation = self.first_pass(token)
+        if not token.endswith('.'):
+            return annotation == SENTBREAK
+
+        typ = token_type_no_period(token_type(token))
+        next_typ = token_type(next_token)
+        if self.first_pass(next_token) == SENTBREAK:
+            next_typ = token_type_no_period(next_typ)
+        is_initial = PUNKT_INITIAL_RE.match(token)
+
+        # collocation heuristic
+        if (typ, next_typ) in self.collocations:
+            return False
+
+        # abbreviations and ellipses are also sentence breaks if the next word looks like a sentence starter
+        if annotation in (ABBR, ELLIPSIS) and not is_initial:
+            if self.ortho_heuristic(next_token, next_typ) is True:
+                return True
+            if next_token[0].isupper() and next_typ in self.sent_starters:
+                return True
+
+        # initials and ordinals are abbreviations if the next word doesn't look like a sentence starter
+        if is_initial or typ == '##number##':
+            is_sent_starter = self.ortho_heuristic(next_token, next_typ)
+            if is_sent_starter is False:
+                return False
+            if (
+                is_sent_starter is None
+                and is_initial
+                and next_token[0].isupper()
+                and not (self.ortho_context.get(next_typ, 0) & ORTHO_LC)
+            ):
+                return False
+
+        return annotation == SENTBREAK
+
+    def ortho_heuristic(self, token, typ):
+        """ Return True if token starts a sentence, False if it doesn't, or None if unknown. """
+        if token in PUNKT_PUNCTUATION:
+            return False
+        ortho_context = self.ortho_context.get(typ, 0)
+        if token[0].isupper() and (ortho_context & ORTHO_LC) and not (ortho_context & ORTHO_MID_UC):
+            return True
+        if token[0].islower() and ((ortho_context & ORTHO_UC) or not (ortho_context & ORTHO_BEG_LC)):
+            return False
+        return None
+
+
+def token_type(token):
+    """ Case-normalized representation of token, with numbers replaced by ##number##. """
+    token = token.lower()
+    return '##number##' if PUNKT_NUMERIC_RE.match(token) else token
+
+
+def token_type_no_period(typ):
+    return typ[:-1] if len(typ) > 1 and typ[-1] == '.' else typ
+
+
+@lru_cache(None)
+def get_sentence_splitter():
+    with open(settings.PUNKT_PARAMS_PATH) as f:
+        return PunktSentenceSplitter(json.load(f))
+
+
+## word splitting ##
+
+# Sentences and texts are joined with separators, so the treebank regexes can run once over all of them instead of
+# once per sentence. Every separator is padded with spaces, so each sentence sees the same context at its edges as
+# the padding nltk adds. Texts must not contain NUL characters, as postgres text can't.
+SENTENCE_SEPARATOR = ' \x00 '
+TEXT_SEPARATOR = ' \x00\x00 '
+
+
+def spaced(chars):
+    """ Rules to put spaces around each of chars. """
+    return [(c, ' %s ' % c) for c in chars]
+
+
+# Rules equivalent to nltk's NLTKWordTokenizer regexes as customized for version 1, in the order nltk applies them.
+# Each rule is a (regex or string, replacement) pair. They produce the same tokens, not the same spacing:
+#   - rules that put spaces around characters regardless of context use str.replace(), which is much faster
+#   - context-dependent rules start with a literal character where possible, and use lookbehinds instead of
+#     capturing the character before a match, so the regex engine can skip ahead to candidate matches
+#   - rules that can't change the tokens returned by tokenize() are left out: the two that split a sentence's final
+#     ',' or ':' or turn its opening '"' into '``', whose tokens are stripped either way, and the second final period
+#     rule, which never matches after the first
+WORD_SPLIT_RULES = [
+    # starting quotes
+    *spaced('«“‘„'),
+    (re.compile(r"`+"), r" \g<0> "),
+    ('``', ' `` '),
+    (re.compile(r"[\"'](?:(?<=[ \(\[{<]\")|(?<=[ \(\[{<]')')"), " `` "),
+    (re.compile(r"(?i)(\')(?!re|ve|ll|m|t|s|d|n)(\w)\b"), r"\1 \2"),
+    # punctuation -- the final period of each sentence, then other punctuation
+    (re.compile(r'\.(?<=[^\.\x00]\.)([\]\)}>"\'' "»”’ " r"]*)\s*(?= \x00)"), r" . \1 "),
+    (re.compile(r"(?=[:,]\D)|(?<=[:,])(?=\D)"), " "),
+    (re.compile(r"\.{2,}"), r" \g<0> "),
+    *spaced(';@#$%&?!'),
+    (re.compile(r"'(?<=[^']') "), " ' "),
+    *spaced('*[](){}<>'),
+    ('--', ' -- '),
+    # ending quotes
+    *spaced('»”’'),
+    ("''", " '' "),
+    ('"', " '' "),
+]
+
+
+def regex_tokenize_many(texts):
+    """
+        Version 2 of tokenize_many().
+        >>> assert regex_tokenize_many(["Mr. Smith's dog, (age 3) ran. It's “fast”..."]) == [
+        ...     ['mr.', "smith's", 'dog', 'age', '3', 'ran', "it's", 'fast']]
+    """
+    splitter = get_sentence_splitter()
+    joined = []
+    for text in texts:
+        text = clean_text(text.replace('\x00', ''))
+        joined.append(SENTENCE_SEPARATOR.join(text[start:end] for start, end in splitter.spans(text)))
+    joined = TEXT_SEPARATOR + TEXT_SEPARATOR.join(joined) + TEXT_SEPARATOR
+    for rule, replacement in WORD_SPLIT_RULES:
+        if type(rule) is str:
+            joined = joined.replace(rule, replacement)
+        else:
+            joined = rule.sub(replacement, joined)
+
+    # lowercase everything at once, unless there's a capital sigma, which lowercases differently at the end of a word
+    lowercase_tokens = 'Σ' in joined
+    if not lowercase_tokens:
+        joined = joined.lower()
+    tokens_by_text = []
+    for text in joined.split('\x00\x00')[1:-1]:
+        tokens = text.replace('\x00', ' ').split()
+        if lowercase_tokens:
+            tokens = [token.lower() for token in tokens]
+        tokens = (token.rstrip(strip_right_chars).lstrip(strip_left_chars) for token in tokens)
+        tokens_by_text.append([token for token in tokens if token])
+    return tokens_by_text
@@ -4,6 +4,8 @@ $$
 DECLARE
     row     RECORD;
     changed boolean;
+    -- TG_ARGV[2] is the change query for fields that affect the citation graph, or 'false' if there are none
+    graph_changed boolean := TG_ARGV[2] <> 'false';
 BEGIN
     -- skip updates where no relevant columns are changed
     IF TG_OP = 'UPDATE' THEN
@@ -11,6 +13,9 @@ BEGIN
         if changed = false then
             return null;
         end if;
+        if graph_changed then
+            EXECUTE 'SELECT ' || TG_ARGV[2] || ';' INTO graph_changed USING OLD, NEW;
+        end if;
     end if;
 
     -- get row object to use for case_id
@@ -18,7 +23,7 @@ BEGIN
         -- special case if case itself is being deleted
         IF TG_ARGV[0] = 'id' THEN
             -- write to CaseDeleted
-            EXECUTE 'INSERT INTO capdb_casedeleted (case_id, timestamp, indexed) VALUES($1.' || TG_ARGV[0] || ', NOW(), false);'
+            EXECUTE 'INSERT INTO capdb_casedeleted (case_id, timestamp, indexed, ngrammed) VALUES($1.' || TG_ARGV[0] || ', NOW(), false, false);'
                 USING OLD;
             RETURN NULL;
         END IF;
@@ -29,10 +34,14 @@ BEGIN
     END IF;
 
     -- write to CaseLastUpdate
-    EXECUTE 'INSERT INTO capdb_caselastupdate (case_id, timestamp, indexed) VALUES($1.' || TG_ARGV[0] || ', NOW(), false)' ||
+    -- only move graph_timestamp for changes that affect the citation graph, so writing pagerank scores back to
+    -- capdb_caseanalysis doesn't make scripts.citation_graph.update_citation_graph() see those cases as changed
+    EXECUTE 'INSERT INTO capdb_caselastupdate (case_id, timestamp, indexed, ngrammed, graph_timestamp) ' ||
+            'VALUES($1.' || TG_ARGV[0] || ', NOW(), false, false, CASE WHEN $2 THEN NOW() END)' ||
             'ON CONFLICT (case_id)' ||
-            'DO UPDATE SET timestamp = NOW(), indexed = false;'
-        USING row;
+            'DO UPDATE SET timestamp = NOW(), indexed = false, ngrammed = false, ' ||
+            'graph_timestamp = CASE WHEN $2 THEN NOW() ELSE capdb_caselastupdate.graph_timestamp END;'
+        USING row, graph_changed;
     RETURN NULL;
 END;
 $$ LANGUAGE plpgsql;
@@ -74,8 +83,9 @@ BEGIN
     end if;
 
     -- write to CaseLastUpdate
-    EXECUTE 'INSERT INTO capdb_caselastupdate (case_id, timestamp, indexed) ' ||
-            'SELECT id, NOW(), false FROM capdb_casemetadata WHERE ' || TG_ARGV[0] || '=$1.' || TG_ARGV[1] || ' ' ||
+    -- foreign key fields don't affect ngrams, so leave ngrammed alone
+    EXECUTE 'INSERT INTO capdb_caselastupdate (case_id, timestamp, indexed, ngrammed) ' ||
+            'SELECT id, NOW(), false, true FROM capdb_casemetadata WHERE ' || TG_ARGV[0] || '=$1.' || TG_ARGV[1] || ' ' ||
             'ON CONFLICT (case_id)' ||
             'DO UPDATE SET timestamp = NOW(), indexed = false;'
         USING NEW;
@@ -116,6 +126,6 @@ $$ LANGUAGE plpgsql;
 --     AFTER INSERT OR DELETE OR UPDATE OF type, cite
 --     ON capdb_citation
 --     FOR EACH ROW
--- EXECUTE PROCEDURE track_last_update('case_id', 'type', 'cite');
+-- EXECUTE PROCEDURE track_last_update('case_id', '$1.type IS DISTINCT FROM $2.type or $1.cite IS DISTINCT FROM $2.cite', 'false');
 
 